@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
+import sys
 import distutils.core
+
+modules = ['wherigo', 'wherigo_replay', 'wherigo_host', 'wherigo_catalog']
+# wherigo_async uses syntax which older versions of python cannot compile.
+if sys.version_info >= (3, 7):
+	modules.append ('wherigo_async')
+
 distutils.core.setup (
 		name = 'wherigo',
-		py_modules = ['wherigo'],
+		py_modules = modules,
 		version = '0.1',
 		description = 'Wherigo cartridge interface',
 		author = 'Bas Wijnen',
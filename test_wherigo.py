@@ -0,0 +1,554 @@
+# test_wherigo.py - Tests for the wherigo module.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# Run with python -m unittest test_wherigo. Tests which run lua code need python-lua; they are skipped without it.
+# The other tests use a stand-in for the tables of python-lua if it is not installed.
+
+# Imports. {{{
+import os
+import sys
+import math
+import types
+import random
+import shutil
+import tempfile
+import unittest
+try:
+	import lua
+	have_lua = True
+except ImportError:
+	have_lua = False
+	class Table: # {{{
+		'Stand-in for lua tables: a list for the keys 1 to n and a dict for the others.'
+		def __init__ (self, data = None):
+			self.items = []
+			self.fields = {}
+			if isinstance (data, dict):
+				self.fields.update (data)
+			elif data is not None:
+				self.items = list (data)
+		def list (self):
+			return list (self.items)
+		def dict (self):
+			ret = dict (self.fields)
+			ret.update ((i + 1, v) for i, v in enumerate (self.items))
+			return ret
+		def __iadd__ (self, values):
+			self.items.extend (values)
+			return self
+		def __len__ (self):
+			return len (self.items)
+		def __getitem__ (self, key):
+			if isinstance (key, int) and 1 <= key <= len (self.items):
+				return self.items[key - 1]
+			return self.fields[key]
+		def __setitem__ (self, key, value):
+			if isinstance (key, int) and 1 <= key <= len (self.items) + 1:
+				if key > len (self.items):
+					self.items.append (value)
+				else:
+					self.items[key - 1] = value
+			else:
+				self.fields[key] = value
+	# }}}
+	class Lua: # {{{
+		'Stand-in for the interpreter, which can only make tables.'
+		def make_table (self, data = None):
+			return Table (data)
+	# }}}
+	lua = types.ModuleType ('lua')
+	lua.Table = Table
+	lua.lua = Lua
+	sys.modules['lua'] = lua
+import wherigo
+import wherigo_replay
+import wherigo_bench
+import wherigo_catalog
+# }}}
+
+config = {'PlayerName': 'Player', 'CompletionCode': '', 'env_Platform': 'python-wherigo', 'env_CartFolder': '/', 'env_SyncFolder': '/', 'env_LogFolder': '/', 'env_PathSep': '/', 'env_DeviceID': 'Test', 'env_Version': '2.11-compatible', 'env_Downloaded': 0, 'env_CartFilename': 'test', 'env_Device': 'Test'}
+
+class Callbacks: # {{{
+	'Host callbacks which record what the cartridge does.'
+	def __init__ (self):
+		self.calls = []
+		self.timers = {}
+		self.serial = 0
+	def __getattr__ (self, name):
+		if name.startswith ('__'):
+			raise AttributeError (name)
+		return lambda *args: self.calls.append ((name, args))
+	def add_timer (self, time, callback):
+		self.serial += 1
+		self.timers[self.serial] = callback
+		return self.serial
+	def remove_timer (self, handle):
+		self.timers.pop (handle, None)
+	def time (self):
+		return 1000.
+# }}}
+
+def make_cartridge (code): # {{{
+	'Write a cartridge directory with code as its lua setup; return its name. The code must define cart, the ZCartridge, which is returned.'
+	directory = tempfile.mkdtemp ()
+	with open (os.path.join (directory, '_cartridge.wfi'), 'w') as f:
+		f.write ('Name: test\n')
+	with open (os.path.join (directory, '_cartridge.lua'), 'w') as f:
+		f.write ('''cart = Wherigo.ZCartridge ()
+cart.StartingLocation = Wherigo.ZonePoint (52, 5, 0)
+cart.StartingLocationDescription = ''
+''' + code + '''
+return cart
+''')
+	return directory
+# }}}
+
+def make_game (): # {{{
+	'Set up Player and an empty ZCartridge like _Session._load does, without a cartridge file or a session; return the cartridge.'
+	wherigo._script = lua.lua ()
+	wherigo.Player = wherigo.ZCharacter (None)
+	wherigo.Player.ObjIndex = -1
+	wherigo.Player.Name = 'Player'
+	wherigo.Player.InsideOfZones = wherigo._script.make_table ()
+	wherigo.Player.PositionAccuracy = wherigo.Distance (10)
+	cartridge = wherigo.ZCartridge ()
+	cartridge._time = 0.
+	return cartridge
+# }}}
+
+def make_zone (cartridge, lat, lon, size = .001): # {{{
+	'Return an active triangular zone with its corner at lat, lon.'
+	zone = wherigo.Zone (cartridge)
+	zone.Points = wherigo._script.make_table ([wherigo.ZonePoint (lat, lon, 0), wherigo.ZonePoint (lat + size, lon, 0), wherigo.ZonePoint (lat, lon + size, 0)])
+	zone.Active = True
+	return zone
+# }}}
+
+class PointsTest (unittest.TestCase): # {{{
+	def setUp (self):
+		self.cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		self.zones = [make_zone (self.cartridge, 52, 5 + i * .01) for i in range (20)]
+		# Count the Points tables which are read for comparing them with the geometry.
+		self.scans = 0
+		items = wherigo._items
+		def count (table):
+			self.scans += 1
+			return items (table)
+		wherigo._items = count
+		self.addCleanup (setattr, wherigo, '_items', items)
+	def test_changed_in_place (self):
+		'Changing the Points table of a zone in place, as lua does, changes its geometry.'
+		zone = self.zones[0]
+		self.cartridge._update (wherigo_replay.Fix (1, 52.005, 5.0001), 1)
+		self.assertFalse (zone._inside)
+		zone.Points[2] = wherigo.ZonePoint (52.01, 5, 0)
+		self.assertTrue (wherigo.IsPointInZone (wherigo.ZonePoint (52.005, 5.0001, 0), zone))
+		self.cartridge._update (wherigo_replay.Fix (2, 52.005, 5.0001), 2)
+		self.assertTrue (zone._inside)
+	def test_far_zone_changed_in_place (self):
+		'A zone which _update does not evaluate because it is far away notices changes of its Points too.'
+		zone = self.zones[-1]
+		self.cartridge._update (wherigo_replay.Fix (1, 52.0003, 5.0023), 1)
+		self.assertEqual (zone.State, 'Distant')
+		zone.Points[1] = wherigo.ZonePoint (52, 5.002, 0)
+		zone.Points[2] = wherigo.ZonePoint (52.001, 5.002, 0)
+		zone.Points[3] = wherigo.ZonePoint (52, 5.003, 0)
+		self.cartridge._update (wherigo_replay.Fix (2, 52.0003, 5.0023), 2)
+		self.assertTrue (zone._inside)
+	def test_no_scan_without_reads (self):
+		'A fix which follows no reads of Points tables does not look at them.'
+		self.cartridge._update (wherigo_replay.Fix (1, 52.0005, 5.0001), 1)
+		self.zones[3].Points
+		self.scans = 0
+		self.cartridge._update (wherigo_replay.Fix (2, 52.0004, 5.0001), 2)
+		self.assertEqual (self.scans, 1)
+		self.scans = 0
+		for t in range (3, 10):
+			self.cartridge._update (wherigo_replay.Fix (t, 52.0005, 5.0001 + t * .0001), t)
+		self.assertEqual (self.scans, 0)
+# }}}
+
+class SaveTest (unittest.TestCase): # {{{
+	def setUp (self):
+		directory = tempfile.mkdtemp ()
+		self.addCleanup (shutil.rmtree, directory)
+		self.filename = os.path.join (directory, 'game.sav')
+		self.addCleanup (wherigo.ZCartridge._new)
+	def game (self):
+		'Set up a new game with the objects which the cartridge code would create; return the cartridge, an item and a zone.'
+		wherigo.ZCartridge._new ()
+		cartridge = make_game ()
+		item = wherigo.ZItem (cartridge)
+		item.Name = 'key'
+		zone = make_zone (cartridge, 52, 5)
+		return cartridge, item, zone
+	def test_round_trip (self):
+		'Restoring a saved game brings back the attributes of its objects, also after appended saves.'
+		cartridge, item, zone = self.game ()
+		item.ObjectLocation = wherigo.ZonePoint (52.1, 5.2, 0)
+		item.Description = 'a key'
+		item.MoveTo (wherigo.Player)
+		zone.Visible = False
+		self.assertEqual (cartridge._save (self.filename), 4)
+		self.assertEqual (cartridge._save (self.filename), 0)
+		item.Description = 'an old key'
+		self.assertEqual (cartridge._save (self.filename), 1)
+		cartridge, item, zone = self.game ()
+		cartridge._restore (self.filename)
+		self.assertEqual (item.Description, 'an old key')
+		self.assertIs (item.Container, wherigo.Player)
+		self.assertFalse (zone.Visible)
+		self.assertEqual ((item.ObjectLocation.latitude, item.ObjectLocation.longitude), (52.1, 5.2))
+		self.assertEqual (len (zone.Points), 3)
+	def test_interrupted_save (self):
+		'An appended save which was not completely written is ignored.'
+		cartridge, item, zone = self.game ()
+		item.Description = 'first'
+		cartridge._save (self.filename)
+		with open (self.filename, 'ab') as f:
+			f.write (b'F\xff\x00\x00\x00')
+		cartridge, item, zone = self.game ()
+		cartridge._restore (self.filename)
+		self.assertEqual (item.Description, 'first')
+	def test_reject (self):
+		'Files which do not start with the header of this version are not restored.'
+		cartridge, item, zone = self.game ()
+		cartridge._save (self.filename)
+		with open (self.filename, 'rb') as f:
+			data = f.read ()
+		for header in (b'WIGSAVE2', b'GARBAGE!'):
+			with open (self.filename, 'wb') as f:
+				f.write (header + data[len (header):])
+			cartridge, item, zone = self.game ()
+			self.assertRaises (ValueError, cartridge._restore, self.filename)
+# }}}
+
+class SpatialTest (unittest.TestCase): # {{{
+	def setUp (self):
+		self.cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		rnd = random.Random (1)
+		# Items are visible in a zone which always shows them.
+		world = make_zone (self.cartridge, 51, 4)
+		world.ShowObjects = 'Always'
+		self.items = []
+		for i in range (60):
+			item = wherigo.ZItem (self.cartridge)
+			item.ObjectLocation = wherigo.ZonePoint (52 + rnd.uniform (-.02, .02), 5 + rnd.uniform (-.03, .03), 0)
+			item.MoveTo (world)
+			self.items.append (item)
+		self.zones = [world] + [make_zone (self.cartridge, 52 + rnd.uniform (-.02, .02), 5 + rnd.uniform (-.03, .03)) for i in range (20)]
+		self.point = wherigo.ZonePoint (52.001, 5.002, 0)
+	def brute_force (self):
+		'Return (distance, object) for all objects, sorted by distance.'
+		ret = [(wherigo.VectorToPoint (self.point, item.ObjectLocation)[0].value, item) for item in self.items]
+		ret += [(wherigo.VectorToZone (self.point, zone)[0].value, zone) for zone in self.zones]
+		return sorted (ret, key = lambda x: x[0])
+	def check (self):
+		expected = self.brute_force ()
+		nearest = self.cartridge._nearest (10, self.point)
+		self.assertEqual ([obj for obj, distance, bearing in nearest], [obj for distance, obj in expected[:10]])
+		for (obj, distance, bearing), (d, o) in zip (nearest, expected):
+			self.assertAlmostEqual (distance.value, d, places = 3)
+		within = self.cartridge._within (1500, self.point)
+		self.assertEqual (set (obj for obj, distance, bearing in within), set (obj for distance, obj in expected if distance <= 1500))
+	def test_brute_force (self):
+		'_nearest and _within find the same objects as computing all distances.'
+		self.check ()
+	def test_changes (self):
+		'The index follows objects which move, are carried or become invisible.'
+		self.check ()
+		self.items[0].ObjectLocation = wherigo.ZonePoint (52.0015, 5.0025, 0)
+		self.items[1].ObjectLocation.latitude = 52.0010
+		self.items[1].ObjectLocation.longitude = 5.0019
+		self.zones[1].Points[1] = wherigo.ZonePoint (52.003, 5.004, 0)
+		self.check ()
+		self.assertEqual (self.cartridge._nearest (1, self.point)[0][0], self.items[1])
+		self.items[1].MoveTo (wherigo.Player)
+		self.items[0].Visible = False
+		del self.items[:2]
+		self.check ()
+# }}}
+
+@unittest.skipIf (wherigo._numpy is None, 'numpy is not installed')
+class ZoneBatchTest (unittest.TestCase): # {{{
+	def setUp (self):
+		self.addCleanup (wherigo.ZCartridge._new)
+		self.build ()
+	def build (self):
+		'Set up a game with random zones.'
+		self.cartridge = make_game ()
+		self.rnd = random.Random (2)
+		self.zones = []
+		for i in range (40):
+			# Star shapes, which are concave.
+			lat, lon = 52 + self.rnd.uniform (-.01, .01), 5 + self.rnd.uniform (-.015, .015)
+			n = self.rnd.randint (3, 9)
+			points = []
+			for k in range (n):
+				angle = 2 * math.pi * k / n
+				r = self.rnd.uniform (.0002, .0015) * (.4 if k % 2 else 1)
+				points.append (wherigo.ZonePoint (lat + r * math.sin (angle), lon + r * 1.6 * math.cos (angle), 0))
+			zone = wherigo.Zone (self.cartridge)
+			zone.Points = wherigo._script.make_table (points)
+			zone.Active = True
+			self.zones.append (zone)
+	def test_parity (self):
+		'A _ZoneBatch computes the same as the geometry of every zone.'
+		batch = wherigo._ZoneBatch (self.zones)
+		for n in range (200):
+			lat, lon = 52 + self.rnd.uniform (-.012, .012), 5 + self.rnd.uniform (-.018, .018)
+			zones = self.rnd.sample (self.zones, 25)
+			results = batch.evaluate (wherigo.ZonePoint (lat, lon, 0), zones)
+			self.assertEqual (set (results), set (zones))
+			for zone in zones:
+				geometry = zone._get_geometry ()
+				serial, inside, distance, bearing = results[zone]
+				self.assertEqual (serial, zone._geometry_serial)
+				self.assertEqual (inside, geometry.inside (lat, lon))
+				if not inside:
+					d, b = geometry.vector (lat, lon)
+					self.assertAlmostEqual (distance, d, places = 4)
+					self.assertAlmostEqual ((bearing - b + 180) % 360 - 180, 0, places = 4)
+	def walk (self, engine):
+		'Walk along the zones with _update and _zone_engine set to engine; return the zone events.'
+		self.cartridge._zone_engine = engine
+		log = []
+		for zone in self.zones:
+			zone.ProximityRange = wherigo.Distance (50)
+			zone.DistanceRange = wherigo.Distance (300)
+			for event in ('OnEnter', 'OnExit', 'OnProximity', 'OnDistant'):
+				setattr (zone, event, lambda z, event = event: log.append ((self.cartridge._time, event, self.zones.index (z))))
+		rnd = random.Random (3)
+		lat, lon = 52, 5
+		for t in range (1, 500):
+			lat += rnd.uniform (-.0004, .0004)
+			lon += rnd.uniform (-.0006, .0006)
+			self.cartridge._update (wherigo_replay.Fix (t, lat, lon), t)
+		return log
+	def test_engines (self):
+		'_update gives the same events with the numpy engine as with the python engine.'
+		events = self.walk ('python')
+		self.assertTrue (len (events) > 0)
+		wherigo.ZCartridge._new ()
+		self.build ()
+		self.assertEqual (self.walk ('numpy'), events)
+# }}}
+
+class CatalogTest (unittest.TestCase): # {{{
+	def setUp (self):
+		self.root = tempfile.mkdtemp ()
+		self.addCleanup (shutil.rmtree, self.root)
+		os.mkdir (os.path.join (self.root, 'sub'))
+		rnd = random.Random (4)
+		for i in range (30):
+			wherigo_bench.make_cartridge (self.path (i), 1, 3, 0, 0, i, center = (rnd.uniform (-60, 60), rnd.uniform (-179, 179)))
+		with open (os.path.join (self.root, 'broken.gwz'), 'wb') as f:
+			f.write (b'not a cartridge')
+		self.catalog = wherigo_catalog.Catalog (os.path.join (self.root, 'catalog.db'))
+		self.addCleanup (self.catalog.close)
+	def path (self, i):
+		return os.path.join (self.root, 'sub' if i % 2 else '', 'c%d.gwz' % i)
+	def test_scan (self):
+		'Scanning reads new and changed files only, and removes entries of files which are gone.'
+		self.assertEqual (self.catalog.scan (self.root, 1), (31, 30, 0))
+		self.assertEqual (len (self.catalog.entries ()), 31)
+		self.assertEqual (self.catalog.get (self.path (3))['name'], 'Benchmark')
+		self.assertIsNotNone (self.catalog.get (os.path.join (self.root, 'broken.gwz'))['error'])
+		self.assertEqual (self.catalog.scan (self.root, 1), (0, 0, 0))
+		wherigo_bench.make_cartridge (self.path (4), 2, 3, 0, 0, 4, center = (10, 10))
+		os.remove (self.path (6))
+		self.assertEqual (self.catalog.scan (self.root, 1), (1, 1, 1))
+		self.assertEqual ((self.catalog.get (self.path (4))['latitude'], self.catalog.get (self.path (4))['longitude']), (10, 10))
+		self.assertIsNone (self.catalog.get (self.path (6)))
+	def test_nearest (self):
+		'nearest finds the same cartridges as computing all distances.'
+		self.catalog.scan (self.root, 1)
+		entries = [e for e in self.catalog.entries () if e['latitude'] is not None]
+		rnd = random.Random (5)
+		for n in range (30):
+			lat, lon = rnd.uniform (-70, 70), rnd.uniform (-180, 180)
+			distances = sorted ((wherigo._meters (wherigo._vector (*[math.radians (x) for x in (lat, lon, e['latitude'], e['longitude'])])[0]), e['path']) for e in entries)
+			self.assertEqual ([(round (d, 3), e['path']) for d, e in self.catalog.nearest (lat, lon, 5)], [(round (d, 3), p) for d, p in distances[:5]])
+			radius = distances[3][0] + 1
+			self.assertEqual ([e['path'] for d, e in self.catalog.nearest (lat, lon, 10, radius)], [p for d, p in distances[:4]])
+# }}}
+
+class GeodesyTest (unittest.TestCase): # {{{
+	def test_safe_radius_ellipsoidal (self):
+		'A zone which the player walks into is entered, also where ellipsoidal distances are shorter than spherical ones.'
+		cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		# Without a session, the model of the class is used.
+		wherigo.ZCartridge._geodesy = 'ellipsoidal'
+		self.addCleanup (setattr, wherigo.ZCartridge, '_geodesy', 'spherical')
+		# The zone starts 800 spherical meters north of the equator.
+		south = 800 / (60 * 1852.)
+		zone = wherigo.Zone (cartridge)
+		zone.Points = wherigo._script.make_table ([wherigo.ZonePoint (lat, lon, 0) for lat, lon in ((south, -.005), (south + .01, -.005), (south + .01, .005), (south, .005))])
+		zone.Active = True
+		cartridge._update (wherigo_replay.Fix (1, 0, 0), 1)
+		self.assertFalse (zone._inside)
+		cartridge._update (wherigo_replay.Fix (2, 802 / (60 * 1852.), 0), 2)
+		self.assertTrue (zone._inside)
+		self.assertEqual (zone.State, 'Inside')
+# }}}
+
+class TimerTest (unittest.TestCase): # {{{
+	def ticks (self, engine):
+		'Play interval timers of 3 and 5 seconds for 20 seconds with Replay; return the ticks as (name, time).'
+		cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		cartridge._timer_engine = engine
+		replay = wherigo_replay.Replay ()
+		replay.cartridge = cartridge
+		wherigo._cb = replay
+		self.addCleanup (setattr, wherigo, '_cb', None)
+		ticks = []
+		timers = []
+		for duration in (3, 5):
+			timer = wherigo.ZTimer (cartridge)
+			timer.Name = 't%d' % duration
+			timer.Type = 'Interval'
+			timer.Duration = duration
+			timer.OnTick = lambda t: ticks.append ((t.Name, replay.now))
+			timers.append (timer)
+		replay.begin (0)
+		for timer in timers:
+			timer.Start ()
+		replay.advance (20)
+		return sorted (ticks, key = lambda t: (t[1], t[0]))
+	def test_engines_tick_alike (self):
+		'The heap engine ticks at the same times as host timers, also when Replay runs _update before the host timer.'
+		expected = sorted ([('t3', t) for t in range (3, 20, 3)] + [('t5', t) for t in range (5, 21, 5)], key = lambda t: (t[1], t[0]))
+		self.assertEqual (self.ticks ('host'), expected)
+		self.assertEqual (self.ticks ('heap'), expected)
+	def test_unchanged_timer (self):
+		'Ticks of an interval timer without handlers, and setting Remaining to its value, do not report the timer as changed.'
+		cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		replay = wherigo_replay.Replay ()
+		replay.cartridge = cartridge
+		wherigo._cb = replay
+		self.addCleanup (setattr, wherigo, '_cb', None)
+		timer = wherigo.ZTimer (cartridge)
+		timer.Type = 'Interval'
+		timer.Duration = 3
+		replay.begin (0)
+		timer.Start ()
+		notify = wherigo._notify
+		notify.enter ()
+		self.addCleanup (notify.leave, False)
+		replay.advance (4)
+		self.assertEqual (timer._target, 6)
+		timer.Stop ()
+		notify.changes = {}
+		timer.Remaining = timer.Remaining
+		self.assertNotIn ('objects', notify.changes)
+# }}}
+
+class ReplayTest (unittest.TestCase): # {{{
+	def test_zone_events_in_order (self):
+		'Entering and leaving a zone is logged before the messages which OnEnter and OnExit show.'
+		cartridge = make_game ()
+		self.addCleanup (wherigo.ZCartridge._new)
+		replay = wherigo_replay.Replay ()
+		replay.cartridge = cartridge
+		wherigo._cb = replay
+		self.addCleanup (setattr, wherigo, '_cb', None)
+		zone = make_zone (cartridge, 52, 5)
+		zone.Name = 'z'
+		zone.OnEnter = lambda z: wherigo.MessageBox ({'Text': 'in', 'Callback': lambda button: wherigo.MessageBox ({'Text': button})})
+		zone.OnExit = lambda z: wherigo.MessageBox ({'Text': 'out'})
+		fixes = [wherigo_replay.Fix (t, lat, 5.0001) for t, lat in ((0, 51.9), (1, 52.0001), (2, 51.9))]
+		events = [e[1:] for e in replay.run (fixes)]
+		self.assertEqual (events, [
+			('start', cartridge.Name, None),
+			('state', 'z', 'Distant'),
+			('enter', 'z', None),
+			('state', 'z', 'Inside'),
+			('message', 'in', 'Button1'),
+			('message', 'Button1', 'Button1'),
+			('exit', 'z', None),
+			('state', 'z', 'Distant'),
+			('message', 'out', 'Button1')])
+# }}}
+
+@unittest.skipIf (not have_lua, 'python-lua is not installed')
+class SetupTest (unittest.TestCase): # {{{
+	def load (self, code):
+		directory = make_cartridge (code)
+		self.addCleanup (shutil.rmtree, directory)
+		self.addCleanup (wherigo.ZCartridge._new)
+		return wherigo._load (directory, Callbacks (), config)
+	def test_geometry_in_setup (self):
+		'Setup code can use TranslatePoint before the cartridge of the session is known.'
+		cartridge = self.load ('cart.Moved = Wherigo.TranslatePoint (cart.StartingLocation, Wherigo.Distance (1852), 0)')
+		self.assertAlmostEqual (cartridge.Moved.latitude, 52 + 1 / 60.)
+		self.assertAlmostEqual (cartridge.Moved.longitude, 5)
+	def test_points_changed_in_place (self):
+		'Changing the Points table of a zone in place changes its geometry.'
+		cartridge = self.load ('''cart.Zone = Wherigo.Zone (cart)
+cart.Zone.Points = {Wherigo.ZonePoint (52, 5, 0), Wherigo.ZonePoint (52.001, 5, 0), Wherigo.ZonePoint (52, 5.001, 0)}
+function cart.Stretch ()
+	cart.Zone.Points[2] = Wherigo.ZonePoint (52.01, 5, 0)
+end''')
+		point = wherigo.ZonePoint (52.005, 5.0001, 0)
+		self.assertFalse (wherigo.IsPointInZone (point, cartridge.Zone))
+		cartridge._session._call (cartridge.Stretch)
+		self.assertTrue (wherigo.IsPointInZone (point, cartridge.Zone))
+# }}}
+
+class PoolCallbacksTest (unittest.TestCase): # {{{
+	def test_pending_timers (self):
+		'Timers which are added before a pooled session is taken can be removed, before and after that.'
+		cbs = wherigo._PoolCallbacks ()
+		first = cbs.add_timer (10, None)
+		second = cbs.add_timer (20, None)
+		cbs.remove_timer (second)
+		host = Callbacks ()
+		cbs._take (host)
+		self.assertEqual (list (host.timers), [1])
+		cbs.remove_timer (first)
+		self.assertEqual (host.timers, {})
+# }}}
+
+def sentence (body): # {{{
+	'Return an nmea sentence with its checksum.'
+	check = 0
+	for c in body:
+		check ^= ord (c)
+	return '$%s*%02X\n' % (body, check)
+# }}}
+
+class NmeaTest (unittest.TestCase): # {{{
+	def test_gga_before_rmc (self):
+		'Fixes from GGA sentences before the first RMC get its date, also across midnight.'
+		lines = []
+		for tod, date in (('235959', '230394'), ('000000', '240394')):
+			lines.append (sentence ('GPGGA,%s,5200.000,N,00500.000,E,1,08,0.9,10.0,M,,,,' % tod))
+			lines.append (sentence ('GPRMC,%s,A,5200.000,N,00500.000,E,0.0,0.0,%s,,' % (tod, date)))
+		# 23 March 1994, 23:59:59.
+		start = 764467199
+		self.assertEqual ([fix.time for fix in wherigo_replay.read_nmea (lines)], [start, start + 1])
+		self.assertEqual ([fix.time for fix in wherigo_replay.read_nmea (lines[:1] + lines[2:])], [start, start + 1])
+# }}}
+
+if __name__ == '__main__':
+	unittest.main ()
@@ -25,6 +25,17 @@ import struct as _struct
 import zipfile as _zipfile
 import os as _os
 import sys as _sys
+import mmap as _mmap
+import collections as _collections
+import heapq as _heapq
+import time as _time
+import json as _json
+import hashlib as _hashlib
+try:
+	import numpy as _numpy
+except ImportError:
+	# Without numpy, zones are always evaluated one at a time.
+	_numpy = None
 # }}}
 
 # Constants and globals. {{{
@@ -57,6 +68,12 @@ _cb = None
 _wfz = None
 # Function to open a file from the current cartridge.
 _wfzopen = None
+# Compiled cartridge (_GWC), if the current cartridge is a gwc file.
+_gwc = None
+# Invisible item at the starting location of the current cartridge, for drawing on the map.
+_starting_marker = None
+# The _Session which the above globals belong to. Every loaded cartridge has its own session; the entry points (_update, timer ticks) make theirs current.
+_session = None
 # }}}
 
 def _table_arg (f): # {{{
@@ -70,13 +87,334 @@ def _table_arg (f): # {{{
 	return ret
 # }}}
 
+def _items (table): # {{{
+	'Return the values of a lua table (or a python sequence) as a list.'
+	if isinstance (table, _lang.Table):
+		return table.list ()
+	return list (table)
+# }}}
+
+def _fields (table): # {{{
+	'Return the contents of a lua table (or a python mapping) as a dict.'
+	if isinstance (table, _lang.Table):
+		return table.dict ()
+	return dict (table)
+# }}}
+
+class _MediaCache: # {{{
+	'Contents of media files, limited to size bytes. When it is full, the least recently used files are dropped.'
+	def __init__ (self, size = 16 << 20):
+		self.size = size
+		self.clear ()
+	def clear (self):
+		self.entries = _collections.OrderedDict ()
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	def get (self, key, load):
+		'Return the data for key. If it is not in the cache, call load to get it.'
+		data = self.entries.pop (key, None)
+		if data is not None:
+			self.hits += 1
+			# Put it back at the end, to mark it as most recently used.
+			self.entries[key] = data
+			return data
+		self.misses += 1
+		data = load ()
+		if len (data) > self.size:
+			return data
+		while self.used + len (data) > self.size:
+			self.used -= len (self.entries.popitem (last = False)[1])
+			self.evictions += 1
+		self.entries[key] = data
+		self.used += len (data)
+		return data
+	def stats (self):
+		return {'size': self.size, 'used': self.used, 'entries': len (self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+# }}}
+
+# Recently used media file contents of the current cartridge.
+_media_cache = _MediaCache ()
+
+class _ChunkCache: # {{{
+	'''On-disk cache of the compiled lua code and the parsed wfi file of gwz files and cartridge directories. It is only used if directory is set.
+	Entries are keyed by the sha1 of the cartridge file (or of the wfi and lua files of a directory), so a changed cartridge gets a new entry.
+	Compiled code is only used by an interpreter of the same version as the one which compiled it; otherwise it is compiled and stored again.'''
+	magic = b'WIGCHNK1\n'
+	def __init__ (self, directory = None):
+		self.directory = directory
+		self.hits = 0
+		self.misses = 0
+	def key (self, file):
+		'Return the key for a cartridge file or directory.'
+		h = _hashlib.sha1 ()
+		files = [_os.path.join (file, name) for name in ('_cartridge.wfi', '_cartridge.lua')] if _os.path.isdir (file) else [file]
+		for name in files:
+			with open (name, 'rb') as f:
+				while True:
+					data = f.read (1 << 16)
+					if not data:
+						break
+					h.update (data)
+		return h.hexdigest ()
+	def version (self, script):
+		'Return a string which identifies the lua interpreter and the format of its compiled code.'
+		return '%s/%s/%d/%s' % (script.run ('return _VERSION', name = 'version')[0], getattr (_lang, '__version__', ''), _struct.calcsize ('P'), _sys.byteorder)
+	def load (self, key, image):
+		'Return the info, the version of the compiled code and the compiled code for key, and fill the media tree of image; or return None if there is no valid entry.'
+		try:
+			with open (_os.path.join (self.directory, key), 'rb') as f:
+				if f.read (len (self.magic)) != self.magic:
+					return None
+				header = _json.loads (f.readline ().decode ('utf-8'))
+				chunk = f.read ()
+			for path, alt, provider in header['media']:
+				target = image.media
+				for sub in path[:-1]:
+					target = target.setdefault (sub, {})
+				media = _Media (alt, image)
+				for kind in provider:
+					media._provider[kind] = [(value, longvalue) for value, longvalue in provider[kind]]
+				target[path[-1]] = media
+			info = dict ((k, None if v is None else (v[0], v[1])) for k, v in header['info'].items ())
+			return info, header['version'], chunk
+		except (IOError, OSError, ValueError, KeyError, TypeError):
+			image.media.clear ()
+			return None
+	def store (self, key, image, version, chunk):
+		'Store the info and media of image, and compiled code of the given version, for key.'
+		media = []
+		def walk (tree, path):
+			for name in sorted (tree):
+				if isinstance (tree[name], dict):
+					walk (tree[name], path + [name])
+				else:
+					media.append ((path + [name], tree[name].AltText, tree[name]._provider))
+		walk (image.media, [])
+		header = _json.dumps ({'version': version, 'info': image.info, 'media': media}).encode ('utf-8')
+		filename = _os.path.join (self.directory, key)
+		try:
+			if not _os.path.isdir (self.directory):
+				_os.makedirs (self.directory)
+			with open (filename + '.tmp', 'wb') as f:
+				f.write (self.magic + header + b'\n')
+				f.write (chunk)
+			_os.rename (filename + '.tmp', filename)
+		except (IOError, OSError) as e:
+			_sys.stderr.write ('Warning: unable to write chunk cache %s: %s\n' % (filename, e))
+	def compile (self, script, code):
+		'Compile lua source code with script; return the compiled code.'
+		if not isinstance (code, bytes):
+			code = code.encode ('utf-8')
+		ret = script.run ('local f, e = (loadstring or load) (source, "=cartridge setup") if not f then error (e) end return string.dump (f)', 'source', code, name = 'compiling cartridge')[0]
+		if not isinstance (ret, bytes):
+			raise TypeError ('compiled code is not returned as bytes')
+		return ret
+	def stats (self):
+		return {'directory': self.directory, 'hits': self.hits, 'misses': self.misses}
+# }}}
+
+# Compiled cartridge code, if enabled by setting _chunk_cache.directory.
+_chunk_cache = _ChunkCache ()
+
+class _Stats: # {{{
+	'''Call counts, and total and maximum wall time, of _update, timer ticks, zone evaluations, lua event handlers and host callbacks.
+	Nothing is recorded unless it is enabled. If interval is set, the statistics are written to output as a line of json every interval seconds.'''
+	clock = staticmethod (getattr (_time, 'perf_counter', _time.time))
+	def __init__ (self):
+		self.enabled = False
+		self.interval = None
+		self.output = _sys.stderr
+		self.reset ()
+	def reset (self):
+		self.data = {}		# category: {key: [calls, total time, maximum time]}
+		self.last_dump = self.clock ()
+	def enable (self, enabled = True):
+		'Start or stop recording. While enabled, the host callbacks are called through a _TimedCallbacks.'
+		global _cb
+		self.enabled = enabled
+		if _session is not None:
+			_cb = _session._callbacks ()
+		elif enabled and _cb is not None and not isinstance (_cb, _TimedCallbacks):
+			_cb = _TimedCallbacks (_cb)
+		elif not enabled and isinstance (_cb, _TimedCallbacks):
+			_cb = _cb._cbs
+	def record (self, category, key, seconds):
+		entry = self.data.setdefault (category, {}).get (key)
+		if entry is None:
+			self.data[category][key] = [1, seconds, seconds]
+		else:
+			entry[0] += 1
+			entry[1] += seconds
+			if seconds > entry[2]:
+				entry[2] = seconds
+		if self.interval is not None and self.last_dump + self.interval <= self.clock ():
+			self.dump ()
+	def call (self, category, key, function, *args):
+		'Call function with args, and record the time it takes.'
+		start = self.clock ()
+		try:
+			return function (*args)
+		finally:
+			self.record (category, key, self.clock () - start)
+	def timed_items (self, category, items):
+		'Yield all items, and record the time until the next one is requested under the Name of the item.'
+		for item in items:
+			start = self.clock ()
+			try:
+				yield item
+			finally:
+				self.record (category, item.Name, self.clock () - start)
+	def get (self):
+		'Return the statistics as {category: {key: {"calls": count, "total": seconds, "max": seconds}}}.'
+		return dict ((category, dict ((key, {'calls': v[0], 'total': v[1], 'max': v[2]}) for key, v in keys.items ())) for category, keys in self.data.items ())
+	def dump (self, output = None):
+		'Write the statistics to output (default self.output) as a line of json.'
+		self.last_dump = self.clock ()
+		output = output or self.output
+		output.write (_json.dumps (self.get (), sort_keys = True) + '\n')
+		output.flush ()
+# }}}
+
+# Time spent in _update, lua handlers and host callbacks, if enabled.
+_stats = _Stats ()
+
+class _TimedCallbacks: # {{{
+	'Wrapper around the host callbacks, which records the time every call takes.'
+	def __init__ (self, cbs):
+		self._cbs = cbs
+	def __getattr__ (self, name):
+		function = getattr (self._cbs, name)
+		if not callable (function):
+			return function
+		ret = lambda *args: _stats.call ('callback', name, function, *args)
+		setattr (self, name, ret)
+		return ret
+# }}}
+
+class _Notifier: # {{{
+	'''Changes which the gui must show, collected while the host has called into the module (_update, a timer tick, a lua handler, _Session._call),
+	and reported once, when the outermost of those calls returns. Changes made outside such a call are reported immediately.
+	If the host callbacks have a notify function, it is called with a dict {kind: list of changed objects}, where kind is one of:
+		'map' (locations, zone points, visibility), 'stats' (distances and bearings), 'inventory' (objects moved to or from Player),
+		'tasks' (attributes of a ZTask), 'objects' (any public attribute of a ZObject). The objects are sorted by ObjIndex.
+		If ZCartridge._screen has been used, 'screens' is a dict {screen name: (added objects, removed objects)} instead, for the list screens which have changed.
+	Otherwise, update_map is called if a ZonePoint has been moved.
+	Every _Session has its own notifier, which reports to the callbacks of that session; _notify is the one of the current session.'''
+	def __init__ (self, session = None):
+		self.session = session
+		self.depth = 0
+		self.changes = {}	# kind: {object: None}
+		self.points_moved = False
+	def mark (self, kind, obj = None):
+		objects = self.changes.get (kind)
+		if objects is None:
+			objects = self.changes[kind] = {}
+		if obj is not None:
+			objects[obj] = None
+		if self.depth == 0:
+			self.flush ()
+	def enter (self):
+		self.depth += 1
+	def leave (self, report = True):
+		'End a call. If it is the outermost call, report the changes, or discard them if report is False.'
+		self.depth -= 1
+		if self.depth == 0:
+			if report:
+				self.flush ()
+			else:
+				self.changes = {}
+				self.points_moved = False
+	def call (self, function, *args):
+		'Call function with args, and report the changes it made when it is the outermost call.'
+		self.depth += 1
+		try:
+			return function (*args)
+		finally:
+			self.leave ()
+	def flush (self):
+		if len (self.changes) == 0:
+			return
+		screens = self.changes.pop ('screens', {})
+		changes = dict ((kind, sorted (objects, key = lambda obj: obj.__dict__.get ('ObjIndex', 0))) for kind, objects in self.changes.items ())
+		self.changes = {}
+		for s in screens:
+			deltas = s.changes ()
+			if len (deltas) > 0:
+				changes.setdefault ('screens', {}).update (deltas)
+		if len (changes) == 0:
+			return
+		points_moved = self.points_moved
+		self.points_moved = False
+		cb = _cb if self.session is None else self.session._callbacks ()
+		if cb is None:
+			return
+		# Changes which the host makes while handling these are reported after it returns.
+		self.depth += 1
+		try:
+			notify = getattr (cb, 'notify', None)
+			if notify is not None:
+				notify (changes)
+			elif points_moved:
+				cb.update_map ()
+		finally:
+			self.depth -= 1
+		if self.depth == 0:
+			self.flush ()
+# }}}
+
+# Changes for the gui which have not been reported yet, of the current session.
+_notify = _Notifier ()
+
+def _notifier_of (cartridge): # {{{
+	'Return the _Notifier of the session of cartridge; the current one if it has no session. Changes to objects must be reported to the session they belong to, also when the host changes them while another session is current.'
+	session = None if cartridge is None else cartridge._session
+	return _notify if session is None else session.notifier
+# }}}
+
+def _unchanged (old, value): # {{{
+	'Return whether setting an attribute which was old to value changes nothing. Only plain values and Distances are compared by value; other objects must be the same.'
+	if old is value:
+		return True
+	if type (old) is not type (value) or not isinstance (old, (bool, int, float, type (''), type (u''), Distance)):
+		return False
+	return old == value
+# }}}
+
+def _fire (obj, event, *args): # {{{
+	'Call the lua handler for event on obj, and record the time it takes if statistics are enabled.'
+	if not _stats.enabled:
+		return _notify.call (getattr (obj, event), obj, *args)
+	return _notify.call (_stats.call, 'event', event, getattr (obj, event), obj, *args)
+# }}}
+
 class _Media: # {{{
-	def __init__ (self, alt):
+	def __init__ (self, alt, image):
 		self.AltText = alt
 		self._provider = {'File': [], 'URL': []}
+		self._image = image	# The _CartridgeImage which contains the files.
+	def _open (self):
+		'Open the first file of this media for reading, or return None if there is no file. Use this for streaming large files; use _get_data for anything that may be shown more than once.'
+		if len (self._provider['File']) == 0:
+			return None
+		return self._image.open (self._provider['File'][0][0], 'rb')
+	def _get_data (self):
+		'Return the contents of the first file of this media, or None if there is no file. Recently used files are kept in _media_cache, so they are not read and decompressed every time.'
+		if len (self._provider['File']) == 0:
+			return None
+		name = self._provider['File'][0][0]
+		def load ():
+			f = self._image.open (name, 'rb')
+			try:
+				return f.read ()
+			finally:
+				f.close ()
+		# The cache is shared by all sessions; sessions of the same cartridge file share its entries.
+		return _media_cache.get ((self._image.key, name), load)
 # }}}
 
-def _parse_wfi (file, config): # {{{
+def _parse_wfi (file, config, image): # {{{
 	ret = {}
 	for key in ('Format', 'Name', 'Version', 'Author', 'E-mail', 'Copyright', 'License', 'Company', 'Activity', 'StartingLocation', 'TargetDevice', 'TargetDeviceVersion', 'BuilderVersion', 'Poster', 'Icon', 'CreateDate', 'UpdateDate', 'PlayerName', 'CompletionCode'):
 		ret[key] = None
@@ -112,7 +450,7 @@ def _parse_wfi (file, config): # {{{
 			last_media._provider[key].append ((value, longvalue))
 			continue
 		if key == 'Media':
-			target = Media
+			target = image.media
 			value = value.split ('.')
 			for sub in value[:-1]:
 				if sub.startswith ('_'):
@@ -130,7 +468,7 @@ def _parse_wfi (file, config): # {{{
 			if v in target:
 				_sys.stderr.write ('Error: duplicate definition of media: %s\n' % value)
 				continue
-			last_media = _Media (longvalue)
+			last_media = _Media (longvalue, image)
 			target[v] = last_media
 			continue
 		last_media = None
@@ -148,93 +486,701 @@ def _parse_wfi (file, config): # {{{
 	return ret
 # }}}
 
+def _view (data, offset, size): # {{{
+	'Return a view of size bytes at offset in data, without copying them.'
+	if _sys.version_info[0] < 3:
+		# Python 2 cannot make a memoryview of an mmap.
+		return buffer (data, offset, size)
+	return memoryview (data)[offset:offset + size]
+# }}}
+
+class _GWC: # {{{
+	'''Compiled cartridge file (gwc), memory mapped.
+	The header and the table of objects are parsed immediately; the lua bytecode and the media are only read when they are used.'''
+	signature = b'\x02\x0aCART\x00'
+	media_types = {1: 'bmp', 2: 'png', 3: 'jpg', 4: 'gif', 17: 'wav', 18: 'mp3', 19: 'fdl', 20: 'snd', 21: 'ogg', 33: 'swf', 49: 'txt'}
+	@classmethod
+	def check (cls, file):
+		'Check whether file is a gwc file.'
+		with open (file, 'rb') as f:
+			return f.read (len (cls.signature)) == cls.signature
+	def __init__ (self, file):
+		with open (file, 'rb') as f:
+			self.data = _mmap.mmap (f.fileno (), 0, access = _mmap.ACCESS_READ)
+		if self.data[:len (self.signature)] != self.signature:
+			raise ValueError ('not a gwc file: %s' % file)
+		pos = len (self.signature)
+		num = self.unpack ('<H', pos)[0]
+		pos += 2
+		# Object 0 is the lua bytecode, the others are media.
+		self.objects = {}
+		for i in range (num):
+			id, address = self.unpack ('<Hi', pos + 6 * i)
+			self.objects[id] = address
+		pos += 6 * num
+		self.header_size = self.unpack ('<i', pos)[0]
+		pos += 4
+		self.latitude, self.longitude, self.altitude, created, self.splash, self.icon = self.unpack ('<dddqhh', pos)
+		pos += 8 * 4 + 2 * 2
+		# The creation date is in seconds since 2004-02-10 01:00:00.
+		self.created = created + 1076374800
+		self.type, pos = self.string (pos)
+		self.player, pos = self.string (pos)
+		self.player_id = self.unpack ('<q', pos)[0]
+		pos += 8
+		strings = []
+		for i in range (8):
+			value, pos = self.string (pos)
+			strings.append (value)
+		self.name, self.guid, self.description, self.starting_description, self.version, self.author, self.company, self.device = strings
+		# The completion code is preceded by its length, but is also 0-terminated.
+		self.completion_code = self.string (pos + 4)[0]
+	def unpack (self, format, pos):
+		return _struct.unpack_from (format, self.data, pos)
+	def string (self, pos):
+		'Read a 0-terminated string at pos; return it and the position after it.'
+		end = self.data.find (b'\0', pos)
+		return self.data[pos:end].decode ('utf-8', 'replace'), end + 1
+	def lua (self):
+		'Return the lua bytecode.'
+		address = self.objects[0]
+		return _view (self.data, address + 4, self.unpack ('<i', address)[0])
+	def media (self, id):
+		'Return type (an extension, or the number for unknown types) and data of a media object, or None if it does not exist.'
+		address = self.objects.get (id)
+		if id == 0 or address is None or self.unpack ('<B', address)[0] == 0:
+			return None
+		type, size = self.unpack ('<ii', address + 1)
+		return self.media_types.get (type, type), _view (self.data, address + 9, size)
+	def info (self, config):
+		'Return the cartridge information, in the same format as _parse_wfi.'
+		ret = {'Name': self.name, 'Version': self.version, 'Author': self.author, 'Company': self.company, 'Activity': self.type, 'StartingLocation': '%f %f %f' % (self.latitude, self.longitude, self.altitude), 'TargetDevice': self.device, 'PlayerName': self.player, 'CompletionCode': self.completion_code}
+		for key in ret:
+			ret[key] = (ret[key], [])
+		for key in ('Format', 'E-mail', 'Copyright', 'License', 'TargetDeviceVersion', 'BuilderVersion', 'Poster', 'Icon', 'CreateDate', 'UpdateDate'):
+			ret[key] = None
+		if not self.player:
+			ret['PlayerName'] = config['PlayerName']
+		if not self.completion_code:
+			ret['CompletionCode'] = config['CompletionCode']
+		return ret
+# }}}
+
+def _info_value (info, key): # {{{
+	'Return the value of key in info from _parse_wfi or _GWC.info, without the long value.'
+	value = info[key]
+	if isinstance (value, tuple):
+		return value[0]
+	return value
+# }}}
+
+class _CartridgeImage (object): # {{{
+	'''The parts of a cartridge file which are the same for every game: its info, lua code and media.
+	Sessions which are created from the same image share it, so the file is read and parsed only once.
+	Forked processes can inherit an image. When it is pickled (for example to start a process without fork), it is loaded from the file again.'''
+	def __init__ (self, file):
+		self.file = file
+		self.key = (_os.path.abspath (file), _os.path.getmtime (file))
+		self.media = {}		# Media tree, see _parse_wfi.
+		self.gwc = None
+		self.wfz = None
+		self.pid = None		# Process which opened wfz.
+		self.info = None
+		self.code = None
+		self.cache_key = None	# Key in _chunk_cache, if it is used.
+		self.chunk = None	# (interpreter version, compiled code), if known.
+		if _os.path.isdir (file):
+			self.open = lambda name, mode = 'r': open (_os.path.join (file, name), mode)
+		elif _GWC.check (file):
+			self.gwc = _GWC (file)
+			self.open = None
+		else:
+			self.open = self.zip_open
+		if self.gwc is None:
+			if _chunk_cache.directory is not None:
+				self.cache_key = _chunk_cache.key (file)
+				entry = _chunk_cache.load (self.cache_key, self)
+				if entry is not None:
+					# The lua source is only read if the compiled code cannot be used.
+					self.info = entry[0]
+					self.chunk = entry[1:]
+					return
+			self.info = _parse_wfi (self.open ('_cartridge.wfi'), {'PlayerName': None, 'CompletionCode': None}, self)
+			self.read_code ()
+	def read_code (self):
+		f = self.open ('_cartridge.lua')
+		try:
+			self.code = f.read ()
+		finally:
+			f.close ()
+	def __reduce__ (self):
+		return (_CartridgeImage, (self.file,))
+	def zip_open (self, name, mode = 'r'):
+		if self.pid != _os.getpid ():
+			# Processes must not share the file position, so each of them opens the file itself.
+			self.wfz = _zipfile.ZipFile (self.file)
+			self.pid = _os.getpid ()
+		return self.wfz.open (_os.path.join (_os.path.splitext (_os.path.basename (self.file))[0], name))
+	def lua (self, script = None):
+		'''Return the lua code, as bytes or a buffer.
+		If script (a lua interpreter) is given and _chunk_cache is used, return compiled code for it, from the cache if possible.'''
+		if self.gwc is not None:
+			return self.gwc.lua ()
+		if script is None or self.cache_key is None:
+			if self.code is None:
+				self.read_code ()
+			return self.code
+		version = _chunk_cache.version (script)
+		if self.chunk is not None and self.chunk[0] == version:
+			_chunk_cache.hits += 1
+			return self.chunk[1]
+		_chunk_cache.misses += 1
+		if self.code is None:
+			self.read_code ()
+		try:
+			chunk = _chunk_cache.compile (script, self.code)
+		except Exception as e:
+			_sys.stderr.write ('Warning: unable to compile cartridge for the chunk cache: %s\n' % e)
+			return self.code
+		self.chunk = (version, chunk)
+		_chunk_cache.store (self.cache_key, self, version, chunk)
+		return chunk
+	def get_info (self, config):
+		'Return the cartridge information, in the same format as _parse_wfi, using config for the PlayerName and CompletionCode if the cartridge does not have them.'
+		if self.gwc is not None:
+			return self.gwc.info (config)
+		ret = dict (self.info)
+		for key in ('PlayerName', 'CompletionCode'):
+			if ret[key] is None:
+				ret[key] = config[key]
+		return ret
+# }}}
+
+class _Session: # {{{
+	'''One game: the lua interpreter, the host callbacks, Player, the media and the cartridge file.
+	The module globals _cb, _script, Player, Media, _wfz, _wfzopen and _gwc are those of the current session.
+	Creating a session loads the cartridge and makes the session current. After that, _update and timer ticks make it current when they are called.
+	When the host calls lua functions itself (such as Callback, OnGetInput or the On* handlers of commands), it must use _call, so they run in the right session.
+	file is a file name or a _CartridgeImage; sessions of the same cartridge file share their cached media contents.'''
+	def __init__ (self, file, cbs, config):
+		self.image = file if isinstance (file, _CartridgeImage) else _CartridgeImage (file)
+		self.file = self.image.file
+		self.key = self.image.key
+		self.cbs = cbs
+		self.timed_cbs = None
+		self.script = None
+		self.player = None
+		self.media = self.image.media
+		self.wfz = None
+		self.wfzopen = None
+		self.gwc = None
+		self.starting_marker = None
+		# The cartridge is only known when the setup code has run.
+		self.cartridge = None
+		self.notifier = _Notifier (self)
+		self._activate (True)
+		# Setting up the objects is not reported as changes.
+		_notify.enter ()
+		try:
+			self.cartridge = self._load (config)
+		finally:
+			_notify.leave (False)
+		self.cartridge._session = self
+		# Timers may be started (for example from OnStart) before the first _update.
+		if hasattr (cbs, 'time'):
+			self.cartridge._time = cbs.time ()
+		# Remember the state that loading has set up.
+		self.script = _script
+		self.player = Player
+		self.wfz = _wfz
+		self.wfzopen = _wfzopen
+		self.gwc = _gwc
+		self.starting_marker = _starting_marker
+	def _callbacks (self):
+		if not _stats.enabled:
+			return self.cbs
+		if self.timed_cbs is None:
+			self.timed_cbs = _TimedCallbacks (self.cbs)
+		return self.timed_cbs
+	def _activate (self, force = False):
+		'Make this the current session.'
+		global _session, _cb, _notify, _script, Player, Media, _wfz, _wfzopen, _gwc, _starting_marker
+		if _session is self and not force:
+			return
+		_session = self
+		_cb = self._callbacks ()
+		_notify = self.notifier
+		_script = self.script
+		Player = self.player
+		Media = self.media
+		_wfz = self.wfz
+		_wfzopen = self.wfzopen
+		_gwc = self.gwc
+		_starting_marker = self.starting_marker
+	def _call (self, function, *args):
+		'Make this the current session, and call function (usually a lua function) with args.'
+		self._activate ()
+		return _notify.call (function, *args)
+	def _load (self, config):
+		'''Start the cartridge from the image for playing; return the ZCartridge object.'''
+		global _script
+		global Player
+		global _wfzopen
+		global _wfz
+		global _gwc
+		file = self.file
+		_gwc = self.image.gwc
+		_wfz = self.image.wfz
+		_wfzopen = self.image.open
+		info = self.image.get_info (config)
+		# Prepare the lua parser. {{{
+		_script = _lang.lua ()
+		env = {}
+		for i in config:
+			if i.startswith ('env_'):
+				env[i[4:]] = config[i]
+		env['Downloaded'] = int (env['Downloaded'])
+		if not env['CartFilename']:
+			env['CartFilename'] = _os.path.splitext (file)[0]
+		if not env['Device']:
+			env['Device'] = _info_value (info, 'TargetDevice')
+		_script.run ('', 'Env', env, name = 'setting Env')
+		# }}}
+		# Set up Player. {{{
+		Player = ZCharacter (None)
+		Player.ObjIndex = -1
+		Player.Name = _info_value (info, 'PlayerName')
+		Player.CompletionCode = _info_value (info, 'CompletionCode')
+		Player.InsideOfZones = _script.make_table ()
+		Player.PositionAccuracy = Distance (10)
+		# }}}
+		# This must be run after Player is created for technical reasons.  See the python-lua manual page for details.
+		_script.module ('Wherigo', _sys.modules[__name__])
+		code = self.image.lua (_script)
+		try:
+			ret = _script.run (code, name = 'cartridge setup')[0]
+		except TypeError:
+			# This version of python-lua cannot run code from a buffer.
+			ret = _script.run (bytes (code), name = 'cartridge setup')[0]
+		# Create a starting marker object, which can be used for drawing a marker on the map, but which is invisible for the cartridge.
+		global _starting_marker
+		_starting_marker = ZItem (ret)
+		_starting_marker.ObjectLocation = ret.StartingLocation
+		_starting_marker.Name = 'The start of this cartridge'
+		_starting_marker.Media = ret.Icon
+		_starting_marker.Description = ret.StartingLocationDescription
+		return ret
+# }}}
+
+class _PendingTimer: # {{{
+	'Handle which _PoolCallbacks.add_timer returns before its session is taken. When the timer is passed on to the real callbacks, handle is set to their handle.'
+	def __init__ (self, time, callback):
+		self.time = time
+		self.callback = callback
+		self.handle = None
+# }}}
+
+class _PoolCallbacks: # {{{
+	'''Host callbacks of a session in a _SessionPool. Until the session is taken, calls are recorded.
+	When it is taken, the recorded calls are passed on to the real callbacks, and all later calls go there directly.
+	Timers which are added before that get a _PendingTimer as their handle, which remove_timer accepts also after the session is taken.'''
+	def __init__ (self):
+		self._cbs = None
+		self._calls = []	# (name, args) of recorded calls.
+	def __getattr__ (self, name):
+		if name.startswith ('__'):
+			raise AttributeError (name)
+		if self._cbs is not None:
+			return getattr (self._cbs, name)
+		if name == 'time':
+			return _time.time
+		return lambda *args: self._calls.append ((name, args))
+	def add_timer (self, time, callback):
+		if self._cbs is not None:
+			return self._cbs.add_timer (time, callback)
+		timer = _PendingTimer (time, callback)
+		self._calls.append (('add_timer', (timer,)))
+		return timer
+	def remove_timer (self, handle):
+		if self._cbs is None:
+			# The timer has not been passed on yet, so it is enough to forget it.
+			if ('add_timer', (handle,)) in self._calls:
+				self._calls.remove (('add_timer', (handle,)))
+			return
+		if isinstance (handle, _PendingTimer):
+			handle = handle.handle
+		self._cbs.remove_timer (handle)
+	def _take (self, cbs):
+		self._cbs = cbs
+		calls = self._calls
+		self._calls = None
+		for name, args in calls:
+			if name == 'add_timer':
+				args[0].handle = cbs.add_timer (args[0].time, args[0].callback)
+			else:
+				getattr (cbs, name) (*args)
+# }}}
+
+class _SessionPool: # {{{
+	'''Sessions of one cartridge which are loaded in advance, so a new game can start without waiting for lua to be set up and the cartridge code to run.
+	The sessions are loaded with config, and handed out by take. The pool is refilled when refill is called, or, if schedule is given, by calling
+	schedule with a function which the program must call when it is idle (for example loop.call_soon, or a list of idle tasks); every call loads one session.
+	Sessions are loaded in the calling thread, because sessions are not thread safe.'''
+	def __init__ (self, file, config, size = 2, schedule = None):
+		self.image = file if isinstance (file, _CartridgeImage) else _CartridgeImage (file)
+		self.config = dict (config)
+		self.size = size
+		self.schedule = schedule
+		self.sessions = []
+		self.scheduled = False
+		self.hits = 0
+		self.misses = 0
+		if schedule is None:
+			self.refill ()
+		else:
+			self._request ()
+	def _prepare (self):
+		'Load a session for the pool, and make the session which was current before current again.'
+		previous = _session
+		session = _Session (self.image, _PoolCallbacks (), self.config)
+		if previous is not None:
+			previous._activate ()
+		return session
+	def refill (self, count = None):
+		'Load sessions until the pool is full, but at most count of them. Return the number of sessions which were loaded.'
+		done = 0
+		while len (self.sessions) < self.size and (count is None or done < count):
+			self.sessions.append (self._prepare ())
+			done += 1
+		return done
+	def _step (self):
+		self.scheduled = False
+		self.refill (1)
+		self._request ()
+	def _request (self):
+		if self.schedule is not None and not self.scheduled and len (self.sessions) < self.size:
+			self.scheduled = True
+			self.schedule (self._step)
+	def take (self, cbs, config = None):
+		'''Return a session with callbacks cbs for a new game, and make it current. config may set PlayerName and CompletionCode.
+		If it changes anything else, or the pool is empty, a new session is loaded with the pool's config, updated with config.'''
+		config = dict (config or {})
+		player = dict ((key, config.pop (key)) for key in ('PlayerName', 'CompletionCode') if key in config)
+		if len (self.sessions) == 0 or any (self.config.get (key) != value for key, value in config.items ()):
+			self.misses += 1
+			cfg = dict (self.config)
+			cfg.update (config)
+			cfg.update (player)
+			session = _Session (self.image, cbs, cfg)
+			self._request ()
+			return session
+		self.hits += 1
+		session = self.sessions.pop (0)
+		# _TimedCallbacks may have cached the recording functions.
+		session.timed_cbs = None
+		session._activate (True)
+		_notify.enter ()
+		try:
+			if hasattr (cbs, 'time'):
+				session.cartridge._time = cbs.time ()
+			session.cbs._take (cbs)
+			if 'PlayerName' in player:
+				Player.Name = player['PlayerName']
+			if 'CompletionCode' in player:
+				Player.CompletionCode = player['CompletionCode']
+		finally:
+			_notify.leave (False)
+		self._request ()
+		return session
+	def stats (self):
+		return {'size': self.size, 'ready': len (self.sessions), 'hits': self.hits, 'misses': self.misses}
+# }}}
+
+# Config for _load which hosts can start from.
+_default_config = {'PlayerName': 'Player', 'CompletionCode': '', 'env_Platform': 'python-wherigo', 'env_CartFolder': '/', 'env_SyncFolder': '/', 'env_LogFolder': '/', 'env_PathSep': '/', 'env_DeviceID': 'Host', 'env_Version': '2.11-compatible', 'env_Downloaded': 0, 'env_CartFilename': '', 'env_Device': ''}
+
 def _load (file, cbs, config): # {{{
-	'''Load a cartridge wfz or wfc file or directory for playing; return the ZCartridge object.'''
-	global _cb
-	global _script
-	global Player
-	_cb = cbs
-	# Prepare the lua parser. {{{
-	_script = _lang.lua ()
-	env = {}
-	for i in config:
-		if i.startswith ('env_'):
-			env[i[4:]] = config[i]
-	env['Downloaded'] = int (env['Downloaded'])
-	if not env['CartFilename']:
-		env['CartFilename'] = _os.path.splitext (filename)[0]
-	if not env['Device']:
-		env['Device'] = data['TargetDevice']
-	_script.run ('', 'Env', env, name = 'setting Env')
-	# }}}
-	global _wfzopen
-	if _os.path.isdir (file):
-		_wfzopen = lambda name: open (_os.path.join (file, name))
+	'''Load a cartridge wfz or wfc file or directory (or a _CartridgeImage) for playing; return the ZCartridge object.
+	The game gets its own _Session, which is made current and is available as the _session attribute of the cartridge. Use _Session (file, cbs, config) directly to get the session.'''
+	return _Session (file, cbs, config).cartridge
+# }}}
+
+# Saved games. {{{
+# A save file starts with _save_magic, followed by frames. The first frame holds all objects; every later frame holds the objects which changed since the frame before it.
+# A frame is 'F', the number of bytes after the header, the game time (of _update) and the records. A record is the ObjIndex (-1 for Player), the class name and the encoded attributes of one object.
+# Every value is a one byte tag followed by its data. Functions and other values which cannot be saved are written as 'X'; restoring does not change them.
+_save_magic = b'WIGSAVE1'
+_not_saved = object ()	# Decoded 'X' value.
+try:
+	_integer_types = (int, long)
+except NameError:
+	_integer_types = (int,)
+
+class _SavedTable (list): # {{{
+	'Decoded lua table: a list of (key, value) pairs.'
+# }}}
+
+class _SavedCommand (dict): # {{{
+	'Decoded ZCommand: its attributes.'
+# }}}
+
+def _encode_string (value): # {{{
+	if not isinstance (value, bytes):
+		value = value.encode ('utf-8', 'surrogateescape' if str is not bytes else 'strict')
+	return _struct.pack ('<I', len (value)) + value
+# }}}
+
+def _encode_value (value, out, tables): # {{{
+	'Append the encoding of value to the list out. tables holds the ids of the tables that are being encoded, so cycles are not followed.'
+	if value is None:
+		out.append (b'N')
+	elif value is True:
+		out.append (b'T')
+	elif value is False:
+		out.append (b'F')
+	elif isinstance (value, _integer_types) and -1 << 63 <= value < 1 << 63:
+		out.append (b'I' + _struct.pack ('<q', value))
+	elif isinstance (value, _integer_types + (float,)):
+		out.append (b'D' + _struct.pack ('<d', value))
+	elif isinstance (value, str):
+		out.append (b'S' + _encode_string (value))
+	elif isinstance (value, bytes):
+		out.append (b'B' + _encode_string (value))
+	elif isinstance (value, type (u'')):
+		out.append (b'U' + _encode_string (value))
+	elif isinstance (value, ZObject):
+		index = value.__dict__.get ('ObjIndex')
+		out.append (b'X' if index is None else b'O' + _struct.pack ('<i', index))
+	elif isinstance (value, ZonePoint):
+		altitude = value.altitude
+		out.append (b'P' + _struct.pack ('<ddd', value.latitude, value.longitude, altitude.value if isinstance (altitude, Distance) else altitude))
+	elif isinstance (value, Distance):
+		out.append (b'L' + _struct.pack ('<d', value.value))
+	elif isinstance (value, ZCommand):
+		out.append (b'C')
+		_encode_fields (dict ((k, v) for k, v in value.__dict__.items () if not k.startswith ('_')), out, tables)
+	elif isinstance (value, (_lang.Table, list, tuple)) and id (value) not in tables:
+		tables.add (id (value))
+		items = value.dict ().items () if isinstance (value, _lang.Table) else zip (range (1, len (value) + 1), value)
+		pairs = []
+		for k, v in items:
+			key = []
+			_encode_value (k, key, tables)
+			if key[0] == b'X':
+				continue
+			key = b''.join (key)
+			item = [key]
+			_encode_value (v, item, tables)
+			pairs.append ((key, b''.join (item)))
+		tables.discard (id (value))
+		# Sort the pairs, so that an unchanged table is always encoded the same way.
+		pairs.sort ()
+		out.append (b'A' + _struct.pack ('<I', len (pairs)))
+		out.extend (x[1] for x in pairs)
 	else:
-		global _wfz
-		_wfz = _zipfile.ZipFile (file)
-		_wfzopen = lambda name: _wfz.open (_os.path.join (_os.path.splitext (_os.path.basename (file))[0], name))
-	info = _parse_wfi (_wfzopen ('_cartridge.wfi'), config)
-	# Set up Player. {{{
-	Player = ZCharacter (None)
-	Player.ObjIndex = -1
-	Player.Name = info['PlayerName']
-	Player.CompletionCode = info['CompletionCode']
-	Player.InsideOfZones = _script.make_table ()
-	Player.PositionAccuracy = Distance (10)
-	# }}}
-	# This must be run after Player is created for technical reasons.  See the python-lua manual page for details.
-	_script.module ('Wherigo', _sys.modules[__name__])
-	ret = _script.run (_wfzopen ('_cartridge.lua').read (), name = 'cartridge setup')[0]
-	# Create a starting marker object, which can be used for drawing a marker on the map, but which is invisible for the cartridge.
-	global _starting_marker
-	_starting_marker = ZItem (ret)
-	_starting_marker.ObjectLocation = ret.StartingLocation
-	_starting_marker.Name = 'The start of this cartridge'
-	_starting_marker.Media = ret.Icon
-	_starting_marker.Description = ret.StartingLocationDescription
-	return ret
+		out.append (b'X')
+# }}}
+
+def _encode_fields (fields, out, tables): # {{{
+	out.append (_struct.pack ('<I', len (fields)))
+	for key in sorted (fields):
+		out.append (_encode_string (key))
+		_encode_value (fields[key], out, tables)
+# }}}
+
+def _encode_record (obj, index): # {{{
+	'Return the saved form of obj.'
+	out = []
+	_encode_fields (obj._get_state (), out, set ())
+	return _struct.pack ('<i', index) + _encode_string (obj.__class__.__name__) + _encode_string (b''.join (out))
+# }}}
+
+class _Decoder: # {{{
+	'Reader for saved values. objects is a function which returns the object for an ObjIndex, or None.'
+	def __init__ (self, data, objects):
+		self.data = data
+		self.pos = 0
+		self.objects = objects
+	def unpack (self, format):
+		ret = _struct.unpack_from (format, self.data, self.pos)
+		self.pos += _struct.calcsize (format)
+		return ret
+	def string (self):
+		size = self.unpack ('<I')[0]
+		self.pos += size
+		return self.data[self.pos - size:self.pos]
+	def native (self):
+		ret = self.string ()
+		return ret if str is bytes else ret.decode ('utf-8', 'surrogateescape')
+	def value (self):
+		tag = self.data[self.pos:self.pos + 1]
+		self.pos += 1
+		if tag == b'N':
+			return None
+		if tag == b'T':
+			return True
+		if tag == b'F':
+			return False
+		if tag == b'I':
+			return self.unpack ('<q')[0]
+		if tag == b'D':
+			return self.unpack ('<d')[0]
+		if tag == b'S':
+			return self.native ()
+		if tag == b'B':
+			return self.string ()
+		if tag == b'U':
+			return self.string ().decode ('utf-8')
+		if tag == b'O':
+			ret = self.objects (self.unpack ('<i')[0])
+			return _not_saved if ret is None else ret
+		if tag == b'P':
+			return ZonePoint (*self.unpack ('<ddd'))
+		if tag == b'L':
+			return Distance (self.unpack ('<d')[0])
+		if tag == b'C':
+			return _SavedCommand (self.fields ())
+		if tag == b'A':
+			ret = _SavedTable ()
+			for i in range (self.unpack ('<I')[0]):
+				key = self.value ()
+				ret.append ((key, self.value ()))
+			return ret
+		if tag == b'X':
+			return _not_saved
+		raise ValueError ('invalid tag %r in saved game' % tag)
+	def fields (self):
+		ret = {}
+		for i in range (self.unpack ('<I')[0]):
+			key = self.native ()
+			ret[key] = self.value ()
+		return ret
+# }}}
+
+def _restored (old, value): # {{{
+	'''Return the value to store for a decoded saved value, where old is the current value.
+	Existing tables and commands are changed in place, so references to them from lua stay valid. Unchanged points and distances are kept.'''
+	if isinstance (value, _SavedTable):
+		if not isinstance (old, _lang.Table):
+			return _script.make_table (dict ((k, _restored (None, v)) for k, v in value if v is not _not_saved))
+		current = old.dict ()
+		keys = set (k for k, v in value)
+		for key in current:
+			if key not in keys:
+				old[key] = None
+		for key, v in value:
+			v = _restored (current.get (key), v)
+			if v is not _not_saved:
+				old[key] = v
+		return old
+	if isinstance (value, _SavedCommand):
+		if not isinstance (old, ZCommand):
+			old = ZCommand (None)
+		for key, v in value.items ():
+			v = _restored (old.__dict__.get (key), v)
+			if v is not _not_saved:
+				setattr (old, key, v)
+		return old
+	if isinstance (value, ZonePoint) and isinstance (old, ZonePoint):
+		altitude = old.altitude.value if isinstance (old.altitude, Distance) else old.altitude
+		if (old.latitude, old.longitude, altitude) == (value.latitude, value.longitude, value.altitude.value):
+			return old
+	if isinstance (value, Distance) and isinstance (old, Distance) and old.value == value.value:
+		return old
+	return value
+# }}}
 # }}}
 
 # Class definitions. All these classes are used by lua code and can be inspected and changed by both lua and python code. {{{
-class Distance: # {{{
+class Distance (object): # {{{
 	'A distance between two points.'
+	__slots__ = ('value',)
+	# Length of the units, in meters.
+	_units = {'feet': 1609.344 / 5280., 'ft': 1609.344 / 5280., 'miles': 1609.344, 'mi': 1609.344, 'meters': 1, 'm': 1, 'kilometers': 1000., 'km': 1000., 'nauticalmiles': 1852.}
 	def __init__ (self, value, units = 'meters'):
-		if units in ('feet', 'ft'):
-			self.value = value * 1609.344 / 5280.
-		elif units in ('miles', 'mi'):
-			self.value = value * 1609.344
-		elif units in ('meters', 'm'):
-			self.value = value
-		elif units in ('kilometers', 'km'):
-			self.value = value * 1000.
-		elif units == 'nauticalmiles':
-			self.value = value * 1852.
-		else:
-			raise AssertionError ('invalid length unit %s' % units)
+		if units != 'meters':
+			factor = self._units.get (units)
+			if factor is None:
+				raise AssertionError ('invalid length unit %s' % units)
+			if factor != 1:
+				value = value * factor
+		self.value = value
 	def GetValue (self, units = 'meters'):
 		if isinstance (units, _lang.Table):
 			assert len (units.dict ()) == 1 and 'units' in units.dict ()
 			units = units.dict ()['units']
-		if units in ('feet', 'ft'):
-			return self.value / 1609.344 * 5280.
-		elif units == 'miles':
-			return self.value / 1609.344
-		elif units in ('meters', 'm'):
-			return self.value
-		elif units in ('kilometers', 'km'):
-			return self.value / 1000.
-		elif units == 'nauticalmiles':
-			return self.value / 1852.
-		else:
+		factor = self._units.get (units)
+		if factor is None:
 			raise AssertionError ('invalid length unit %s' % units)
+		return self.value if factor == 1 else self.value / factor
 	def __call__ (self, units = 'meters'):
 		return self.GetValue (units)
 	def __repr__ (self):
 		return 'Distance (%f, "meters")' % self.value
-	def __cmp__ (self, other):
+	def __eq__ (self, other):
+		if not isinstance (other, Distance):
+			return NotImplemented
+		return self.value == other.value
+	def __ne__ (self, other):
+		if not isinstance (other, Distance):
+			return NotImplemented
+		return self.value != other.value
+	def __hash__ (self):
+		return hash (self.value)
+	def __lt__ (self, other):
+		assert isinstance (other, Distance)
+		return self.value < other.value
+	def __le__ (self, other):
+		assert isinstance (other, Distance)
+		return self.value <= other.value
+	def __gt__ (self, other):
+		assert isinstance (other, Distance)
+		return self.value > other.value
+	def __ge__ (self, other):
 		assert isinstance (other, Distance)
-		return self.value - other.value
+		return self.value >= other.value
+# }}}
+
+class _ObjectSet (object): # {{{
+	'''Ordered set of objects, which lua sees as a table.
+	Adding and removing objects takes constant time. The lua table is only built when it is used after a change.'''
+	def __init__ (self, items = ()):
+		self.items = _collections.OrderedDict ((x, None) for x in items)
+		self.table = None
+	def add (self, obj):
+		'Add obj at the end, if it is not in the set yet.'
+		if obj not in self.items:
+			self.items[obj] = None
+			self.table = None
+	def discard (self, obj):
+		if obj in self.items:
+			del self.items[obj]
+			self.table = None
+	def __contains__ (self, obj):
+		return obj in self.items
+	def __iter__ (self):
+		return iter (self.items)
+	def __len__ (self):
+		return len (self.items)
+	def get_table (self):
+		if self.table is None:
+			self.table = _script.make_table (list (self.items))
+		return self.table
+# }}}
+
+class _ObjectSetProperty (object): # {{{
+	'''Attribute which holds an _ObjectSet (in the instance attribute name), but which looks like a table.
+	The table is rebuilt when it is used after the set has changed, so lua code should not keep it around while moving objects.'''
+	def __init__ (self, name):
+		self.name = name
+	def __get__ (self, obj, cls):
+		if obj is None:
+			return self
+		if self.name not in obj.__dict__:
+			raise AttributeError (self.name)
+		return obj.__dict__[self.name].get_table ()
+	def __set__ (self, obj, value):
+		obj.__dict__[self.name] = _ObjectSet (value.list () if isinstance (value, _lang.Table) else value or ())
 # }}}
 
 class ZCommand (object): # {{{
@@ -281,28 +1227,96 @@ class ZObject (object): # {{{
 		self.Visible = True if Visible is None else Visible
 		self.Cartridge = Cartridge
 		if Cartridge is not None and self.Cartridge._store:
-			self.ObjIndex = len (self.Cartridge.AllZObjects) + 1
-			self.Cartridge.AllZObjects += (self,)
+			self.Cartridge._register (self)
 		if Container:
 			self.MoveTo (Container)
+	_vector_key = None
+	_moves = 0	# Incremented whenever any Container changes, to invalidate cached ancestors.
+	# Kind of change (see _Notifier) for some attributes, and for all attributes of objects of this class.
+	_notify_kinds = {'ObjectLocation': 'map', 'Points': 'map', 'OriginalPoint': 'map', 'Active': 'map', 'Visible': 'map', 'CurrentDistance': 'stats', 'CurrentBearing': 'stats'}
+	_notify_kind = None
+	# Attributes which are properties, and where they store their value.
+	_stored = {'Container': '_container', 'CurrentDistance': '_distance', 'CurrentBearing': '_bearing', 'Remaining': '_remaining'}
+	def __setattr__ (self, key, value):
+		if key[0] == '_':
+			object.__setattr__ (self, key, value)
+			return
+		old = self.__dict__.get (self._stored.get (key, key))
+		object.__setattr__ (self, key, value)
+		if key in ('ObjectLocation', 'OriginalPoint') and old is not value:
+			# Let the point know that moving it changes this object.
+			if isinstance (old, ZonePoint) and self in getattr (old, '_owners', ()):
+				old._owners.remove (self)
+			if isinstance (value, ZonePoint):
+				if not hasattr (value, '_owners'):
+					object.__setattr__ (value, '_owners', [])
+				value._owners.append (self)
+		if _unchanged (old, value):
+			# Points which are moved in place tell their owners themselves.
+			return
+		notify = _notifier_of (self.__dict__.get ('Cartridge'))
+		notify.mark ('objects', self)
+		kind = self._notify_kinds.get (key)
+		if kind is not None:
+			notify.mark (kind, self)
+		if self._notify_kind is not None:
+			notify.mark (self._notify_kind, self)
+		if key == 'Container':
+			player = self._player ()
+			if player is not None and player in (old, value):
+				notify.mark ('inventory', self)
+		if key in ('ObjectLocation', 'OriginalPoint', 'Container'):
+			self._moved ()
+		if key in ('Active', 'Visible', 'Container', 'State', 'ShowObjects', 'Complete') and old != value:
+			self._screen_changed ()
+	def _moved (self):
+		'The position of this object, or of its container, may have changed; tell the spatial index of its cartridge.'
+		cartridge = self.__dict__.get ('Cartridge')
+		if cartridge is not None and cartridge._spatial is not None:
+			cartridge._spatial.touch (self)
+	def _screen_changed (self):
+		'An attribute which decides on which list screen this object is shown has changed; tell the screens of its cartridge.'
+		cartridge = self.__dict__.get ('Cartridge')
+		if cartridge is not None and cartridge._screens is not None:
+			cartridge._screens.touch (self)
+	Inventory = _ObjectSetProperty ('_inventory')
+	def _get_container (self):
+		return self._container
+	def _set_container (self, container):
+		self._container = container
+		ZObject._moves += 1
+	Container = property (_get_container, _set_container)
+	def _ancestors (self):
+		'Return the set of this object, its container, the container of that, etc. It is cached until something moves.'
+		cache = self.__dict__.get ('_ancestry')
+		if cache is not None and cache[0] == ZObject._moves:
+			return cache[1]
+		ret = set ()
+		p = self
+		while p not in ret:
+			ret.add (p)
+			if not hasattr (p, 'Container') or not p.Container:
+				break
+			p = p.Container
+		self._ancestry = (ZObject._moves, ret)
+		return ret
+	def _player (self):
+		'Return the Player of the session this object belongs to. Use this in functions which the host may call while another session is current.'
+		cartridge = self.__dict__.get ('Cartridge')
+		session = None if cartridge is None else cartridge._session
+		return Player if session is None else session.player
 	def Contains (self, obj):
 		if obj == Player:
 			return IsPointInZone (Player.ObjectLocation, self)
-		p = obj
-		while True:
-			if p == self:
-				return True
-			if not hasattr (p, 'Container') or not p.Container:
-				return False
-			p = p.Container
+		if not isinstance (obj, ZObject):
+			return obj == self
+		return self in obj._ancestors ()
 	def MoveTo (self, owner):
 		if self.Container:
-			l = self.Container.Inventory.list ()
-			if self in l:
-				self.Container.Inventory.pop (l.index (self))
+			self.Container._inventory.discard (self)
 		self.Container = owner
 		if self.Container:
-			self.Container.Inventory += (self,)
+			self.Container._inventory.add (self)
 	def _is_visible (self, debug):
 		if not (debug or (self.Active and self.Visible)):
 			return False
@@ -310,7 +1324,7 @@ class ZObject (object): # {{{
 			return True
 		if self.Container == None:
 			return False
-		if self.Container == Player:
+		if self.Container == self._player ():
 			return True
 		if not self.Container.Active or not isinstance (self.Container, Zone):
 			return False
@@ -344,10 +1358,47 @@ class ZObject (object): # {{{
 				#print ('Warning: object %s (type %s) has no location' % (self.Name, type (self)))
 				return None
 		return self.ObjectLocation
+	def _current_vector (self):
+		'Return CurrentDistance and CurrentBearing. For items and characters, they are computed from the player position when they are needed, instead of on every fix.'
+		player = self._player ()
+		if isinstance (self, (ZItem, ZCharacter)) and self.Active and player is not None and self is not player and self.Container is not player:
+			here = player.ObjectLocation
+			pos = self._get_pos ()
+			if here and pos:
+				key = self._vector_key
+				if key is None or key[0] is not here or key[1] is not pos or key[2] != pos.latitude or key[3] != pos.longitude:
+					self._vector_key = (here, pos, pos.latitude, pos.longitude)
+					self._distance, self._bearing = VectorToPoint (here, pos)
+		return self._distance, self._bearing
+	def _set_distance (self, value):
+		self._distance = value
+	def _set_bearing (self, value):
+		self._bearing = value
+	CurrentDistance = property (lambda self: self._current_vector ()[0], _set_distance)
+	CurrentBearing = property (lambda self: self._current_vector ()[1], _set_bearing)
+	_saved_private = ()	# Private attributes which are part of the game state.
+	def _get_state (self):
+		'Return the attributes which ZCartridge._save writes for this object.'
+		ret = {'Container': self.Container}
+		for key, value in self.__dict__.items ():
+			if (not key.startswith ('_') and key not in ('ObjIndex', 'Cartridge', 'AllZObjects')) or key in self._saved_private:
+				ret[key] = value
+		return ret
+	def _set_state (self, state):
+		'Restore the attributes from a decoded _get_state.'
+		container = state.pop ('Container', _not_saved)
+		if container is not _not_saved and container is not self.Container:
+			self.MoveTo (container)
+		for key, value in state.items ():
+			value = _restored (self.__dict__.get (key), value)
+			if value is not _not_saved:
+				setattr (self, key, value)
+		self._vector_key = None
 # }}}
 
 class ZonePoint (object): # {{{
 	'A specific geographical point, or the INVALID_ZONEPOINT constant to represent no value.'
+	__slots__ = ('latitude', 'longitude', 'altitude', '_watchers', '_owners')	# _watchers and _owners are the zones and objects which use this point; they are only set when needed.
 	def __init__ (self, latitude = 0, longitude = 0, altitude = 0):
 		if isinstance (latitude, dict):
 			d = latitude
@@ -368,7 +1419,24 @@ class ZonePoint (object): # {{{
 	def __setattr__ (self, key, value):
 		object.__setattr__ (self, key, value)
 		if key in ('latitude', 'longitude'):
-			_cb.update_map ()
+			# Zones using this point must recompute their geometry.
+			notifiers = []
+			for zone in getattr (self, '_watchers', ()):
+				zone._point_moved (self)
+				notify = _notifier_of (zone.__dict__.get ('Cartridge'))
+				notify.mark ('map', zone)
+				if notify not in notifiers:
+					notifiers.append (notify)
+			for obj in getattr (self, '_owners', ()):
+				obj._moved ()
+				notify = _notifier_of (obj.__dict__.get ('Cartridge'))
+				notify.mark ('map', obj)
+				notify.mark ('objects', obj)
+				if notify not in notifiers:
+					notifiers.append (notify)
+			for notify in notifiers or [_notify]:
+				notify.points_moved = True
+				notify.mark ('map')
 	def __repr__ (self):
 		return 'ZonePoint (%f, %f, %f)' % (self.latitude, self.longitude, self.altitude ())
 # }}}
@@ -377,6 +1445,7 @@ class ZonePoint (object): # {{{
 class ZCartridge (ZObject): # {{{
 	def __init__ (self, Container = None, Active = None, Commands = None, Description = None, Icon = None, Media = None, Name = None, ObjectLocation = None, Visible = None, **ka):
 		self.AllZObjects = _script.make_table () # This must be done before ZObject.__init__, because that registers this object.
+		self._objects = {}	# For every ZObject class, the registered objects which are instances of it, in order.
 		self._store = True
 		ZObject.__init__ (self, {'Cartridge': self, 'Container': Container, 'Active': Active, 'Commands': Commands, 'Description': Description, 'Icon': Icon, 'Media': Media, 'Name': Name, 'ObjectLocation': ObjectLocation, 'Visible': Visible})
 		self.ZVariables = _script.make_table ()
@@ -414,125 +1483,412 @@ class ZCartridge (ZObject): # {{{
 		self.StateId = '1'	# ?
 		self.Complete = False	# ?
 		self._mediacount = 1
+	# Geodesic model for distances, bearings and TranslatePoint: 'spherical' (like the Wherigo builder), 'local' (flat earth, fast, for games within a few kilometers) or 'ellipsoidal' (WGS84).
+	# See _SphericalModel, _LocalModel and _EllipsoidalModel. Set it on the class or on the cartridge of a session, before the game starts.
+	_geodesy = 'spherical'
+	# Zone evaluation engine for _update: 'python' evaluates every zone separately, 'numpy' evaluates them all at once, 'auto' uses numpy if it is available and there are at least _batch_min_zones active zones.
+	_zone_engine = 'auto'
+	_batch_min_zones = 8
+	_batch = None
+	_zone_index = None
+	_points_read = None	# Zones of which the Points table has been read since _update last checked them, see Zone._read_points.
+	_spatial = None	# _SpatialIndex for _nearest and _within, made by the first query.
+	_screens = None	# _Screens for _screen, made by its first call.
+	_complete_tasks = True	# Whether complete tasks are on the Tasks screen.
+	_fix = 0	# Number of positions that _update has seen.
+	_session = None	# Set by _load.
+	# Timer scheduling: 'host' registers a host timer for every running ZTimer, 'heap' keeps them in a _TimerQueue which uses one host timer.
+	_timer_engine = 'host'
+	_timers = None
+	# State of the save file of _save: its name, the saved record of every object, and the sizes of the full state and of the appended changes.
+	_save_file = None
+	_saved = None
+	_save_sizes = (0, 0)
+	_saved_time = 0	# While restoring: the game time of the last save in the file.
 	def GetAllOfType (self, type):
-		return _script.make_table ([x for x in self.AllZObjects if isinstance (x, ZObject) and x.__class__.__name__ == type])
+		for cls in self._objects:
+			if cls.__name__ == type:
+				return _script.make_table ([x for x in self._objects[cls] if x.__class__.__name__ == type])
+		return _script.make_table ()
+	def _register (self, obj):
+		'Add obj to AllZObjects, and to the lists of objects for its classes.'
+		obj.ObjIndex = len (self.AllZObjects) + 1
+		self.AllZObjects += (obj,)
+		for cls in type (obj).__mro__:
+			if issubclass (cls, ZObject):
+				self._objects.setdefault (cls, []).append (obj)
+		if self._spatial is not None:
+			self._spatial.touch (obj)
+		if self._screens is not None:
+			self._screens.touch (obj)
+	def _objects_of (self, cls):
+		'Return all registered objects which are instances of cls, in the order of AllZObjects. The returned list must not be changed.'
+		return self._objects.get (cls, [])
 	def RequestSync (self):
 		_cb.save ()
+	def _save (self, filename, full = False):
+		'''Save the state of the game to filename. Return the number of objects that were written.
+		The first save to a file (or any save if full is set) writes all objects. Later saves append only the objects which have changed since the previous one.
+		When the appended part becomes larger than the full state, the file is rewritten.'''
+		player = self._player ()
+		records = {-1: _encode_record (player, -1)}
+		for obj in self._objects_of (ZObject):
+			records[obj.ObjIndex] = _encode_record (obj, obj.ObjIndex)
+		if self._saved is not None and self._save_file == filename and not full:
+			changed = [records[i] for i in sorted (records) if self._saved.get (i) != records[i]]
+			self._saved = records
+			if len (changed) == 0:
+				return 0
+			data = b''.join (changed)
+			if self._save_sizes[1] + len (data) <= self._save_sizes[0]:
+				with open (filename, 'ab') as f:
+					f.write (b'F' + _struct.pack ('<Id', len (data), self._time) + data)
+				self._save_sizes = (self._save_sizes[0], self._save_sizes[1] + len (data))
+				return len (changed)
+		data = b''.join (records[i] for i in sorted (records))
+		# Write to a new file first, so an interrupted save does not destroy the previous one.
+		with open (filename + '.tmp', 'wb') as f:
+			f.write (_save_magic + b'F' + _struct.pack ('<Id', len (data), self._time) + data)
+		getattr (_os, 'replace', _os.rename) (filename + '.tmp', filename)
+		self._save_file = filename
+		self._saved = records
+		self._save_sizes = (len (data), 0)
+		return len (records)
+	def _restore (self, filename):
+		'''Restore the state which _save has written to filename, and call OnRestore. Call this instead of OnStart, on a cartridge that has just been loaded.
+		Objects which lua created during the game are created again. Functions are not saved, so attributes holding them keep their value from loading.'''
+		if self._session is not None:
+			self._session._activate ()
+		return _notify.call (self._read_save, filename)
+	def _read_save (self, filename):
+		'Implementation of _restore.'
+		with open (filename, 'rb') as f:
+			data = f.read ()
+		if not data.startswith (_save_magic):
+			raise ValueError ('%s is not a saved game' % filename)
+		# Find the latest record of every object.
+		records = {}
+		pos = len (_save_magic)
+		while pos + 13 <= len (data) and data[pos:pos + 1] == b'F':
+			size, time = _struct.unpack_from ('<Id', data, pos + 1)
+			end = pos + 13 + size
+			if end > len (data):
+				# The last save was interrupted.
+				break
+			reader = _Decoder (data, None)
+			reader.pos = pos + 13
+			while reader.pos < end:
+				start = reader.pos
+				index = reader.unpack ('<i')[0]
+				name = reader.native ()
+				reader.string ()
+				records[index] = (name, data[start:reader.pos])
+			self._saved_time = time
+			pos = end
+		objects = self._objects_of (ZObject)
+		for index in sorted (records):
+			if index > len (objects):
+				cls = globals ().get (records[index][0])
+				if not isinstance (cls, type) or not issubclass (cls, ZObject):
+					_sys.stderr.write ('not restoring object %d of unknown class %s\n' % (index, records[index][0]))
+					continue
+				obj = cls (self)
+				if obj.ObjIndex != index:
+					_sys.stderr.write ('restored object %d has index %d\n' % (index, obj.ObjIndex))
+		player = self._player ()
+		def find (index):
+			if index == -1:
+				return player
+			return objects[index - 1] if 0 < index <= len (objects) else None
+		for index in sorted (records):
+			obj = find (index)
+			if obj is None:
+				continue
+			reader = _Decoder (records[index][1], find)
+			reader.unpack ('<i')
+			reader.string ()
+			reader.pos += 4
+			obj._set_state (reader.fields ())
+		# Appending to the file continues from the restored state.
+		self._save_file = filename
+		self._saved = dict ((i, records[i][1]) for i in records)
+		self._save_sizes = (len (data), 0)
+		if self.OnRestore:
+			_fire (self, 'OnRestore')
 	@classmethod
 	def _new (cls):
-		'Clean up all objects and data.'
-		global Player, _script
+		'Clean up all objects and data of the current session.'
+		global Player, _script, _session, _notify
 		Player = None
 		_script = None
+		_session = None
+		_notify = _Notifier ()
 	def _update (self, position, time):
+		if self._session is not None:
+			self._session._activate ()
+		if _stats.enabled:
+			return _notify.call (_stats.call, 'update', '_update', self._evaluate, position, time)
+		return _notify.call (self._evaluate, position, time)
+	def _nearest (self, count, point = None, classes = None, radius = None, debug = False):
+		'''Return the count visible objects which are nearest to point (a ZonePoint; the player if it is None) as a list of (object, Distance, bearing), sorted by distance.
+		Only instances of classes (a tuple, by default items, characters and zones) are returned; if radius is not None, only objects within radius meters. For zones, the distance is that of VectorToZone.
+		Objects which the player carries, and objects without a position, are never returned. With debug, invisible objects are returned too (see ZObject._is_visible).
+		The objects are kept in a _SpatialIndex, so this only computes the distances of objects which are close to point.'''
+		if self._session is not None:
+			self._session._activate ()
+		player = Player if self._session is None else self._session.player
+		if point is None:
+			point = player.ObjectLocation
+		if not point:
+			return []
+		if classes is None:
+			classes = (ZItem, ZCharacter, Zone)
+		if self._spatial is None:
+			self._spatial = _SpatialIndex ([obj for obj in self._objects_of (ZObject) if isinstance (obj, (ZItem, ZCharacter, Zone))])
+		return [(obj, Distance (distance), bearing) for distance, bearing, obj in self._spatial.query (point, count, radius, classes, player, debug)]
+	def _within (self, radius, point = None, classes = None, debug = False):
+		'Return all visible objects within radius meters from point, like _nearest.'
+		return self._nearest (None, point, classes, radius, debug)
+	def _screen (self, screen):
+		'''Return the objects on a list screen, in the order of AllZObjects. screen is INVENTORYSCREEN, ITEMSCREEN, LOCATIONSCREEN or TASKSCREEN, or its name in _screen_names.
+		After the first call, the contents of the screens are kept up to date, and every change is reported as 'screens' by the notifier
+		(or returned by _screen_changes), so the gui only needs to change what was added and removed.'''
+		if not isinstance (screen, str):
+			screen = _screen_names[screen]
+		if self._screens is None:
+			self._screens = _Screens (self)
+		return self._screens.get (screen)
+	def _screen_changes (self):
+		'Return and clear the changes of the list screens which have not been reported yet: {screen name: (added objects, removed objects)}. This is for hosts without a notify callback.'
+		if self._screens is None:
+			return {}
+		return self._screens.changes ()
+	def _update_batch (self, fixes, collapse = False):
+		'''Handle a time ordered sequence of (position, time) pairs, such as fixes which were queued while the host was busy, like calling _update for each of them.
+		Timers which are due between fixes tick at their deadlines, in order (timers with the same deadline in the order of AllZObjects), before the next fix. Changes are reported once, at the end.
+		If collapse is True, zones which the player enters and leaves again within fixes are not entered, so OnEnter and OnExit are not called for them.
+		Return True if _update would have returned True for any of the fixes.'''
+		if self._session is not None:
+			self._session._activate ()
+		if _stats.enabled:
+			return _notify.call (_stats.call, 'update', '_update_batch', self._evaluate_batch, fixes, collapse)
+		return _notify.call (self._evaluate_batch, fixes, collapse)
+	def _evaluate_batch (self, fixes, collapse):
+		'Implementation of _update_batch.'
+		fixes = list (fixes)
+		held = self._brief_visits ([f[0] for f in fixes]) if collapse else None
+		update_all = False
+		for n, (position, time) in enumerate (fixes):
+			if self._tick_due (time):
+				update_all = True
+			if self._evaluate (position, time, held[n] if held else ()):
+				update_all = True
+		return update_all
+	def _tick_due (self, time):
+		'''Tick the running timers with a deadline at or before time, each at its own deadline, in the order of the deadlines. Return True if any timer ticked.
+		A timer ticks at most once for every deadline, so an Interval timer with a Duration of 0 ticks only once.'''
+		last = {}	# timer: deadline of its last tick.
+		while True:
+			due = [t for t in self._objects_of (ZTimer) if t._target is not None and t._target <= time and last.get (t) != t._target]
+			if len (due) == 0:
+				return len (last) > 0
+			timer = min (due, key = lambda t: t._target)
+			last[timer] = timer._target
+			self._time = max (self._time, timer._target)
+			timer._remove_source ()
+			timer.Tick ()
+	def _brief_visits (self, positions):
+		'''For collapsing visits in _update_batch: return a list with, for every position, the set of zones which the player is inside of,
+		but which it left again at a later position. Zones which the player is already inside of are not included.
+		This uses the zones as they are before the first position is handled.'''
+		ret = [set () for p in positions]
+		points = [(n, p.lat, p.lon) for n, p in enumerate (positions) if p]
+		if len (points) == 0:
+			return ret
+		bbox = (min (p[1] for p in points), min (p[2] for p in points), max (p[1] for p in points), max (p[2] for p in points))
+		for zone in self._objects_of (Zone):
+			if not zone.Active or zone._inside:
+				continue
+			geometry = zone._get_geometry ()
+			if not geometry.valid:
+				continue
+			box = geometry.bbox
+			if box[3] - box[1] <= 180 and (box[0] > bbox[2] or box[2] < bbox[0] or box[1] > bbox[3] or box[3] < bbox[1]):
+				continue
+			entered = None
+			for n, lat, lon in points:
+				if geometry.inside (lat, lon):
+					if entered is None:
+						entered = n
+				elif entered is not None:
+					for k in range (entered, n):
+						ret[k].add (zone)
+					entered = None
+		return ret
+	def _evaluate (self, position, time, hold = ()):
+		'Implementation of _update. Zones in hold are considered outside, even if position is inside them.'
 		self._time = time
-		# Update Timers. Do this before everything else, so Remaining is set correctly when callbacks are invoked.
-		for i in self.AllZObjects.list ():
-			if isinstance (i, ZTimer) and i._target != None:
-				i.Remaining = i._target - time
 		update_all = False
+		# Remaining of running timers is computed from self._time when it is read. With the heap engine, ticks which are due now are handled before everything else.
+		if self._timers is not None and self._timers.run (time):
+			update_all = True
 		if not position:
-			return False
+			return update_all
 		Player.ObjectLocation = ZonePoint (position.lat, position.lon, position.alt)
 		if position.epx is not None and position.epy is not None:
 			Player.PositionAccuracy = Distance ((position.epx + position.epy) / 2.)
-		for i in self.AllZObjects.list ():
-			# Update all object distances and bearings.
-			if isinstance (i, (ZItem, ZCharacter)) and i.Container is not Player:
-				if not i.Active:
-					continue
-				pos = i._get_pos ()
-				if not pos:
-					continue
-				i.CurrentDistance, i.CurrentBearing = VectorToPoint (Player.ObjectLocation, pos)
-		for i in self.AllZObjects.list ():
+		# All distances and bearings change with the position.
+		_notify.mark ('stats')
+		self._fix += 1
+		# Distances and bearings of items and characters are computed when they are used, see ZObject._current_vector.
+		# Only evaluate zones which are close, or which may change state for other reasons. The others cannot change state.
+		if self._points_read:
+			# Zones which are far away are not evaluated, so lua may have changed their Points in place without them noticing.
+			read = self._points_read
+			self._points_read = None
+			for zone in read:
+				zone._points_dirty = False
+				zone._compare_points ()
+		if self._zone_index is None:
+			self._zone_index = _ZoneIndex (self._objects_of (Zone))
+		here = Player.ObjectLocation
+		zones = self._zone_index.pending (here)
+		results = self._zone_results (zones, here)
+		todo = self._zone_index.evaluate (zones)
+		if _stats.enabled:
+			todo = _stats.timed_items ('zone', todo)
+		for i in todo:
 			# Update container info, and call OnEnter or OnExit.
-			if isinstance (i, Zone):
-				if i._active != i.Active:
-					# TODO: Doing this here means that OnSetActive fires after the lua callback has returned. Setting a zone active and immediately inactive doesn't make it fire, while it should make it fire twice.
-					i._active = i.Active
-					if hasattr (i, 'OnSetActive'):
-						#print ('OnSetActive %s' % i.Name)
-						i.OnSetActive (i)
-						update_all = True
-				if not i.Active:
-					if i in Player.InsideOfZones.list ():
-						Player.InsideOfZones.pop (Player.InsideOfZones.list ().index (i))
-						update_all = True
-					continue
+			i._evaluated = self._fix
+			if i._active != i.Active:
+				# TODO: Doing this here means that OnSetActive fires after the lua callback has returned. Setting a zone active and immediately inactive doesn't make it fire, while it should make it fire twice.
+				i._active = i.Active
+				if hasattr (i, 'OnSetActive'):
+					#print ('OnSetActive %s' % i.Name)
+					_fire (i, 'OnSetActive')
+					update_all = True
+			if not i.Active:
+				if i in Player._inside_of_zones:
+					Player._inside_of_zones.discard (i)
+					update_all = True
+				continue
+			# Use the batch result, unless a callback has changed the zone or the player since it was computed.
+			result = results.get (i)
+			if result is not None and (result[0] != i._check_points () or here is not Player.ObjectLocation):
+				result = None
+			if result is not None:
+				inside = result[1]
+			else:
 				inside = IsPointInZone (Player.ObjectLocation, i)
-				if inside != i._inside:
+			if inside and i in hold:
+				inside = False
+			if inside != i._inside:
+				update_all = True
+				i._inside = inside
+				if inside:
+					Player._inside_of_zones.add (i)
+					if i._state == 'NotInRange' and hasattr (i, 'OnDistant') and i.OnDistant:
+						#print ('OnDistant 1 %s' % i.Name)
+						_fire (i, 'OnDistant')
+					if i._state != 'Proximity' and hasattr (i, 'OnProximity') and i.OnProximity:
+						#print ('OnProximity %s' % i.Name)
+						_fire (i, 'OnProximity')
+					if hasattr (i, 'OnEnter') and i.OnEnter:
+						#print ('OnEnter %s' % i.Name)
+						_fire (i, 'OnEnter')
+				else:
+					Player._inside_of_zones.discard (i)
 					update_all = True
-					i._inside = inside
-					if inside:
-						Player.InsideOfZones += (i,)
-						if i._state == 'NotInRange' and hasattr (i, 'OnDistant') and i.OnDistant:
-							#print ('OnDistant 1 %s' % i.Name)
-							i.OnDistant (i)
-						if i._state != 'Proximity' and hasattr (i, 'OnProximity') and i.OnProximity:
-							#print ('OnProximity %s' % i.Name)
-							i.OnProximity (i)
-						if hasattr (i, 'OnEnter') and i.OnEnter:
-							#print ('OnEnter %s' % i.Name)
-							i.OnEnter (i)
-					else:
-						Player.InsideOfZones.pop (Player.InsideOfZones.list ().index (i))
+					#print ('no longer inside %s' % i.Name)
+					if hasattr (i, 'OnExit') and i.OnExit:
+						#print ('OnExit %s' % i.Name)
+						_fire (i, 'OnExit')
+			if inside:
+				i.State = 'Inside'
+				i._state = i.State
+			else:
+				# See how close we are. This is computed in meters; the Distance for lua is only made once.
+				if result is not None:
+					distance, bearing = result[2], result[3]
+				else:
+					point = Player.ObjectLocation
+					distance, bearing = i._get_geometry ().vector (point.latitude, point.longitude)
+				i.CurrentDistance, i.CurrentBearing = Distance (distance), bearing
+				if distance < i.ProximityRange.value:
+					if i._state == 'NotInRange' and hasattr (i, 'OnDistant') and i.OnDistant:
+						#print ('OnDistant 2 %s (from %s)' % (i.Name, i.State))
+						_fire (i, 'OnDistant')
 						update_all = True
-						#print ('no longer inside %s' % i.Name)
-						if hasattr (i, 'OnExit') and i.OnExit:
-							#print ('OnExit %s' % i.Name)
-							i.OnExit (i)
-				if inside:
-					i.State = 'Inside'
-					i._state = i.State
+					i.State = 'Proximity'
+				elif i.DistanceRange.value < 0 or distance < i.DistanceRange.value:
+					if i._state == 'Inside' and hasattr (i, 'OnProximity') and i.OnProximity:
+						#print ('OnProximity %s' % i.Name)
+						_fire (i, 'OnProximity')
+						update_all = True
+					i.State = 'Distant'
 				else:
-					# See how close we are.
-					i.CurrentDistance, i.CurrentBearing = VectorToZone (Player.ObjectLocation, i)
-					if i.CurrentDistance < i.ProximityRange:
-						if i._state == 'NotInRange' and hasattr (i, 'OnDistant') and i.OnDistant:
-							#print ('OnDistant 2 %s (from %s)' % (i.Name, i.State))
-							i.OnDistant (i)
-							update_all = True
-						i.State = 'Proximity'
-					elif i.DistanceRange < Distance (0) or i.CurrentDistance < i.DistanceRange:
-						if i._state == 'Inside' and hasattr (i, 'OnProximity') and i.OnProximity:
-							#print ('OnProximity %s' % i.Name)
-							i.OnProximity (i)
-							update_all = True
-						i.State = 'Distant'
-					else:
-						if i._state == 'Inside' and hasattr (i, 'OnProximity') and i.OnProximity:
-							#print ('OnProximity %s' % i.Name)
-							i.OnProximity (i)
-							update_all = True
-						if i._state in ('Inside', 'Proximity') and hasattr (i, 'OnDistant') and i.OnDistant:
-							#print ('OnDistant 3 %s (from %s)' % (i.Name, i.State))
-							i.OnDistant (i)
-							update_all = True
-						i.State = 'NotInRange'
-					if i.State != i._state:
-						#print ('new state for %s: %s' % (i.Name, i.State))
-						s = i._state
-						i._state = i.State
-						attr = 'On' + i.State
-						if hasattr (i, attr) and getattr (i, attr):
-							#print ('%s %s (from %s)' % (attr, i.Name, s))
-							getattr (i, attr) (i)
-							update_all = True
+					if i._state == 'Inside' and hasattr (i, 'OnProximity') and i.OnProximity:
+						#print ('OnProximity %s' % i.Name)
+						_fire (i, 'OnProximity')
+						update_all = True
+					if i._state in ('Inside', 'Proximity') and hasattr (i, 'OnDistant') and i.OnDistant:
+						#print ('OnDistant 3 %s (from %s)' % (i.Name, i.State))
+						_fire (i, 'OnDistant')
+						update_all = True
+					i.State = 'NotInRange'
+				if i.State != i._state:
+					#print ('new state for %s: %s' % (i.Name, i.State))
+					s = i._state
+					i._state = i.State
+					attr = 'On' + i.State
+					if hasattr (i, attr) and getattr (i, attr):
+						#print ('%s %s (from %s)' % (attr, i.Name, s))
+						_fire (i, attr)
+						update_all = True
 		return update_all
+	def _zone_results (self, zones, here):
+		'''Evaluate the active zones of zones for position here at once, with a _ZoneBatch. Return a dict like _ZoneBatch.evaluate;
+		it is empty if zones should be evaluated one at a time.
+		The batch holds all zones with valid geometry, so it is only packed again when the geometry of a zone changes, or zones are added.'''
+		if _numpy is None or self._zone_engine == 'python' or self._geodesy != 'spherical':
+			return {}
+		active = [z for z in zones if z.Active and z._get_geometry ().valid]
+		if len (active) == 0 or (self._zone_engine == 'auto' and len (active) < self._batch_min_zones):
+			return {}
+		if self._batch is None or not self._batch.valid (active):
+			self._batch = _ZoneBatch ([z for z in self._objects_of (Zone) if z._get_geometry ().valid])
+		return self._batch.evaluate (here, active)
+	def _get_timers (self):
+		if self._timers is None:
+			self._timers = _TimerQueue (self)
+		return self._timers
 	def _reschedule_timers (self):
-		for t in self.AllZObjects.list ():
-			if isinstance (t, ZTimer):
-				t._reschedule ()
+		if self._session is not None:
+			self._session._activate ()
+		if self._timers is not None:
+			self._timers.arm (True)
+		for t in self._objects_of (ZTimer):
+			t._reschedule ()
 # }}}
 
 class ZCharacter (ZObject): # {{{
+	InsideOfZones = _ObjectSetProperty ('_inside_of_zones')	# Only used for Player.
 	@_table_arg
 	def __init__ (self, Cartridge, Container = None, Active = None, Commands = None, Description = None, Icon = None, Media = None, Name = None, ObjectLocation = None, Visible = None, **ka):
 		if len (ka) > 0:
 			_sys.stderr.write ('unknown commands given to ZCharacter: %s\n' % ka)
 		#print ('making character')
 		ZObject.__init__ (self, {'Cartridge': Cartridge, 'Container': Container, 'Active': Active, 'Commands': Commands, 'Description': Description, 'Icon': Icon, 'Media': Media, 'Name': Name, 'ObjectLocation': ObjectLocation, 'Visible': Visible})
+	def _get_state (self):
+		ret = ZObject._get_state (self)
+		if '_inside_of_zones' in self.__dict__:
+			ret['InsideOfZones'] = list (self._inside_of_zones)
+		return ret
+	def _set_state (self, state):
+		zones = state.pop ('InsideOfZones', None)
+		ZObject._set_state (self, state)
+		if zones is not None and zones is not _not_saved:
+			self.InsideOfZones = [v for k, v in sorted (zones, key = lambda x: x[0]) if v is not _not_saved]
 # }}}
 
 class ZTimer (ZObject): # {{{
@@ -543,13 +1899,32 @@ class ZTimer (ZObject): # {{{
 		if len (ka) > 0:
 			_sys.stderr.write ('unknown commands given to ZTimer: %s\n' % ka)
 		ZObject.__init__ (self, {'Cartridge': Cartridge, 'Container': Container, 'Active': Active, 'Commands': Commands, 'Description': Description, 'Icon': Icon, 'Media': Media, 'Name': Name, 'ObjectLocation': ObjectLocation, 'Visible': Visible})
+		self._target = None	# time for next tick, or None.
+		self._source = None
 		self.Type = Type
 		self.Duration = Duration
 		self.Remaining = -1
 		self.OnStart = OnStart
 		self.OnStop = OnStop
 		self.OnTick = OnTick
-		self._target = None	# time for next tick, or None.
+	def _get_remaining (self):
+		if self._target is None:
+			return self._remaining
+		return self._target - self.Cartridge._time
+	def _set_remaining (self, remaining):
+		self._remaining = remaining
+	# While the timer is running, Remaining is computed from the time of the last _update.
+	Remaining = property (_get_remaining, _set_remaining)
+	def _add_source (self, delay):
+		if self.Cartridge._timer_engine == 'heap':
+			self._source = self.Cartridge._get_timers ().add (self, self.Cartridge._time + delay)
+		else:
+			self._source = _cb.add_timer (delay, self.Tick)
+	def _remove_source (self):
+		if self.Cartridge._timer_engine == 'heap':
+			self.Cartridge._get_timers ().remove (self)
+		else:
+			_cb.remove_timer (self._source)
 		self._source = None
 	def Start (self):
 		if self._target is not None:
@@ -557,56 +1932,158 @@ class ZTimer (ZObject): # {{{
 			return
 		if self.OnStart:
 			#print ('OnStart timer %s' % self.Name)
-			self.OnStart (self)
+			_fire (self, 'OnStart')
 		#print ('Timer started, settings:\n' + '\n'.join (['%s:%s' % (x, getattr (self, x)) for x in dir (self) if not x.startswith ('_')]))
 		if self.Remaining < 0:
 			self.Remaining = self.Duration
-		self._source = _cb.add_timer (self.Remaining, self.Tick)
-		self._target = self.Cartridge._time + self.Duration
+		self._add_source (self.Remaining)
+		self._target = self.Cartridge._time + self.Remaining
 	def Stop (self):
 		if self._target is None:
 			print ('Not stopping timer: not running.')
 			return
-		_cb.remove_timer (self._source)
+		self._remove_source ()
+		self._remaining = self.Remaining
 		self._target = None
-		self._source = None
 		if self.OnStop:
 			#print ('OnStop %s' % self.Name)
-			self.OnStop (self)
+			_fire (self, 'OnStop')
 		#print ('Timer stopped, settings:\n' + '\n'.join (['%s:%s' % (x, getattr (self, x)) for x in dir (self) if not x.startswith ('_')]))
 	def _reschedule (self):
-		if self._target is None:
+		if self._target is None or self.Cartridge._timer_engine == 'heap':
 			return
 		_cb.remove_timer (self._source)
 		self._source = _cb.add_timer (self.Remaining, self.Tick)
+	_saved_private = ('_remaining', '_target')	# The target is saved as it is, so that a running timer which did not change is not saved again.
+	def _set_state (self, state):
+		remaining = state.pop ('_remaining', -1)
+		target = state.pop ('_target', None)
+		ZObject._set_state (self, state)
+		if self._target is not None:
+			self._remove_source ()
+			self._target = None
+		self._remaining = remaining
+		if target is not None:
+			# Continue without calling OnStart. _saved_time is the game time of the last save, when target was already set.
+			remaining = max (0, target - self.Cartridge._saved_time)
+			self._add_source (remaining)
+			self._target = self.Cartridge._time + remaining
 	def Tick (self):
+		if self.Cartridge._session is not None:
+			self.Cartridge._session._activate ()
+		if _stats.enabled:
+			return _notify.call (_stats.call, 'timer', self.Name, self._tick)
+		return _notify.call (self._tick)
+	def _tick (self):
+		'Implementation of Tick.'
 		if self.Type == 'Interval':
 			now = self.Cartridge._time
 			# If this is called manually, skip the remaining time.
 			if self._target > now:
 				self._target = now
 			self._target += self.Duration
-			self.Remaining = self._target - now
 			# If execution is too slow, skip ticks.
 			if self._target < now:
-				self._target = now
-				self.Remaining = self.Duration
+				self._target = now + self.Duration
 			# This is braindead, but it's what the original does...
 			if self.OnStart:
 				#print ('OnStart timer %s' % self.Name)
-				self.OnStart (self)
-			self._source = _cb.add_timer (self._target - now, self.Tick)
+				_fire (self, 'OnStart')
+			if self.Cartridge._timer_engine == 'heap' and self._source is not None:
+				# Called manually; drop the pending tick.
+				self._remove_source ()
+			self._add_source (self._target - now)
 		else:
+			if self.Cartridge._timer_engine == 'heap' and self._source is not None:
+				self._remove_source ()
 			self._target = None
 			self._source = None
 			self.Remaining = -1
 		if self.OnTick:
 			#print ('OnTick %s' % self.Name)
-			self.OnTick (self)
+			_fire (self, 'OnTick')
 		#print ('Timer ticked, settings:\n' + '\n'.join (['%s:%s' % (x, getattr (self, x)) for x in dir (self) if not x.startswith ('_')]))
 		return False
 # }}}
 
+class _TimerQueue: # {{{
+	'''Scheduler for the running timers of a cartridge, used if its _timer_engine is 'heap'.
+	Deadlines are kept in a heap, and only one host timer is registered, for the first deadline.
+	Stopped timers are not removed from the heap; their entries are skipped because they are no longer the timer's _source.'''
+	def __init__ (self, cartridge):
+		self.cartridge = cartridge
+		self.heap = []		# (target, serial, timer)
+		self.serial = 0		# For keeping the order of equal targets.
+		self.source = None	# Host timer handle.
+		self.armed = None	# Target for which the host timer is set.
+		self.armings = 0	# Incremented whenever the host timer is set, so callbacks of removed host timers can be ignored.
+	def add (self, timer, target):
+		'Schedule a tick of timer at target. Return the heap entry, which is used as the timer source.'
+		self.serial += 1
+		entry = (target, self.serial, timer)
+		_heapq.heappush (self.heap, entry)
+		timer._source = entry
+		self.arm ()
+		return entry
+	def remove (self, timer):
+		timer._source = None
+		self.arm ()
+	def first (self):
+		'Return the first live entry, dropping stale entries before it.'
+		while len (self.heap) > 0 and self.heap[0][2]._source is not self.heap[0]:
+			_heapq.heappop (self.heap)
+		return self.heap[0] if len (self.heap) > 0 else None
+	def arm (self, force = False):
+		'Make sure the host timer is set for the first deadline.'
+		entry = self.first ()
+		target = None if entry is None else entry[0]
+		if target == self.armed and not force:
+			return
+		if self.source is not None:
+			_cb.remove_timer (self.source)
+			self.source = None
+		self.armed = target
+		if target is not None:
+			self.armings += 1
+			arming = self.armings
+			self.source = _cb.add_timer (max (0, target - self.cartridge._time), lambda: self.fire (arming))
+	def fire (self, arming):
+		'Host timer callback for the host timer which was set as number arming.'
+		if arming != self.armings or self.source is None:
+			# This host timer has been removed, but the host has called it anyway (for example after _update ran its ticks and set a new one).
+			return False
+		if self.cartridge._session is not None:
+			self.cartridge._session._activate ()
+		self.source = None
+		self.armed = None
+		entry = self.first ()
+		if entry is not None:
+			if hasattr (_cb, 'time'):
+				now = _cb.time ()
+			else:
+				# Without a clock, the best guess is that the host called this at the first deadline.
+				now = max (self.cartridge._time, entry[0])
+			_notify.call (self.run, max (self.cartridge._time, now))
+		self.arm ()
+		return False
+	def run (self, now):
+		'Tick all timers with a deadline at or before now. Return True if any timer ticked.'
+		self.cartridge._time = now
+		due = []
+		while True:
+			entry = self.first ()
+			if entry is None or entry[0] > now:
+				break
+			due.append (_heapq.heappop (self.heap))
+		for entry in due:
+			# A callback of an earlier timer may have stopped or restarted this one.
+			if entry[2]._source is entry:
+				entry[2]._source = None
+				entry[2].Tick ()
+		self.arm ()
+		return len (due) > 0
+# }}}
+
 class ZInput (ZObject): # {{{
 	'A user input field.'
 	@_table_arg
@@ -635,6 +2112,12 @@ class Zone (ZObject): # {{{
 		if len (ka) > 0:
 			_sys.stderr.write ('unknown commands given to Zone: %s\n' % ka)
 		ZObject.__init__ (self, {'Cartridge': Cartridge, 'Container': Container, 'Active': Active, 'Commands': Commands, 'Description': Description, 'Icon': Icon, 'Media': Media, 'Name': Name, 'ObjectLocation': ObjectLocation, 'Visible': Visible})
+		self._watched = []		# ZonePoints which will call _point_moved when they change.
+		self._points = ()		# Contents of Points when it was last checked.
+		self._points_dirty = False	# Whether Points has been read since _update last checked it.
+		self._geometry_serial = 0	# Incremented whenever Points change.
+		self._geometry = None		# Cached _ZoneGeometry for Points.
+		self._evaluated = 0		# Value of Cartridge._fix when _update last evaluated this zone.
 		self.OriginalPoint = OriginalPoint
 		self.Points = Points if Points is not None else _script.make_table ()
 		self.ShowObjects = ShowObjects
@@ -648,6 +2131,85 @@ class Zone (ZObject): # {{{
 		self.OnDistant = OnDistant
 		self.ProximityRange = ProximityRange
 		self.DistanceRange = DistanceRange
+	def __setattr__ (self, key, value):
+		ZObject.__setattr__ (self, key, value)
+		if key == 'Points':
+			self._watch_points ()
+		elif key in ('Active', 'ProximityRange', 'DistanceRange'):
+			self._changed ()
+	def _changed (self):
+		'Make sure that _update evaluates this zone at the next opportunity.'
+		cartridge = self.__dict__.get ('Cartridge')
+		if cartridge is not None and cartridge._zone_index is not None:
+			cartridge._zone_index.touch (self)
+	def _watch_points (self):
+		'Register with all ZonePoints in Points, so that changing them invalidates cached geometry.'
+		for p in self._watched:
+			p._watchers.remove (self)
+		self._points = tuple (_items (self.__dict__['Points']))
+		self._watched = [p for p in self._points if isinstance (p, ZonePoint)]
+		for p in self._watched:
+			if not hasattr (p, '_watchers'):
+				object.__setattr__ (p, '_watchers', [])
+			p._watchers.append (self)
+		self._point_moved (None)
+	_saved_private = ('_inside', '_state', '_active')
+	def _set_state (self, state):
+		ZObject._set_state (self, state)
+		# Points may have been changed in place.
+		self._watch_points ()
+	def _get_points (self):
+		try:
+			points = self.__dict__['Points']
+		except KeyError:
+			raise AttributeError ('Points')
+		self._read_points ()
+		return points
+	def _set_points (self, points):
+		self.__dict__['Points'] = points
+	# The table is kept in __dict__, so it is saved like other attributes.
+	Points = property (_get_points, _set_points)
+	def _read_points (self):
+		'''The Points table has been handed out, so it may be changed in place (such as zone.Points[3] = ZonePoint (...) in lua).
+		Until the next _update, the zone compares it with its geometry whenever that is used.'''
+		if self._points_dirty:
+			return
+		self._points_dirty = True
+		cartridge = self.__dict__.get ('Cartridge')
+		if cartridge is not None:
+			if cartridge._points_read is None:
+				cartridge._points_read = set ()
+			cartridge._points_read.add (self)
+	def _compare_points (self):
+		'If the contents of the Points table are not the points which are watched, watch the new ones.'
+		points = _items (self.__dict__['Points'])
+		if len (points) != len (self._points) or any (a is not b for a, b in zip (points, self._points)):
+			self._watch_points ()
+	def _check_points (self):
+		'Return the geometry serial, which is valid for the current Points.'
+		if self._points_dirty:
+			self._compare_points ()
+		return self._geometry_serial
+	def _point_moved (self, point):
+		self._geometry_serial += 1
+		self._geometry = None
+		self._changed ()
+		self._moved ()
+	def _current_vector (self):
+		'Return CurrentDistance and CurrentBearing. If _update did not evaluate the zone for the current position because it is far away, they are computed when needed.'
+		if self._evaluated != self.Cartridge._fix and self.Active:
+			here = self._player ().ObjectLocation
+			key = self._vector_key
+			serial = self._check_points ()
+			if key is None or key[0] is not here or key[1] != serial:
+				self._vector_key = (here, serial)
+				self._distance, self._bearing = VectorToZone (here, self)
+		return self._distance, self._bearing
+	def _get_geometry (self):
+		self._check_points ()
+		if self._geometry is None:
+			self._geometry = _ZoneGeometry (self._points)
+		return self._geometry
 	def __str__ (self):
 		if hasattr (self, 'OriginalPoint'):
 			return '<Zone at %s>' % str (self.OriginalPoint)
@@ -657,6 +2219,7 @@ class Zone (ZObject): # {{{
 
 class ZTask (ZObject): # {{{
 	'A task the user can attempt to accomplish.'
+	_notify_kind = 'tasks'
 	@_table_arg
 	def __init__ (self, Cartridge, Container = None, Active = None, Commands = None, Description = None, Icon = None, Media = None, Name = None, ObjectLocation = None, Visible = None, Complete = False, CorrectState = False, **ka):
 		if len (ka) > 0:
@@ -675,6 +2238,12 @@ class ZMedia (ZObject): # {{{
 		ZObject.__init__ (self, {'Cartridge': Cartridge, 'Container': Container, 'Active': Active, 'Commands': Commands, 'Description': Description, 'Icon': Icon, 'Media': Media, 'Name': Name, 'ObjectLocation': ObjectLocation, 'Visible': Visible})
 		self._gwc_file_order = Cartridge._mediacount
 		Cartridge._mediacount += 1
+	def _get_data (self):
+		'Return type and data of this media file if the cartridge is a gwc file, or None. The data is a buffer into the file, which is only read when it is used.'
+		gwc = _gwc if self.Cartridge._session is None else self.Cartridge._session.gwc
+		if gwc is None:
+			return None
+		return gwc.media (self._gwc_file_order)
 # }}}
 # }}}
 # }}}
@@ -748,46 +2317,331 @@ def NoCaseEquals (s1, s2): # {{{
 	return s1 == s2
 # }}}
 
-def _intersect (point, segment): # {{{
-	'Compute whether a line from the north pole to point intersects with the segment. Return 0 or 1.'
+def _crossing (lat, lon, lat1, lon1, lat2, lon2): # {{{
+	'Compute whether a line from the north pole to (lat, lon) intersects with the segment from (lat1, lon1) to (lat2, lon2). All coordinates are in degrees. Return 0 or 1.'
 	# Use simple interpolation for latitude. TODO: this is not correct on the spherical surface.
-	if INVALID_ZONEPOINT in (point, segment[0], segment[1]):
-		return 0
-	lon1 = segment[0].longitude
-	lon2 = segment[1].longitude
-	lonp = point.longitude
 	if (lon2 - lon1) % 360 > 180:
 		# lon1 > lon2
-		if (lonp - lon2) % 360 > 180 or (lon1 - lonp) % 360 >= 180 or lon1 == lonp:
+		if (lon - lon2) % 360 > 180 or (lon1 - lon) % 360 >= 180 or lon1 == lon:
 			return 0
-		lat = segment[0].latitude + (segment[1].latitude - segment[0].latitude) * ((lon1 - lonp) % 360) / ((lon1 - lon2) % 360)
+		l = lat1 + (lat2 - lat1) * ((lon1 - lon) % 360) / ((lon1 - lon2) % 360)
 	else:
 		# lon2 > lon1
-		if (lonp - lon1) % 360 > 180 or (lon2 - lonp) % 360 >= 180 or lon2 == lonp:
+		if (lon - lon1) % 360 > 180 or (lon2 - lon) % 360 >= 180 or lon2 == lon:
 			return 0
-		lat = segment[0].latitude + (segment[1].latitude - segment[0].latitude) * ((lonp - lon1) % 360) / ((lon2 - lon1) % 360)
-	if lat > point.latitude:
+		l = lat1 + (lat2 - lat1) * ((lon - lon1) % 360) / ((lon2 - lon1) % 360)
+	if l > lat:
 		return 1
 	return 0
 # }}}
 
+def _intersect (point, segment): # {{{
+	'Compute whether a line from the north pole to point intersects with the segment. Return 0 or 1.'
+	if INVALID_ZONEPOINT in (point, segment[0], segment[1]):
+		return 0
+	return _crossing (point.latitude, point.longitude, segment[0].latitude, segment[0].longitude, segment[1].latitude, segment[1].longitude)
+# }}}
+
+def _vector (lat1, lon1, lat2, lon2): # {{{
+	'Compute distance and bearing from (lat1, lon1) to (lat2, lon2). Coordinates and the returned distance (an angle) are in radians, the bearing is in degrees.'
+	# Special case for points on the same longitude (in particular, for p1 == p2).
+	if lon1 == lon2:
+		return abs (lat1 - lat2), 0 if lat1 <= lat2 else 180
+	# Formula of haversines. This is a numerically stable way of determining the distance.
+	dist = 2 * _math.asin (_math.sqrt (_math.sin ((lat1 - lat2) / 2) ** 2 + _math.cos (lat1) * _math.cos (lat2) * _math.sin ((lon1 - lon2) / 2) ** 2))
+	# And the bearing.
+	bearing = _math.atan2 (_math.sin (lon2 - lon1) * _math.cos(lat2), _math.cos (lat1) * _math.sin (lat2) - _math.sin (lat1) * _math.cos (lat2) * _math.cos (lon2 - lon1))
+	return dist, _math.degrees (bearing)
+# }}}
+
+def _segment (lat1, lon1, lat2, lon2): # {{{
+	'Compile a segment for _crossing and _vector_to_segment. Coordinates are in degrees.'
+	r = [_math.radians (x) for x in (lat1, lon1, lat2, lon2)]
+	length, bearing = _vector (*r)
+	return (lat1, lon1, lat2, lon2) + tuple (r) + (length, bearing)
+# }}}
+
+def _closest_point (lat, lon, segment): # {{{
+	'Compute the point on a compiled segment which is closest to (lat, lon). Coordinates are in radians.'
+	lat1, lon1, lat2, lon2, length, bearing = segment[4:]
+	d1, b1 = _vector (lat1, lon1, lat, lon)
+	angle = _math.radians (b1 - bearing)
+	dist = _math.asin (_math.sin (d1) * _math.sin (angle))
+	dat = _math.acos (min (1., _math.cos (d1) / _math.cos (dist)))
+	if _math.cos (angle) < 0:
+		# The point is behind the start of the segment, so the along track distance is negative.
+		dat = -dat
+	if dat <= 0:
+		return lat1, lon1
+	elif dat >= length:
+		return lat2, lon2
+	# Move dat along the segment, like TranslatePoint.
+	b = _math.radians (bearing)
+	ilat = _math.asin (_math.sin (lat1) * _math.cos (dat) + _math.cos (lat1) * _math.sin (dat) * _math.cos (b))
+	ilon = lon1 + _math.atan2 (_math.sin (b) * _math.sin (dat) * _math.cos (lat1), _math.cos (dat) - _math.sin (lat1) * _math.sin (ilat))
+	return ilat, ilon
+# }}}
+
+def _vector_to_segment (lat, lon, segment): # {{{
+	'Compute distance (as an angle) and bearing from (lat, lon) to the closest point on a compiled segment. Coordinates and distance are in radians, the bearing is in degrees.'
+	ilat, ilon = _closest_point (lat, lon, segment)
+	return _vector (lat, lon, ilat, ilon)
+# }}}
+
+def _meters (angle): # {{{
+	'Convert an angle in radians to meters.'
+	# 1 nautical mile is by definition equal to 1 minute, so 60 nautical miles is 1 degree.
+	return _math.degrees (angle) * 60 * 1852.
+# }}}
+
+# Geodesic models. {{{
+# Every cartridge uses one of these for distances, bearings and TranslatePoint; see ZCartridge._geodesy.
+# All of them take and return coordinates and bearings in degrees, and distances in meters.
+class _SphericalModel: # {{{
+	'''The earth as a sphere on which 1 nautical mile is 1 minute of arc (so its radius is 6366.7 km).
+	This is what the Wherigo builder and players use, so it is the default.'''
+	name = 'spherical'
+	slack = 1.	# Upper bound for distances in this model, relative to spherical distances.
+	def vector (self, lat1, lon1, lat2, lon2):
+		dist, bearing = _vector (_math.radians (lat1), _math.radians (lon1), _math.radians (lat2), _math.radians (lon2))
+		return _meters (dist), bearing
+	def segment_vector (self, lat, lon, segment):
+		'Return distance and bearing from (lat, lon) to the closest point of a compiled segment.'
+		dist, bearing = _vector_to_segment (_math.radians (lat), _math.radians (lon), segment)
+		return _meters (dist), bearing
+	def zone_vector (self, geometry, lat, lon):
+		'Return distance and bearing from (lat, lon) to the closest point of the segments of a _ZoneGeometry.'
+		lat = _math.radians (lat)
+		lon = _math.radians (lon)
+		current = float ('inf'), float ('nan')
+		for s in geometry.segments:
+			this = _vector_to_segment (lat, lon, s)
+			if this[0] < current[0]:
+				current = this
+		return _meters (current[0]), current[1]
+	def translate (self, lat, lon, meters, bearing):
+		'Return the point at meters from (lat, lon) in the direction of bearing.'
+		d = _math.radians (meters / 1852. / 60.)
+		b = _math.radians (bearing)
+		lat1 = _math.radians (lat)
+		lat2 = _math.asin (_math.sin (lat1) * _math.cos (d) + _math.cos (lat1) * _math.sin (d) * _math.cos(b))
+		dlon = _math.atan2 (_math.sin(b) * _math.sin (d) * _math.cos (lat1), _math.cos (d) - _math.sin (lat1) * _math.sin (lat2))
+		return _math.degrees (lat2), lon + _math.degrees (dlon)
+# }}}
+
+class _LocalModel: # {{{
+	'''Flat earth: points are projected on a plane (equirectangular, east and north in meters) around the position the vector starts from,
+	with the scale of the spherical model. This needs one cosine per computation, instead of several trigonometric functions per segment.
+	For two points, the cosine of their middle latitude is used, which keeps the difference with the spherical model below a millimeter for points within 5 km.
+	For zones and segments, the projection is around the position, and segments are straight lines in it (as in IsPointInZone), not great circles.
+	For segments within d meters, at latitude lat, the distance then differs from the spherical one by at most about d * d * tan (|lat|) / (2 * 6367 km):
+	10 cm for 1 km and 2.5 m for 5 km at 52 degrees, 5 m for 5 km at 70 degrees. This grows quickly for larger distances and towards the poles,
+	so this model is meant for games which are played within a few kilometers.'''
+	name = 'local'
+	slack = 1.01
+	scale = 60 * 1852.	# Meters per degree of latitude.
+	def vector (self, lat1, lon1, lat2, lon2):
+		y = (lat2 - lat1) * self.scale
+		x = ((lon2 - lon1 + 180) % 360 - 180) * self.scale * _math.cos (_math.radians ((lat1 + lat2) / 2.))
+		return _math.hypot (x, y), _math.degrees (_math.atan2 (x, y))
+	def segment_vector (self, lat, lon, segment):
+		return self.closest (lat, lon, (segment,))
+	def zone_vector (self, geometry, lat, lon):
+		return self.closest (lat, lon, geometry.segments)
+	def closest (self, lat, lon, segments):
+		'Return distance and bearing from (lat, lon) to the closest point of compiled segments.'
+		scale = self.scale
+		lon_scale = scale * _math.cos (_math.radians (lat))
+		best = float ('inf')
+		x = y = float ('nan')
+		for s in segments:
+			# Coordinates relative to the point, in meters.
+			y1 = (s[0] - lat) * scale
+			x1 = ((s[1] - lon + 180) % 360 - 180) * lon_scale
+			dy = (s[2] - lat) * scale - y1
+			dx = ((s[3] - lon + 180) % 360 - 180) * lon_scale - x1
+			length = dx * dx + dy * dy
+			t = 0 if length == 0 else max (0, min (1, -(x1 * dx + y1 * dy) / length))
+			px = x1 + t * dx
+			py = y1 + t * dy
+			dist = _math.hypot (px, py)
+			if dist < best:
+				best, x, y = dist, px, py
+		if best == 0:
+			return 0., 0
+		return best, _math.degrees (_math.atan2 (x, y))
+	def translate (self, lat, lon, meters, bearing):
+		b = _math.radians (bearing)
+		return lat + meters * _math.cos (b) / self.scale, lon + meters * _math.sin (b) / (self.scale * _math.cos (_math.radians (lat)))
+# }}}
+
+class _EllipsoidalModel: # {{{
+	'''The WGS84 ellipsoid, which is what GPS receivers use; distances are in real meters.
+	Vectors between points and TranslatePoint use the formulas of Vincenty, which are accurate to less than a millimeter.
+	For segments and zones, the closest point is found on the sphere, and the distance to it is computed on the ellipsoid; this is accurate to a few centimeters for zones of some kilometers.
+	It is several times slower than the spherical model, and zone batches (which use numpy) are not used with it.'''
+	name = 'ellipsoidal'
+	slack = 1.01	# Ellipsoidal distances are less than 0.6% longer than spherical ones.
+	a = 6378137.
+	f = 1 / 298.257223563
+	def vector (self, lat1, lon1, lat2, lon2):
+		a, f = self.a, self.f
+		b = a * (1 - f)
+		L = _math.radians ((lon2 - lon1 + 180) % 360 - 180)
+		U1 = _math.atan ((1 - f) * _math.tan (_math.radians (lat1)))
+		U2 = _math.atan ((1 - f) * _math.tan (_math.radians (lat2)))
+		sinU1, cosU1 = _math.sin (U1), _math.cos (U1)
+		sinU2, cosU2 = _math.sin (U2), _math.cos (U2)
+		lam = L
+		for i in range (100):
+			sinlam, coslam = _math.sin (lam), _math.cos (lam)
+			sinsigma = _math.sqrt ((cosU2 * sinlam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * coslam) ** 2)
+			if sinsigma == 0:
+				# The points are the same.
+				return 0., 0
+			cossigma = sinU1 * sinU2 + cosU1 * cosU2 * coslam
+			sigma = _math.atan2 (sinsigma, cossigma)
+			sinalpha = cosU1 * cosU2 * sinlam / sinsigma
+			cos2alpha = 1 - sinalpha ** 2
+			# cos2alpha is 0 for points on the equator.
+			cos2sm = cossigma - 2 * sinU1 * sinU2 / cos2alpha if cos2alpha != 0 else 0.
+			C = f / 16 * cos2alpha * (4 + f * (4 - 3 * cos2alpha))
+			previous = lam
+			lam = L + (1 - C) * f * sinalpha * (sigma + C * sinsigma * (cos2sm + C * cossigma * (-1 + 2 * cos2sm ** 2)))
+			if abs (lam - previous) < 1e-12:
+				break
+		else:
+			# This does not converge for nearly antipodal points; use the sphere for them.
+			return _spherical.vector (lat1, lon1, lat2, lon2)
+		u2 = cos2alpha * (a * a - b * b) / (b * b)
+		A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+		B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+		dsigma = B * sinsigma * (cos2sm + B / 4 * (cossigma * (-1 + 2 * cos2sm ** 2) - B / 6 * cos2sm * (-3 + 4 * sinsigma ** 2) * (-3 + 4 * cos2sm ** 2)))
+		bearing = _math.atan2 (cosU2 * sinlam, cosU1 * sinU2 - sinU1 * cosU2 * coslam)
+		return b * A * (sigma - dsigma), _math.degrees (bearing)
+	def segment_vector (self, lat, lon, segment):
+		ilat, ilon = _closest_point (_math.radians (lat), _math.radians (lon), segment)
+		return self.vector (lat, lon, _math.degrees (ilat), _math.degrees (ilon))
+	def zone_vector (self, geometry, lat, lon):
+		rlat = _math.radians (lat)
+		rlon = _math.radians (lon)
+		current = float ('inf'), None
+		for s in geometry.segments:
+			dist = _vector_to_segment (rlat, rlon, s)[0]
+			if dist < current[0]:
+				current = dist, s
+		if current[1] is None:
+			return float ('inf'), float ('nan')
+		return self.segment_vector (lat, lon, current[1])
+	def translate (self, lat, lon, meters, bearing):
+		a, f = self.a, self.f
+		b = a * (1 - f)
+		alpha1 = _math.radians (bearing)
+		sinalpha1, cosalpha1 = _math.sin (alpha1), _math.cos (alpha1)
+		tanU1 = (1 - f) * _math.tan (_math.radians (lat))
+		cosU1 = 1 / _math.sqrt (1 + tanU1 ** 2)
+		sinU1 = tanU1 * cosU1
+		sigma1 = _math.atan2 (tanU1, cosalpha1)
+		sinalpha = cosU1 * sinalpha1
+		cos2alpha = 1 - sinalpha ** 2
+		u2 = cos2alpha * (a * a - b * b) / (b * b)
+		A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+		B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+		sigma = meters / (b * A)
+		for i in range (100):
+			cos2sm = _math.cos (2 * sigma1 + sigma)
+			sinsigma, cossigma = _math.sin (sigma), _math.cos (sigma)
+			dsigma = B * sinsigma * (cos2sm + B / 4 * (cossigma * (-1 + 2 * cos2sm ** 2) - B / 6 * cos2sm * (-3 + 4 * sinsigma ** 2) * (-3 + 4 * cos2sm ** 2)))
+			previous = sigma
+			sigma = meters / (b * A) + dsigma
+			if abs (sigma - previous) < 1e-12:
+				break
+		cos2sm = _math.cos (2 * sigma1 + sigma)
+		sinsigma, cossigma = _math.sin (sigma), _math.cos (sigma)
+		tmp = sinU1 * sinsigma - cosU1 * cossigma * cosalpha1
+		lat2 = _math.atan2 (sinU1 * cossigma + cosU1 * sinsigma * cosalpha1, (1 - f) * _math.sqrt (sinalpha ** 2 + tmp ** 2))
+		lam = _math.atan2 (sinsigma * sinalpha1, cosU1 * cossigma - sinU1 * sinsigma * cosalpha1)
+		C = f / 16 * cos2alpha * (4 + f * (4 - 3 * cos2alpha))
+		L = lam - (1 - C) * f * sinalpha * (sigma + C * sinsigma * (cos2sm + C * cossigma * (-1 + 2 * cos2sm ** 2)))
+		return _math.degrees (lat2), lon + _math.degrees (L)
+# }}}
+
+_spherical = _SphericalModel ()
+_geodesy_models = dict ((m.name, m) for m in (_spherical, _LocalModel (), _EllipsoidalModel ()))
+
+def _model (): # {{{
+	'Return the geodesic model of the current cartridge. While a cartridge is being set up, that is the default of ZCartridge.'
+	cartridge = None if _session is None else _session.cartridge
+	if cartridge is None:
+		cartridge = getattr (Player, 'Cartridge', None)
+	return _geodesy_models[getattr (cartridge, '_geodesy', ZCartridge._geodesy)]
+# }}}
+# }}}
+
+class _ZoneGeometry: # {{{
+	'''Compiled form of the Points of a Zone, for IsPointInZone and VectorToZone.
+	Zones keep this until their Points, or one of the ZonePoints in it, change.'''
+	def __init__ (self, points):
+		# valid means that there are points, and all of them are ZonePoints. Only valid geometry is used for zone batches and the zone index.
+		self.valid = len (points) > 0 and all (isinstance (p, ZonePoint) for p in points)
+		self.coords = tuple ((p.latitude, p.longitude) if isinstance (p, ZonePoint) else None for p in points)
+		# Segments are in the order that VectorToZone uses: first the closing segment, then the others.
+		# Segments with an invalid point are left out; they never intersect and are infinitely far away.
+		self.segments = [_segment (a[0], a[1], b[0], b[1]) for a, b in zip (self.coords[-1:] + self.coords[:-1], self.coords) if a is not None and b is not None]
+		valid = [c for c in self.coords if c is not None]
+		if len (valid) == 0:
+			self.base = 0
+			self.bbox = None
+			return
+		# Spherical trigonometry: every closed curve cuts the world in two pieces. If point is in the same piece as the OriginalPoint, it is considered "inside".
+		# This means that any line from OriginalPoint to point has an even number of intersections with zone segments.
+		# This line doesn't need to be the shortest path. It is much easier if it isn't. I'm using a two-segment line: One segment straight north to the pole, one straight south to OriginalPoint.
+		# Use alternative originalpoint which is guaranteed to be OUTSIDE the zone for non-huge zones, then return the inverse result.
+		# This is required because originalpoint isn't always inside the zone.
+		# The number of intersections from the alternative origin doesn't depend on the point, so it is computed here.
+		nonorigin = (valid[0][0], (valid[0][1] + 180) % 180 - 90)
+		self.base = sum (_crossing (nonorigin[0], nonorigin[1], *s[:4]) for s in self.segments)
+		lats = [c[0] for c in valid]
+		lons = [c[1] for c in valid]
+		self.bbox = (min (lats), min (lons), max (lats), max (lons))
+		# All points of the zone, including its segments, are within radius (in meters) of center.
+		self.center = ((self.bbox[0] + self.bbox[2]) / 2., (self.bbox[1] + self.bbox[3]) / 2.)
+		c = [_math.radians (x) for x in self.center]
+		self.radius = _math.degrees (max (_vector (c[0], c[1], _math.radians (lat), _math.radians (lon))[0] for lat, lon in valid)) * 60 * 1852.
+	def inside (self, lat, lon):
+		'Compute IsPointInZone for (lat, lon), in degrees.'
+		num = self.base
+		for s in self.segments:
+			num += _crossing (lat, lon, *s[:4])
+		return num % 2 != 0
+	def boundary (self, lat, lon, reach):
+		'''Return a lower bound for the distance, in meters, which a point at (lat, lon) (in degrees) must move to make inside give a different result.
+		This is the distance to the nearest segment, as inside sees them (straight in degrees), with longitudes scaled for the highest latitude within reach meters.'''
+		scale = 60 * 1852.
+		lon_scale = scale * _math.cos (_math.radians (min (90, abs (lat) + reach / scale)))
+		ret = float ('inf')
+		for s in self.segments:
+			# Coordinates relative to the point, in meters.
+			y1 = (s[0] - lat) * scale
+			x1 = ((s[1] - lon + 180) % 360 - 180) * lon_scale
+			y2 = (s[2] - lat) * scale
+			x2 = ((s[3] - lon + 180) % 360 - 180) * lon_scale
+			dx = x2 - x1
+			dy = y2 - y1
+			length = dx * dx + dy * dy
+			t = 0 if length == 0 else max (0, min (1, -(x1 * dx + y1 * dy) / length))
+			ret = min (ret, _math.hypot (x1 + t * dx, y1 + t * dy))
+		return ret
+	def vector (self, lat, lon):
+		'Compute VectorToZone for (lat, lon), in degrees, if it is outside the zone. Return distance (in meters) and bearing (in degrees).'
+		return _model ().zone_vector (self, lat, lon)
+# }}}
+
 def IsPointInZone (point, zone): # {{{
 	'Unknown parameters; presumably checks whether a specified ZonePoint is within a specified Zone.'
 	if point == INVALID_ZONEPOINT:
 		return False
-	# Spherical trigonometry: every closed curve cuts the world in two pieces. If point is in the same piece as the OriginalPoint, it is considered "inside".
-	# This means that any line from OriginalPoint to point has an even number of intersections with zone segments.
-	# This line doesn't need to be the shortest path. It is much easier if it isn't. I'm using a two-segment line: One segment straight north to the pole, one straight south to OriginalPoint.
-	num = 0
-	points = zone.Points.list ()
-	# Use alternative originalpoint which is guaranteed to be OUTSIDE the zone for non-huge zones, then return the inverse result.
-	# This is required because originalpoint isn't always inside the zone.
-	nonorigin = ZonePoint (points[0].latitude, (points[0].longitude + 180) % 180 - 90, points[0].altitude)
-	points += (points[0],)
-	for i in range (len (points) - 1):
-		num += _intersect (point, (points[i], points[i + 1]))
-		num += _intersect (nonorigin, (points[i], points[i + 1]))
-	return num % 2 != 0
+	return zone._get_geometry ().inside (point.latitude, point.longitude)
 # }}}
 
 def VectorToSegment (point, p1, p2): # {{{
@@ -795,17 +2649,8 @@ def VectorToSegment (point, p1, p2): # {{{
 	# Compute shortest distance and bearing to get from point to anywhere on segment.
 	if INVALID_ZONEPOINT in (point, p1, p2):
 		return Distance (float ('inf')), float ('nan')
-	d1, b1 = VectorToPoint (p1, point)
-	d1 = _math.radians (d1.GetValue ('nauticalmiles') / 60.)
-	ds, bs = VectorToPoint (p1, p2)
-	dist = _math.asin (_math.sin (d1) * _math.sin (_math.radians (b1 - bs)))
-	dat = _math.acos (_math.cos (d1) / _math.cos (dist))
-	if dat <= 0:
-		return VectorToPoint (point, p1)
-	elif dat >= _math.radians (ds.GetValue ('nauticalmiles') / 60.):
-		return VectorToPoint (point, p2)
-	intersect = TranslatePoint (p1, Distance (dat * 60, 'nauticalmiles'), bs)
-	return VectorToPoint (point, intersect)
+	dist, bearing = _model ().segment_vector (point.latitude, point.longitude, _segment (p1.latitude, p1.longitude, p2.latitude, p2.longitude))
+	return Distance (dist), bearing
 # }}}
 
 def VectorToZone (point, zone): # {{{
@@ -813,35 +2658,19 @@ def VectorToZone (point, zone): # {{{
 	# Compute shortest distance and bearing to get from point inside a zone.
 	if point == INVALID_ZONEPOINT:
 		return Distance (float ('inf')), float ('nan')
-	if IsPointInZone (point, zone):
+	geometry = zone._get_geometry ()
+	if geometry.inside (point.latitude, point.longitude):
 		return Distance (0), 0
-	# Use VectorToSegment multiple times.
-	points = zone.Points.list ()
-	current = VectorToSegment (point, points[-1], points[0])
-	for p in range (1, len (points)):
-		this = VectorToSegment (point, points[p - 1], points[p])
-		if this[0] < current[0]:
-			current = this
-	return current
+	dist, bearing = geometry.vector (point.latitude, point.longitude)
+	return Distance (dist), bearing
 # }}}
 
 def VectorToPoint (p1, p2): # {{{
 	'd,b=VectorToPoint(zonepoint1,zonepoint2). Accepts two ZonePoint instance. Returns distance and bearing from zonepoint1 to zonepoint2. d is a Distance instance; b is a float.'
 	if INVALID_ZONEPOINT in (p1, p2):
 		return Distance (float ('inf')), float ('nan')
-	# Special case for points on the same longitude (in particular, for p1 == p2).
-	if p1.longitude == p2.longitude:
-		return Distance (abs (p1.latitude - p2.latitude) * 60, 'nauticalmiles'), 0 if p1.latitude <= p2.latitude else 180
-	lat1 = _math.radians (p1.latitude)
-	lon1 = _math.radians (p1.longitude)
-	lat2 = _math.radians (p2.latitude)
-	lon2 = _math.radians (p2.longitude)
-	# Formula of haversines. This is a numerically stable way of determining the distance.
-	dist = 2 * _math.asin (_math.sqrt (_math.sin ((lat1 - lat2) / 2) ** 2 + _math.cos (lat1) * _math.cos (lat2) * _math.sin ((lon1 - lon2) / 2) ** 2))
-	# And the bearing.
-	bearing = _math.atan2 (_math.sin (lon2 - lon1) * _math.cos(lat2), _math.cos (lat1) * _math.sin (lat2) - _math.sin (lat1) * _math.cos (lat2) * _math.cos (lon2 - lon1))
-	# To get a distance, use nautical miles: 1 nautical mile is by definition equal to 1 minute, so 60 nautical miles is 1 degree.
-	return Distance (_math.degrees (dist) * 60, 'nauticalmiles'), _math.degrees (bearing)
+	dist, bearing = _model ().vector (p1.latitude, p1.longitude, p2.latitude, p2.longitude)
+	return Distance (dist), bearing
 # }}}
 
 def TranslatePoint (point, distance, bearing): # {{{
@@ -852,11 +2681,494 @@ def TranslatePoint (point, distance, bearing): # {{{
 		and bearing is a float.'''
 	if point == INVALID_ZONEPOINT:
 		return point
-	d = _math.radians (distance.GetValue ('nauticalmiles') / 60.)
-	b = _math.radians (bearing)
-	lat1 = _math.radians (point.latitude)
-	lat2 = _math.asin (_math.sin (lat1) * _math.cos (d) + _math.cos (lat1) * _math.sin (d) * _math.cos(b))
-	dlon = _math.atan2 (_math.sin(b) * _math.sin (d) * _math.cos (lat1), _math.cos (d) - _math.sin (lat1) * _math.sin (lat2))
-	return ZonePoint (_math.degrees (lat2), point.longitude + _math.degrees (dlon), point.altitude)
+	lat, lon = _model ().translate (point.latitude, point.longitude, distance.GetValue (), bearing)
+	return ZonePoint (lat, lon, point.altitude)
+# }}}
+# }}}
+
+# Finding the zones which need to be evaluated. {{{
+class _ZoneIndex: # {{{
+	'''Grid over the map, for finding the zones which _update must evaluate.
+	Every zone is put in all cells which are within its DistanceRange or ProximityRange (whichever is larger) from it.
+	If the player is not in one of those cells, the zone cannot be entered and its range cannot be crossed.
+	Such a zone only needs to be evaluated if it is not yet in the state for being far away, or if it has changed.
+	Additionally, after a zone is evaluated, its safe radius is computed: the distance to its boundary and to the nearest ProximityRange or DistanceRange threshold.
+	Until the player has moved further than that from where it was evaluated, its state cannot change, so it is not evaluated again.'''
+	cell_size = .01		# Size of grid cells, in degrees (about a kilometer).
+	max_cells = 1024	# Zones which need more cells than this are evaluated on every fix.
+	margin = 1.		# Extra range, in meters, so rounding errors cannot cause missed events.
+	safe_max = 1000.	# Largest safe radius, in meters.
+	def __init__ (self, zones):
+		self.cells = {}			# (row, column): set of zones.
+		self.everywhere = set ()	# Zones which are always evaluated.
+		self.placed = {}		# zone: list of cells it is in.
+		self.unsettled = set ()		# Zones which must be evaluated even if they are far away.
+		self.changed = set (zones)	# Zones which must be placed again before they are evaluated.
+		self.safe = {}			# zone: (position, radius): the state of zone cannot change while the player is within radius meters from position.
+		self.heap = None		# Zones still to be evaluated in the current pass.
+		self.done = None		# Zones already evaluated in the current pass.
+		self.columns = int (round (360 / self.cell_size))
+	def cell (self, lat, lon):
+		return (int (_math.floor (lat / self.cell_size)), int (_math.floor (lon / self.cell_size)) % self.columns)
+	def place (self, zone):
+		'Put zone in the cells it needs to be in.'
+		for c in self.placed.pop (zone, ()):
+			self.cells[c].discard (zone)
+		self.everywhere.discard (zone)
+		cells = self.find_cells (zone)
+		if cells is None:
+			self.everywhere.add (zone)
+			return
+		for c in cells:
+			if c not in self.cells:
+				self.cells[c] = set ()
+			self.cells[c].add (zone)
+		self.placed[zone] = cells
+	def find_cells (self, zone):
+		'Return the cells that zone needs to be in, or None if it should be evaluated everywhere.'
+		geometry = zone._get_geometry ()
+		if not geometry.valid:
+			return None
+		bbox = geometry.bbox
+		if bbox[3] - bbox[1] > 180:
+			# Zones crossing the date line, or huge zones.
+			return None
+		center = geometry.center
+		reach = max (zone.ProximityRange.value, zone.DistanceRange.value, 0)
+		# The radius of the geometry is spherical; the ranges are in meters of the geodesic model.
+		extent = (geometry.radius + reach * _model ().slack + self.margin) / (60 * 1852.)
+		lat_range = (min (center[0] - extent, bbox[0]), max (center[0] + extent, bbox[2]))
+		if lat_range[0] <= -89 or lat_range[1] >= 89:
+			return None
+		extent /= _math.cos (_math.radians (max (abs (lat_range[0]), abs (lat_range[1]))))
+		lon_range = (min (center[1] - extent, bbox[1]), max (center[1] + extent, bbox[3]))
+		if lon_range[1] - lon_range[0] >= 180:
+			return None
+		low = self.cell (lat_range[0], lon_range[0])
+		high = self.cell (lat_range[1], lon_range[1])
+		rows = range (low[0], high[0] + 1)
+		columns = range (int (_math.floor (lon_range[0] / self.cell_size)), int (_math.floor (lon_range[1] / self.cell_size)) + 1)
+		if len (rows) * len (columns) > self.max_cells:
+			return None
+		return [(r, c % self.columns) for r in rows for c in columns]
+	def touch (self, zone):
+		'Zone has changed; evaluate it at the next opportunity.'
+		self.changed.add (zone)
+		# If this happens during a pass, and the pass has not reached the zone yet, evaluate it in this pass, like it would be if all zones were evaluated.
+		if self.heap is not None and zone not in self.done and zone.ObjIndex > self.position:
+			self.done.add (zone)
+			_heapq.heappush (self.heap, (zone.ObjIndex, zone))
+	def pending (self, here):
+		'Return the zones which must be evaluated for position here.'
+		for zone in self.changed:
+			self.place (zone)
+			self.safe.pop (zone, None)
+		ret = self.unsettled | self.changed | self.everywhere
+		ret.update (self.cells.get (self.cell (here.latitude, here.longitude), ()))
+		self.changed = set ()
+		moved = {}	# position: distance from here, in meters.
+		return sorted ((zone for zone in ret if not self.is_safe (zone, here, moved)), key = lambda zone: zone.ObjIndex)
+	def is_safe (self, zone, here, moved):
+		'Check if the player at here is still within the safe radius of zone. Safe radii are spherical distances, like _ZoneGeometry.boundary.'
+		safe = self.safe.get (zone)
+		if safe is None:
+			return False
+		position, radius = safe
+		if position not in moved:
+			moved[position] = _spherical.vector (position.latitude, position.longitude, here.latitude, here.longitude)[0]
+		return moved[position] < radius
+	def evaluate (self, zones):
+		'Iterate over zones in order. Zones which are changed by callbacks are added if they come later.'
+		self.heap = [(zone.ObjIndex, zone) for zone in zones]
+		self.done = set (zones)
+		try:
+			while self.heap:
+				self.position, zone = _heapq.heappop (self.heap)
+				yield zone
+				self.settle (zone)
+		finally:
+			self.heap = None
+			self.done = None
+	def settle (self, zone):
+		'Record whether zone needs to be evaluated again when it is far away.'
+		if zone._active != zone.Active:
+			settled = False
+		elif not zone.Active:
+			settled = zone not in Player._inside_of_zones
+		else:
+			settled = not zone._inside and zone._state == ('Distant' if zone.DistanceRange.value < 0 else 'NotInRange')
+		if settled:
+			self.unsettled.discard (zone)
+		else:
+			self.unsettled.add (zone)
+		self.safe.pop (zone, None)
+		here = Player.ObjectLocation
+		if zone._active != zone.Active or not here:
+			return
+		if not zone.Active:
+			# The state of an inactive zone does not depend on the position.
+			self.safe[zone] = (here, float ('inf'))
+			return
+		geometry = zone._get_geometry ()
+		if not geometry.valid or zone in self.everywhere:
+			return
+		radius = min (self.safe_max, geometry.boundary (here.latitude, here.longitude, self.safe_max))
+		if not zone._inside:
+			# Distance to a zone changes at most as much as the position. That is in the geodesic model, which is at most slack times the spherical distance.
+			distance = zone.CurrentDistance.value
+			slack = _model ().slack
+			for threshold in (zone.ProximityRange.value, zone.DistanceRange.value):
+				if threshold >= 0:
+					radius = min (radius, abs (distance - threshold) / slack)
+		radius -= self.margin
+		if radius > 0:
+			self.safe[zone] = (here, radius)
+# }}}
+# }}}
+
+# List screens for the gui. {{{
+class _Screens: # {{{
+	'''The objects on the list screens of a cartridge, for ZCartridge._screen:
+		'Inventory': items and characters which the player carries,
+		'Item': other items and characters which the player can see (see ZObject._is_visible),
+		'Location': zones, 'Tasks': tasks (without complete tasks if ZCartridge._complete_tasks is False).
+	All of them must be Active and Visible. Objects call ZObject._screen_changed when an attribute which decides this changes;
+	they are put on the right screen when the changes are reported, and the notifier reports the differences (see _Notifier).'''
+	names = ('Inventory', 'Item', 'Location', 'Tasks')
+	def __init__ (self, cartridge):
+		self.cartridge = cartridge
+		self.contents = dict ((name, set ()) for name in self.names)
+		self.where = {}		# object: name of the screen it is on.
+		self.added = dict ((name, set ()) for name in self.names)
+		self.removed = dict ((name, set ()) for name in self.names)
+		self.dirty = set ()	# Objects which must be placed again.
+		for obj in cartridge._objects_of (ZObject):
+			self.place (obj)
+		# The initial contents are not changes.
+		for name in self.names:
+			self.added[name].clear ()
+	def player (self):
+		session = self.cartridge._session
+		return Player if session is None else session.player
+	def screen (self, obj, player):
+		'Return the name of the screen that obj is on, or None.'
+		if not obj.Active or not obj.Visible or obj is player:
+			return None
+		if isinstance (obj, (ZItem, ZCharacter)):
+			if player is not None and obj.Container is player:
+				return 'Inventory'
+			return 'Item' if obj._is_visible (False) else None
+		if isinstance (obj, Zone):
+			return 'Location'
+		if isinstance (obj, ZTask):
+			return 'Tasks' if self.cartridge._complete_tasks or not obj.Complete else None
+		return None
+	def touch (self, obj):
+		'An attribute of obj which may put it on another screen has changed.'
+		self.dirty.add (obj)
+		_notifier_of (self.cartridge).mark ('screens', self)
+	def sync (self):
+		'Place the changed objects, and the objects which changed zones contain.'
+		player = self.player ()
+		dirty = self.dirty
+		self.dirty = set ()
+		for obj in dirty:
+			self.place (obj, player)
+			if isinstance (obj, Zone):
+				for item in obj._inventory:
+					self.place (item, player)
+	def place (self, obj, player = None):
+		if player is None:
+			player = self.player ()
+		new = self.screen (obj, player)
+		old = self.where.get (obj)
+		if new == old:
+			return
+		if old is not None:
+			self.contents[old].discard (obj)
+			if obj in self.added[old]:
+				self.added[old].discard (obj)
+			else:
+				self.removed[old].add (obj)
+			del self.where[obj]
+		if new is not None:
+			self.contents[new].add (obj)
+			if obj in self.removed[new]:
+				self.removed[new].discard (obj)
+			else:
+				self.added[new].add (obj)
+			self.where[obj] = new
+	def get (self, name):
+		'Return the objects on screen name, in the order of AllZObjects.'
+		self.sync ()
+		return sorted (self.contents[name], key = lambda obj: obj.ObjIndex)
+	def changes (self):
+		'Return and clear the changes since the previous call: {screen name: (added objects, removed objects)}, for screens which have changed.'
+		self.sync ()
+		ret = {}
+		for name in self.names:
+			if len (self.added[name]) > 0 or len (self.removed[name]) > 0:
+				ret[name] = tuple (sorted (objects, key = lambda obj: obj.ObjIndex) for objects in (self.added[name], self.removed[name]))
+				self.added[name].clear ()
+				self.removed[name].clear ()
+		return ret
+# }}}
+# }}}
+
+# Spatial queries for the gui. {{{
+class _SpatialIndex: # {{{
+	'''Grid over the map with the items, characters and zones of a cartridge, for ZCartridge._nearest and ZCartridge._within.
+	Items and characters are in the cell of their position (see ZObject._get_pos); zones are in all cells of their bounding box.
+	Objects which the player carries are left out. Objects tell the index when they (or their containers) move, with ZObject._moved;
+	they are placed again when the next query is made. A query looks at the cells around the point in growing rings,
+	until the rest of the map is provably further away than what it has found.'''
+	cell_size = .001	# Size of grid cells, in degrees (about 100 meters).
+	max_cells = 4096	# Zones which need more cells than this are checked by every query.
+	max_extent = 10.	# Queries which need to look further than this, in degrees, check all cells.
+	def __init__ (self, objects):
+		self.cells = {}			# (row, column): set of objects.
+		self.everywhere = set ()	# Zones which are checked by every query.
+		self.placed = {}		# object: list of cells it is in.
+		self.dirty = set (objects)	# Objects which must be placed again before the next query.
+		self.columns = int (round (360 / self.cell_size))
+	def cell (self, lat, lon):
+		return (int (_math.floor (lat / self.cell_size)), int (_math.floor (lon / self.cell_size)) % self.columns)
+	def touch (self, obj):
+		'The position of obj, or of one of its containers, has changed.'
+		self.dirty.add (obj)
+	def sync (self, player):
+		'Place the objects which have moved, and the objects which they contain.'
+		todo = list (self.dirty)
+		self.dirty = set ()
+		done = set ()
+		while len (todo) > 0:
+			obj = todo.pop ()
+			if obj in done:
+				continue
+			done.add (obj)
+			self.place (obj, player)
+			# Everything the player carries is left out, wherever the player goes.
+			if obj is not player:
+				todo.extend (obj.__dict__.get ('_inventory', ()))
+	def place (self, obj, player):
+		'Put obj in the cells it needs to be in.'
+		for c in self.placed.pop (obj, ()):
+			self.cells[c].discard (obj)
+			if len (self.cells[c]) == 0:
+				del self.cells[c]
+		self.everywhere.discard (obj)
+		cells = self.find_cells (obj, player)
+		if cells is None:
+			self.everywhere.add (obj)
+			return
+		for c in cells:
+			if c not in self.cells:
+				self.cells[c] = set ()
+			self.cells[c].add (obj)
+		if len (cells) > 0:
+			self.placed[obj] = cells
+	def find_cells (self, obj, player):
+		'Return the cells that obj needs to be in, an empty list if it should not be found, or None if every query should check it.'
+		if isinstance (obj, Zone):
+			geometry = obj._get_geometry ()
+			bbox = geometry.bbox
+			if bbox is None:
+				return []
+			if not geometry.valid or bbox[3] - bbox[1] > 180:
+				return None
+			low = self.cell (bbox[0], bbox[1])
+			high = self.cell (bbox[2], bbox[3])
+			rows = range (low[0], high[0] + 1)
+			columns = range (int (_math.floor (bbox[1] / self.cell_size)), int (_math.floor (bbox[3] / self.cell_size)) + 1)
+			if len (rows) * len (columns) > self.max_cells:
+				return None
+			return [(r, c % self.columns) for r in rows for c in columns]
+		if not isinstance (obj, (ZItem, ZCharacter)) or obj is player or player in obj._ancestors ():
+			return []
+		pos = obj._get_pos ()
+		if not pos:
+			return []
+		return [self.cell (pos.latitude, pos.longitude)]
+	def bound (self, lat, lon, center, ring):
+		'''Return a lower bound for the distance, in meters, from (lat, lon) to objects which are not in the cells within ring of center,
+		or None if that is not known because the ring is too large.'''
+		size = self.cell_size
+		south = (center[0] - ring) * size
+		north = (center[0] + ring + 1) * size
+		if ring * size > self.max_extent or south <= -89 or north >= 89:
+			return None
+		# Longitudes are relative to the cell of center, which is correct for the cell of lon, even across the date line.
+		west = lon - (lon - center[1] * size) % 360 - ring * size
+		east = west + (2 * ring + 1) * size
+		scale = 60 * 1852.
+		lat_gap = min (lat - south, north - lat) * scale
+		lon_gap = min (lon - west, east - lon) * scale * _math.cos (_math.radians (max (abs (south), abs (north))))
+		# Distances in all geodesic models, and on the sphere for large longitude differences, are at least this much of the flat estimate.
+		return min (lat_gap, lon_gap) * .98
+	def cell_bound (self, lat, lon, cell):
+		'Return a lower bound for the distance, in meters, from (lat, lon) to anything in cell.'
+		size = self.cell_size
+		south = cell[0] * size
+		north = south + size
+		scale = 60 * 1852.
+		dlat = max (0, south - lat, lat - north)
+		offset = (lon - cell[1] * size) % 360
+		dlon = 0 if offset < size else min (offset - size, 360 - offset)
+		latitude = max (abs (lat), abs (south), abs (north))
+		if dlon > self.max_extent or latitude >= 89:
+			# Only the difference in latitude is known to be a lower bound.
+			return dlat * scale * .98
+		return _math.hypot (dlat, dlon * _math.cos (_math.radians (latitude))) * scale * .98
+	def query (self, here, count, radius, classes, player, debug):
+		'''Return (distance in meters, bearing, object) for the count nearest objects (or all, if count is None) within radius meters (or at any distance, if radius is None) of here,
+		which are instances of classes and visible (see ZObject._is_visible), sorted by distance. Objects at the same distance are in the order of AllZObjects.'''
+		if count is not None and count <= 0:
+			return []
+		self.sync (player)
+		lat, lon = here.latitude, here.longitude
+		center = self.cell (lat, lon)
+		found = []	# Heap of (-distance, -ObjIndex, bearing, object) with the count nearest objects.
+		seen = set ()
+		def consider (obj):
+			if obj in seen:
+				return
+			seen.add (obj)
+			if not isinstance (obj, classes) or not obj._is_visible (debug):
+				return
+			if isinstance (obj, Zone):
+				distance, bearing = VectorToZone (here, obj)
+			else:
+				distance, bearing = VectorToPoint (here, obj._get_pos ())
+			distance = distance.value
+			if radius is not None and distance > radius:
+				return
+			entry = (-distance, -obj.__dict__.get ('ObjIndex', 0), bearing, obj)
+			if count is None or len (found) < count:
+				_heapq.heappush (found, entry)
+			elif entry > found[0]:
+				_heapq.heapreplace (found, entry)
+		def complete (bound):
+			'Check if nothing which is further away than bound can be in the result.'
+			if radius is not None and bound > radius:
+				return True
+			return count is not None and len (found) == count and -found[0][0] <= bound
+		for obj in self.everywhere:
+			consider (obj)
+		# Look at the cells around here, in growing rings, while there are fewer cells in a ring than cells with objects.
+		visited = set ()
+		ring = 0
+		while 8 * ring <= len (self.cells):
+			if ring == 0:
+				cells = [center]
+			else:
+				cells = [(center[0] + r, center[1] + c) for r in (-ring, ring) for c in range (-ring, ring + 1)]
+				cells += [(center[0] + r, center[1] + c) for c in (-ring, ring) for r in range (-ring + 1, ring)]
+			for r, c in cells:
+				c = (r, c % self.columns)
+				visited.add (c)
+				for obj in self.cells.get (c, ()):
+					consider (obj)
+			bound = self.bound (lat, lon, center, ring)
+			if bound is None:
+				break
+			if complete (bound):
+				return self.result (found)
+			ring += 1
+		# The rest of the map is sparse: look at the other cells with objects, nearest first.
+		for bound, c in sorted ((self.cell_bound (lat, lon, c), c) for c in self.cells if c not in visited):
+			if complete (bound):
+				break
+			for obj in self.cells[c]:
+				consider (obj)
+		return self.result (found)
+	def result (self, found):
+		return [(-d, bearing, obj) for d, index, bearing, obj in sorted (found, reverse = True)]
+# }}}
+# }}}
+
+# Batch evaluation of zones, using numpy. These do the same as IsPointInZone and VectorToZone, but for all zones at once. {{{
+def _intersect_array (lat, lon, alat, alon, blat, blon): # {{{
+	'Vectorized _intersect: for each segment from (alat, alon) to (blat, blon), compute whether a line from the north pole to (lat, lon) intersects with it. All coordinates are in degrees.'
+	with _numpy.errstate (divide = 'ignore', invalid = 'ignore'):
+		# blon < alon
+		skip = ((lon - blon) % 360 > 180) | ((alon - lon) % 360 >= 180) | (alon == lon)
+		cross = ~skip & (alat + (blat - alat) * ((alon - lon) % 360) / ((alon - blon) % 360) > lat)
+		# blon > alon
+		skip = ((lon - alon) % 360 > 180) | ((blon - lon) % 360 >= 180) | (blon == lon)
+		cross_forward = ~skip & (alat + (blat - alat) * ((lon - alon) % 360) / ((blon - alon) % 360) > lat)
+	return _numpy.where ((blon - alon) % 360 > 180, cross, cross_forward)
+# }}}
+
+def _vector_array (lat1, lon1, lat2, lon2): # {{{
+	'Vectorized VectorToPoint. Coordinates are in radians. Return angular distances in radians and bearings in degrees.'
+	dist = 2 * _numpy.arcsin (_numpy.sqrt (_numpy.sin ((lat1 - lat2) / 2) ** 2 + _numpy.cos (lat1) * _numpy.cos (lat2) * _numpy.sin ((lon1 - lon2) / 2) ** 2))
+	bearing = _numpy.degrees (_numpy.arctan2 (_numpy.sin (lon2 - lon1) * _numpy.cos (lat2), _numpy.cos (lat1) * _numpy.sin (lat2) - _numpy.sin (lat1) * _numpy.cos (lat2) * _numpy.cos (lon2 - lon1)))
+	# Special case for points on the same longitude.
+	same = lon1 == lon2
+	dist = _numpy.where (same, _numpy.abs (lat1 - lat2), dist)
+	bearing = _numpy.where (same, _numpy.where (lat1 <= lat2, 0., 180.), bearing)
+	return dist, bearing
+# }}}
+
+class _ZoneBatch: # {{{
+	'The segments of the _ZoneGeometry of a set of zones, packed into contiguous arrays.'
+	def __init__ (self, zones):
+		self.zones = zones
+		self.position = dict ((z, i) for i, z in enumerate (zones))
+		geometries = [z._get_geometry () for z in zones]
+		self.serials = [z._geometry_serial for z in zones]
+		self.sizes = _numpy.array ([len (g.segments) for g in geometries], dtype = int)
+		self.starts = _numpy.concatenate (([0], _numpy.cumsum (self.sizes)[:-1]))
+		segments = _numpy.array ([s for g in geometries for s in g.segments], dtype = float).reshape (-1, 10)
+		self.alat, self.alon, self.blat, self.blon, self.ralat, self.ralon, self.rblat, self.rblon, self.length, self.bearing = _numpy.ascontiguousarray (segments.T)
+		# Intersections with the alternative origin (see _ZoneGeometry) don't depend on the player position.
+		self.base = _numpy.array ([g.base for g in geometries], dtype = int)
+	def valid (self, zones):
+		'Check whether this batch can be used for zones, in their current state.'
+		for z in zones:
+			i = self.position.get (z)
+			if i is None or z._check_points () != self.serials[i]:
+				return False
+		return True
+	def evaluate (self, point, zones):
+		'''Compute IsPointInZone and VectorToZone for point and zones, which must be in the batch.
+		Return a dict of zone: (geometry serial, inside, distance in meters, bearing).'''
+		if point == INVALID_ZONEPOINT or len (zones) == 0:
+			return {}
+		# Select the segments of zones.
+		ids = _numpy.array ([self.position[z] for z in zones], dtype = int)
+		sizes = self.sizes[ids]
+		starts = _numpy.concatenate (([0], _numpy.cumsum (sizes)[:-1]))
+		segment_zone = _numpy.repeat (_numpy.arange (len (zones)), sizes)
+		select = _numpy.arange (int (sizes.sum ())) + _numpy.repeat (self.starts[ids] - starts, sizes)
+		alat, alon, blat, blon = self.alat[select], self.alon[select], self.blat[select], self.blon[select]
+		ralat, ralon, rblat, rblon = self.ralat[select], self.ralon[select], self.rblat[select], self.rblon[select]
+		length, segment_bearing = self.length[select], self.bearing[select]
+		# Inside or outside.
+		cross = _intersect_array (point.latitude, point.longitude, alat, alon, blat, blon)
+		inside = (_numpy.add.reduceat (cross.astype (int), starts) + self.base[ids]) % 2 != 0
+		# Vector to every segment, like VectorToSegment.
+		lat, lon = _math.radians (point.latitude), _math.radians (point.longitude)
+		d1, b1 = _vector_array (ralat, ralon, lat, lon)
+		angle = _numpy.radians (b1 - segment_bearing)
+		dist = _numpy.arcsin (_numpy.sin (d1) * _numpy.sin (angle))
+		dat = _numpy.arccos (_numpy.minimum (1., _numpy.cos (d1) / _numpy.cos (dist)))
+		dat = _numpy.where (_numpy.cos (angle) < 0, -dat, dat)
+		# Point on the segment at dat from its start, like TranslatePoint.
+		b = _numpy.radians (segment_bearing)
+		tlat = _numpy.arcsin (_numpy.sin (ralat) * _numpy.cos (dat) + _numpy.cos (ralat) * _numpy.sin (dat) * _numpy.cos (b))
+		tlon = ralon + _numpy.arctan2 (_numpy.sin (b) * _numpy.sin (dat) * _numpy.cos (ralat), _numpy.cos (dat) - _numpy.sin (ralat) * _numpy.sin (tlat))
+		before = dat <= 0
+		after = ~before & (dat >= length)
+		tlat = _numpy.where (before, ralat, _numpy.where (after, rblat, tlat))
+		tlon = _numpy.where (before, ralon, _numpy.where (after, rblon, tlon))
+		dist, bearing = _vector_array (lat, lon, tlat, tlon)
+		# The closest segment of each zone; the first one wins in case of a tie, like in VectorToZone.
+		closest = _numpy.minimum.reduceat (dist, starts)
+		hits = _numpy.flatnonzero (dist == closest[segment_zone])
+		first = hits[_numpy.searchsorted (segment_zone[hits], _numpy.arange (len (zones)))]
+		meters = _numpy.degrees (closest) * 60 * 1852.
+		serials = [self.serials[i] for i in ids.tolist ()]
+		return dict (zip (zones, zip (serials, inside.tolist (), meters.tolist (), bearing[first].tolist ())))
 # }}}
 # }}}
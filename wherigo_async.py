@@ -0,0 +1,247 @@
+# wherigo_async.py - Play wherigo games from an asyncio event loop.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# This module needs Python 3.7 or later.
+# Every Game is a wherigo._Session whose callbacks use the event loop: timers are scheduled with call_later,
+# and everything the game does is put in a queue, which the program reads with Game.events.
+# Dialogs, messages and inputs are Prompts, which are answered with Prompt.answer and can be awaited.
+# Lua code never waits, so it runs directly in the loop; many games can share one loop.
+
+# Imports. {{{
+import time as _time
+import asyncio as _asyncio
+import wherigo
+from wherigo import _fields, _items
+# }}}
+
+class Prompt: # {{{
+	'''A dialog, message or input which the cartridge has shown, and which the program must answer.
+	kind is 'dialog', 'message' or 'input'; text, media (a ZMedia or None) and buttons (a list) describe it.
+	For inputs, zinput is the ZInput and choices its Choices. Awaiting a Prompt returns the answer when it is given.'''
+	def __init__ (self, game, kind, function, text, media = None, buttons = (), zinput = None, choices = ()):
+		self.game = game
+		self.kind = kind
+		self.function = function	# Lua callback to call with the answer, or None.
+		self.text = text
+		self.media = media
+		self.buttons = list (buttons)
+		self.zinput = zinput
+		self.choices = list (choices)
+		self.future = game.loop.create_future ()
+	def answer (self, value = 'Button1'):
+		'''Answer the prompt: call its Callback (for dialogs and messages, value is the name of the pressed button) or OnGetInput (with the input; None aborts it).
+		Answering a prompt twice, or after the game is closed, does nothing.'''
+		if self.future.done ():
+			return
+		self.future.set_result (value)
+		if self.function is not None:
+			self.game._attempt (self.function, value)
+	def done (self):
+		return self.future.done ()
+	def __await__ (self):
+		return self.future.__await__ ()
+	def __repr__ (self):
+		return 'Prompt (%s, %r)' % (self.kind, self.text)
+# }}}
+
+class Game: # {{{
+	'''One game, played from an asyncio event loop. file is the name of a cartridge file or a wherigo._CartridgeImage;
+	config is used for _load, on top of wherigo._default_config. The cartridge is loaded immediately.
+	Everything the game does is put in a queue as a tuple, which is returned by next_event or events:
+		('prompt', Prompt) for dialogs, messages and inputs
+		('play', media), ('stop_sound',), ('status', text), ('save',), ('quit',), ('drive_to',), ('alert',)
+		('log', level name, text), ('show', screen name, object), ('refresh',)
+		('changes', {kind: list of objects}), with the changes that wherigo._Notifier reports
+		('error', exception), if a lua function which the game called failed
+	time () is time.time (), like the times of fixes, unless a function is passed as clock.
+	Without loop, the game uses the running loop, so it must be created from a coroutine.'''
+	def __init__ (self, file, config = None, loop = None, clock = None):
+		self.loop = loop or _asyncio.get_running_loop ()
+		self.clock = clock or _time.time
+		self.queue = _asyncio.Queue ()
+		self.timers = set ()	# Handles of timers which have not run or been removed.
+		self.prompts = []	# Prompts which have not been answered.
+		self.closed = False
+		cfg = dict (wherigo._default_config)
+		cfg['env_DeviceID'] = 'Async'
+		if config is not None:
+			cfg.update (config)
+		self.session = wherigo._Session (file, self, cfg)
+		self.cartridge = self.session.cartridge
+	# Playing. {{{
+	def _attempt (self, function, *args):
+		'Call function in this game; report an exception as an error event. Return the result, or None if the call failed.'
+		if self.closed:
+			return None
+		try:
+			return self.session._call (function, *args)
+		except Exception as e:
+			self.queue.put_nowait (('error', e))
+			return None
+	def start (self):
+		'Start the game: call OnStart.'
+		if getattr (self.cartridge, 'OnStart', None):
+			self._attempt (self.cartridge.OnStart, self.cartridge)
+	def fix (self, position, time = None):
+		'''Move the player to position (an object with lat, lon, alt, epx and epy, such as a wherigo_replay.Fix), or only update timers if it is None.
+		If time is None, the time of position is used if it has one, or else the current time. Return the result of _update.'''
+		if time is None:
+			time = getattr (position, 'time', None)
+			if time is None:
+				time = self.clock ()
+		return self._attempt (self.cartridge._update, position, time)
+	async def follow (self, fixes):
+		'''Call fix for every fix from fixes, which is an async iterator (or a plain iterable).
+		Between fixes, other tasks on the loop can run. Return when fixes are exhausted or the game is closed.'''
+		if hasattr (fixes, '__aiter__'):
+			async for fix in fixes:
+				if self.closed:
+					return
+				self.fix (fix)
+				await _asyncio.sleep (0)
+		else:
+			for fix in fixes:
+				if self.closed:
+					return
+				self.fix (fix)
+				await _asyncio.sleep (0)
+	def event (self, obj, name, *args):
+		'Call the lua handler name (such as the OnClick of a command) of obj.'
+		return self._attempt (wherigo._fire, obj, name, *args)
+	async def next_event (self):
+		'Wait for the next event, and return it.'
+		return await self.queue.get ()
+	async def events (self):
+		'Async iterator over the events of the game; it ends after the game is closed and all events have been read.'
+		while not self.closed or not self.queue.empty ():
+			event = await self.queue.get ()
+			if event is None:
+				continue
+			yield event
+	async def prompt (self):
+		'Wait for the next event which is a Prompt, and return the Prompt. Other events are dropped.'
+		while True:
+			event = await self.queue.get ()
+			if event is not None and event[0] == 'prompt':
+				return event[1]
+	def close (self):
+		'End the game: cancel its timers and unanswered prompts, and end events.'
+		if self.closed:
+			return
+		self.closed = True
+		for handle in self.timers:
+			handle.cancel ()
+		self.timers.clear ()
+		for prompt in self.prompts:
+			prompt.future.cancel ()
+		self.prompts = []
+		if self.session is wherigo._session:
+			wherigo.ZCartridge._new ()
+		# Wake up a reader which is waiting in events.
+		self.queue.put_nowait (None)
+	def _ask (self, *args, **ka):
+		prompt = Prompt (self, *args, **ka)
+		self.prompts.append (prompt)
+		prompt.future.add_done_callback (lambda future: prompt in self.prompts and self.prompts.remove (prompt))
+		self.queue.put_nowait (('prompt', prompt))
+	def _tick (self, handle, callback):
+		'Run a timer callback from the loop.'
+		self.timers.discard (handle[0])
+		if self.closed:
+			return
+		# The timer computes its next deadline from the time of the cartridge.
+		self.cartridge._time = self.time ()
+		try:
+			callback ()
+		except Exception as e:
+			self.queue.put_nowait (('error', e))
+	# }}}
+	# Callbacks for wherigo. {{{
+	def dialog (self, table):
+		for entry in _items (table):
+			fields = _fields (entry)
+			self._ask ('dialog', fields.get ('Callback'), fields.get ('Text'), fields.get ('Media'))
+	def message (self, table):
+		fields = _fields (table)
+		buttons = fields.get ('Buttons')
+		self._ask ('message', fields.get ('Callback'), fields.get ('Text'), fields.get ('Media'), _items (buttons) if buttons else [])
+	def get_input (self, zinput):
+		choices = getattr (zinput, 'Choices', None)
+		on_input = zinput.OnGetInput
+		function = (lambda answer: on_input (zinput, answer)) if on_input else None
+		self._ask ('input', function, getattr (zinput, 'Text', None), getattr (zinput, 'Media', None), zinput = zinput, choices = _items (choices) if choices else [])
+	def play (self, media):
+		self.queue.put_nowait (('play', media))
+	def stop_sound (self):
+		self.queue.put_nowait (('stop_sound',))
+	def set_status (self, text):
+		self.queue.put_nowait (('status', text))
+	def save (self):
+		self.queue.put_nowait (('save',))
+	def quit (self):
+		self.queue.put_nowait (('quit',))
+	def drive_to (self, *zone):
+		self.queue.put_nowait (('drive_to',))
+	def alert (self):
+		self.queue.put_nowait (('alert',))
+	def log (self, level, levelname, text):
+		self.queue.put_nowait (('log', levelname, text))
+	def show (self, screen, item):
+		self.queue.put_nowait (('show', wherigo._screen_names[screen], item))
+	def update (self):
+		self.queue.put_nowait (('refresh',))
+	update_stats = update
+	update_map = update
+	def notify (self, changes):
+		self.queue.put_nowait (('changes', changes))
+	def add_timer (self, time, callback):
+		# The handle is only known after call_later returns, so it is passed in a list.
+		box = []
+		handle = self.loop.call_later (max (0, time), self._tick, box, callback)
+		box.append (handle)
+		self.timers.add (handle)
+		return handle
+	def remove_timer (self, handle):
+		handle.cancel ()
+		self.timers.discard (handle)
+	def time (self):
+		return self.clock ()
+	# }}}
+# }}}
+
+async def run (file, fixes, config = None, on_event = None): # {{{
+	'''Load a game, start it and follow fixes (an async iterator or an iterable); then close it.
+	Events are passed to on_event (a function or a coroutine function) while the game runs; prompts which on_event does not answer are left unanswered.
+	Return the Game.'''
+	game = Game (file, config)
+	async def handle ():
+		async for event in game.events ():
+			if on_event is None:
+				continue
+			ret = on_event (event)
+			if _asyncio.iscoroutine (ret):
+				await ret
+	reader = game.loop.create_task (handle ())
+	try:
+		game.start ()
+		await game.follow (fixes)
+	finally:
+		game.close ()
+		await reader
+	return game
+# }}}
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# wherigo_bench.py - Benchmarks for the wherigo module, using generated cartridges.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# Usage: python wherigo_bench.py [options] > result.json
+# Every configuration is a generated gwz file with a number of zones, items and timers.
+# The results are written as json, so that runs with different versions of the module can be compared with --compare.
+
+# Imports. {{{
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import zipfile
+import platform
+import tempfile
+import argparse
+import wherigo
+import wherigo_replay
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+# }}}
+
+clock = getattr (time, 'perf_counter', time.time)
+
+# Default configurations: (zones, points per zone, items, timers).
+configs = ((10, 6, 10, 2), (100, 8, 100, 10), (1000, 12, 500, 50))
+
+def make_cartridge (filename, zones, points, items, timers, seed = 0, center = (52., 5.), size = .05): # {{{
+	'''Write a gwz file with the given number of zones (each with the given number of points), items and interval timers.
+	Zones are spread randomly over a square of size degrees around center. Half of the items are in a zone, the others have a location.'''
+	rnd = random.Random (seed)
+	name = os.path.splitext (os.path.basename (filename))[0]
+	lua = ['require "Wherigo"', 'cart = Wherigo.ZCartridge ()', 'cart.Name = "Benchmark %d zones"' % zones, 'cart.StartingLocation = Wherigo.ZonePoint (%f, %f, 0)' % center]
+	zone_names = []
+	for z in range (zones):
+		lat = center[0] + rnd.uniform (-size, size) / 2
+		lon = center[1] + rnd.uniform (-size, size) / 2
+		radius = rnd.uniform (.0002, .001)
+		p = []
+		for k in range (points):
+			a = 2 * math.pi * k / points
+			r = radius * rnd.uniform (.6, 1)
+			p.append ('Wherigo.ZonePoint (%f, %f, 0)' % (lat + r * math.sin (a), lon + r * math.cos (a) / math.cos (math.radians (lat))))
+		zone = 'zone%d' % z
+		zone_names.append (zone)
+		lua.extend ([
+			'%s = Wherigo.Zone (cart)' % zone,
+			'%s.Name = "%s"' % (zone, zone),
+			'%s.Points = {%s}' % (zone, ', '.join (p)),
+			'%s.OriginalPoint = Wherigo.ZonePoint (%f, %f, 0)' % (zone, lat, lon),
+			'%s.ProximityRange = Wherigo.Distance (%d, "meters")' % (zone, rnd.choice ((30, 60, 100))),
+			'%s.DistanceRange = Wherigo.Distance (%d, "meters")' % (zone, rnd.choice ((-1, 200, 500))),
+			'%s.Active = true' % zone,
+			'%s.OnEnter = function (self) cart.Entered = (cart.Entered or 0) + 1 end' % zone])
+	for i in range (items):
+		item = 'item%d' % i
+		if i % 2 == 0 and len (zone_names) > 0:
+			lua.append ('%s = Wherigo.ZItem {Cartridge = cart, Container = %s}' % (item, rnd.choice (zone_names)))
+		else:
+			lua.append ('%s = Wherigo.ZItem (cart)' % item)
+			lua.append ('%s.ObjectLocation = Wherigo.ZonePoint (%f, %f, 0)' % (item, center[0] + rnd.uniform (-size, size) / 2, center[1] + rnd.uniform (-size, size) / 2))
+		lua.append ('%s.Name = "%s"' % (item, item))
+	for t in range (timers):
+		timer = 'timer%d' % t
+		lua.extend ([
+			'%s = Wherigo.ZTimer (cart)' % timer,
+			'%s.Name = "%s"' % (timer, timer),
+			'%s.Type = "Interval"' % timer,
+			'%s.Duration = %d' % (timer, rnd.randint (5, 120)),
+			'%s.OnTick = function (self) cart.Ticks = (cart.Ticks or 0) + 1 end' % timer])
+	lua.append ('return cart')
+	wfi = 'Name: Benchmark\nStartingLocation: %f %f 0\nActivity: Benchmark\nTargetDevice: PocketPC\n' % center
+	with zipfile.ZipFile (filename, 'w') as z:
+		z.writestr (name + '/_cartridge.lua', '\n'.join (lua) + '\n')
+		z.writestr (name + '/_cartridge.wfi', wfi)
+# }}}
+
+def make_track (fixes, seed = 0, center = (52., 5.), size = .05, step = 5.): # {{{
+	'Return a random walk of fixes, one per second, of about step meters each, which stays within the cartridge area.'
+	rnd = random.Random (seed + 1)
+	lat, lon = center
+	bearing = rnd.uniform (0, 2 * math.pi)
+	ret = []
+	for i in range (fixes):
+		bearing += rnd.gauss (0, .3)
+		lat += step / 111120. * math.cos (bearing)
+		lon += step / 111120. * math.sin (bearing) / math.cos (math.radians (lat))
+		if abs (lat - center[0]) > size / 2 or abs (lon - center[1]) > size / 2:
+			bearing += math.pi
+		ret.append (wherigo_replay.Fix (1e9 + i, lat, lon, 0., 4., 4.))
+	return ret
+# }}}
+
+def percentile (values, p): # {{{
+	values = sorted (values)
+	if len (values) == 0:
+		return None
+	return values[min (len (values) - 1, int (len (values) * p / 100.))]
+# }}}
+
+def run (zones, points, items, timers, fixes = 1000, seed = 0, engine = None, calls = 10000): # {{{
+	'Run all benchmarks for one configuration; return the results as a dict.'
+	ret = {'zones': zones, 'points': points, 'items': items, 'timers': timers, 'fixes': fixes, 'engine': engine}
+	tmp = tempfile.mkdtemp ()
+	try:
+		filename = os.path.join (tmp, 'bench.gwz')
+		make_cartridge (filename, zones, points, items, timers, seed)
+		r = wherigo_replay.Replay ()
+		# Loading.
+		if tracemalloc is not None:
+			tracemalloc.start ()
+		start = clock ()
+		cartridge = r.load (filename)
+		ret['load'] = clock () - start
+		if tracemalloc is not None:
+			memory = tracemalloc.get_traced_memory ()[0]
+			tracemalloc.stop ()
+			ret['memory_per_object'] = memory / float (len (cartridge.AllZObjects))
+		else:
+			ret['memory_per_object'] = None
+		ret['objects'] = len (cartridge.AllZObjects)
+		if engine is not None:
+			cartridge._zone_engine = engine
+		# Updates.
+		track = make_track (fixes, seed)
+		r.begin (track[0].time)
+		for t in cartridge._objects_of (wherigo.ZTimer):
+			t.Start ()
+		latency = []
+		for fix in track:
+			r.advance (fix.time)
+			start = clock ()
+			cartridge._update (fix, r.now)
+			latency.append (clock () - start)
+		ret['update'] = {'mean': sum (latency) / len (latency), 'p50': percentile (latency, 50), 'p99': percentile (latency, 99), 'max': max (latency)}
+		# Geometry.
+		zone_list = cartridge._objects_of (wherigo.Zone)
+		if len (zone_list) > 0:
+			rnd = random.Random (seed + 2)
+			pairs = [(wherigo.ZonePoint (f.lat, f.lon, 0), rnd.choice (zone_list)) for f in track]
+			pairs = (pairs * (calls // len (pairs) + 1))[:calls]
+			for name, function in (('is_point_in_zone', wherigo.IsPointInZone), ('vector_to_zone', wherigo.VectorToZone)):
+				start = clock ()
+				for point, zone in pairs:
+					function (point, zone)
+				ret[name] = len (pairs) / (clock () - start)
+	finally:
+		shutil.rmtree (tmp)
+		wherigo.ZCartridge._new ()
+	return ret
+# }}}
+
+def compare (old, new): # {{{
+	'Print the ratio new / old for every number in matching configurations of two result files.'
+	key = lambda r: (r['zones'], r['points'], r['items'], r['timers'], r['fixes'], r['engine'])
+	old_results = dict ((key (r), r) for r in old['results'])
+	for r in new['results']:
+		o = old_results.get (key (r))
+		if o is None:
+			continue
+		sys.stdout.write ('%d zones, %d points, %d items, %d timers, engine %s:\n' % (r['zones'], r['points'], r['items'], r['timers'], r['engine']))
+		for name in ('load', 'memory_per_object', 'is_point_in_zone', 'vector_to_zone'):
+			if o.get (name) and r.get (name) is not None:
+				sys.stdout.write ('\t%s: %.3f\n' % (name, r[name] / o[name]))
+		for name in ('mean', 'p50', 'p99'):
+			sys.stdout.write ('\tupdate %s: %.3f\n' % (name, r['update'][name] / o['update'][name]))
+# }}}
+
+def main (argv): # {{{
+	parser = argparse.ArgumentParser (description = 'Benchmark the wherigo module with generated cartridges, and write the results as json.')
+	parser.add_argument ('--zones', type = int, help = 'number of zones (default: run the standard configurations)')
+	parser.add_argument ('--points', type = int, default = 8, help = 'points per zone')
+	parser.add_argument ('--items', type = int, default = 100, help = 'number of items')
+	parser.add_argument ('--timers', type = int, default = 10, help = 'number of timers')
+	parser.add_argument ('--fixes', type = int, default = 1000, help = 'number of positions for measuring _update')
+	parser.add_argument ('--engine', choices = ('python', 'numpy', 'auto'), help = 'zone engine to use')
+	parser.add_argument ('--seed', type = int, default = 0)
+	parser.add_argument ('--output', help = 'file to write the results to (default: standard output)')
+	parser.add_argument ('--compare', nargs = 2, metavar = ('OLD', 'NEW'), help = 'compare two result files instead of running benchmarks')
+	args = parser.parse_args (argv)
+	if args.compare:
+		with open (args.compare[0]) as f:
+			old = json.load (f)
+		with open (args.compare[1]) as f:
+			new = json.load (f)
+		compare (old, new)
+		return
+	if args.zones is None:
+		todo = configs
+	else:
+		todo = ((args.zones, args.points, args.items, args.timers),)
+	results = []
+	for zones, points, items, timers in todo:
+		sys.stderr.write ('%d zones of %d points, %d items, %d timers\n' % (zones, points, items, timers))
+		results.append (run (zones, points, items, timers, args.fixes, args.seed, args.engine))
+	output = {'python': platform.python_version (), 'numpy': getattr (wherigo._numpy, '__version__', None), 'time': time.time (), 'results': results}
+	if args.output:
+		with open (args.output, 'w') as f:
+			json.dump (output, f, indent = 1, sort_keys = True)
+	else:
+		json.dump (output, sys.stdout, indent = 1, sort_keys = True)
+		sys.stdout.write ('\n')
+# }}}
+
+if __name__ == '__main__':
+	main (sys.argv[1:])
@@ -0,0 +1,260 @@
+# wherigo_catalog.py - Index of the cartridges in a directory tree, without running them.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# Only the wfi file (for gwz files and directories) or the header (for gwc files) is read; lua is not started.
+# The results are kept in an sqlite database. A scan only reads files which are new or have a different mtime or size,
+# and only parses them again if their contents have changed.
+
+# Imports. {{{
+import os as _os
+import re as _re
+import io as _io
+import sys as _sys
+import json as _json
+import math as _math
+import sqlite3 as _sqlite3
+import hashlib as _hashlib
+import zipfile as _zipfile
+import traceback as _traceback
+import multiprocessing as _multiprocessing
+import wherigo
+# }}}
+
+# Columns of the cartridges table, after path.
+_columns = ('mtime', 'size', 'hash', 'kind', 'name', 'version', 'author', 'company', 'activity', 'device', 'guid', 'description', 'latitude', 'longitude', 'altitude', 'media', 'info', 'error')
+
+# Reading cartridges. {{{
+class _Info: # {{{
+	'Stand-in for a _CartridgeImage while parsing a wfi file: it only collects the media tree.'
+	def __init__ (self):
+		self.media = {}
+# }}}
+
+def _count_media (tree): # {{{
+	'Return the number of media in a media tree from _parse_wfi.'
+	return sum (_count_media (value) if isinstance (value, dict) else 1 for value in tree.values ())
+# }}}
+
+def _location (value): # {{{
+	'Parse a StartingLocation value; return (latitude, longitude, altitude), with None for missing numbers.'
+	numbers = [float (x) for x in _re.findall (r'[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?', value or '')][:3]
+	return tuple (numbers + [None] * (3 - len (numbers)))
+# }}}
+
+def _hash (path): # {{{
+	'Return the sha1 of the contents of a cartridge file, or of the wfi and lua files of a cartridge directory.'
+	h = _hashlib.sha1 ()
+	files = [_os.path.join (path, name) for name in ('_cartridge.wfi', '_cartridge.lua')] if _os.path.isdir (path) else [path]
+	for name in files:
+		with open (name, 'rb') as f:
+			while True:
+				data = f.read (1 << 16)
+				if not data:
+					break
+				h.update (data)
+	return h.hexdigest ()
+# }}}
+
+def read_info (path): # {{{
+	'''Read the information about a cartridge (a gwc or gwz file, or a directory with the contents of a gwz file), without running it.
+	Return a dict with the columns of the catalog (except path, mtime, size, hash and error).'''
+	ret = dict.fromkeys (_columns[3:-1])
+	if not _os.path.isdir (path) and wherigo._GWC.check (path):
+		gwc = wherigo._GWC (path)
+		try:
+			ret.update ({'kind': 'gwc', 'name': gwc.name, 'version': gwc.version, 'author': gwc.author, 'company': gwc.company, 'activity': gwc.type, 'device': gwc.device, 'guid': gwc.guid, 'description': gwc.description, 'latitude': gwc.latitude, 'longitude': gwc.longitude, 'altitude': gwc.altitude, 'media': len ([id for id in gwc.objects if id != 0])})
+			info = gwc.info ({'PlayerName': None, 'CompletionCode': None})
+		finally:
+			gwc.data.close ()
+	else:
+		image = _Info ()
+		if _os.path.isdir (path):
+			ret['kind'] = 'directory'
+			with open (_os.path.join (path, '_cartridge.wfi')) as f:
+				info = wherigo._parse_wfi (f, {'PlayerName': None, 'CompletionCode': None}, image)
+		else:
+			ret['kind'] = 'gwz'
+			with _zipfile.ZipFile (path) as z:
+				f = z.open (_os.path.join (_os.path.splitext (_os.path.basename (path))[0], '_cartridge.wfi'))
+				if _sys.version_info[0] >= 3:
+					f = _io.TextIOWrapper (f, 'utf-8', 'replace')
+				try:
+					info = wherigo._parse_wfi (f, {'PlayerName': None, 'CompletionCode': None}, image)
+				finally:
+					f.close ()
+		for key, column in (('Name', 'name'), ('Version', 'version'), ('Author', 'author'), ('Company', 'company'), ('Activity', 'activity'), ('TargetDevice', 'device')):
+			if info[key] is not None:
+				ret[column] = wherigo._info_value (info, key)
+		ret['latitude'], ret['longitude'], ret['altitude'] = _location (wherigo._info_value (info, 'StartingLocation') if info['StartingLocation'] is not None else None)
+		ret['media'] = _count_media (image.media)
+	ret['info'] = _json.dumps (dict ((key, wherigo._info_value (info, key)) for key in info if info[key] is not None), sort_keys = True)
+	return ret
+# }}}
+
+def _read (job): # {{{
+	'''Worker function for scanning: job is (path, mtime, size, known hash or None).
+	Return (path, mtime, size, hash, info or None if the hash is known, error or None).'''
+	path, mtime, size, known = job
+	try:
+		h = _hash (path)
+		if h == known:
+			return path, mtime, size, h, None, None
+		return path, mtime, size, h, read_info (path), None
+	except Exception:
+		return path, mtime, size, None, None, _traceback.format_exc ()
+# }}}
+
+def _stat (path): # {{{
+	'Return (mtime, size) of a cartridge file, or of the wfi and lua files of a cartridge directory.'
+	if not _os.path.isdir (path):
+		stat = _os.stat (path)
+		return stat.st_mtime, stat.st_size
+	stats = [_os.stat (_os.path.join (path, name)) for name in ('_cartridge.wfi', '_cartridge.lua')]
+	return max (s.st_mtime for s in stats), sum (s.st_size for s in stats)
+# }}}
+
+def find (root): # {{{
+	'Return the paths of all gwc and gwz files, and of all directories with a _cartridge.wfi and _cartridge.lua, in the tree under root.'
+	ret = []
+	for base, dirs, files in _os.walk (root):
+		if '_cartridge.wfi' in files and '_cartridge.lua' in files:
+			ret.append (base)
+		for name in files:
+			if _os.path.splitext (name)[1].lower () in ('.gwc', '.gwz'):
+				ret.append (_os.path.join (base, name))
+	return ret
+# }}}
+# }}}
+
+class Catalog: # {{{
+	'''Persistent index of cartridges, in an sqlite database.
+	Every cartridge is a dict with path and the keys in _columns: latitude, longitude and altitude are the starting location,
+	media is the number of media, info is a json object with all fields of the wfi file or gwc header, and error is the reason why the file could not be read, or None.'''
+	def __init__ (self, database):
+		self.db = _sqlite3.connect (database)
+		self.db.execute ('CREATE TABLE IF NOT EXISTS cartridges (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, kind TEXT, name TEXT, version TEXT, author TEXT, company TEXT, activity TEXT, device TEXT, guid TEXT, description TEXT, latitude REAL, longitude REAL, altitude REAL, media INTEGER, info TEXT, error TEXT)')
+		self.db.execute ('CREATE INDEX IF NOT EXISTS cartridges_location ON cartridges (latitude, longitude)')
+		self.db.commit ()
+	def close (self):
+		self.db.close ()
+	def _rows (self, query, args = ()):
+		return [dict (zip (('path',) + _columns, row)) for row in self.db.execute ('SELECT path, %s FROM cartridges %s' % (', '.join (_columns), query), args)]
+	def scan (self, root, workers = None):
+		'''Bring the entries for the tree under root up to date, reading new and changed files with a pool of workers processes (default: one per cpu).
+		Files with the same mtime and size as before are not read; files with a different mtime, but the same contents, are not parsed again.
+		Entries for cartridges which no longer exist are removed. Return (number of files read, number of files parsed, number of entries removed).'''
+		root = _os.path.abspath (root)
+		prefix = _os.path.join (root, '')
+		known = dict ((row[0], row[1:]) for row in self.db.execute ('SELECT path, mtime, size, hash FROM cartridges') if row[0] == root or row[0].startswith (prefix))
+		jobs = []
+		paths = find (root)
+		for path in paths:
+			try:
+				mtime, size = _stat (path)
+			except OSError:
+				continue
+			old = known.get (path)
+			if old is not None and old[0] == mtime and old[1] == size:
+				continue
+			jobs.append ((path, mtime, size, old[2] if old is not None else None))
+		if workers is None:
+			workers = _multiprocessing.cpu_count ()
+		if workers > 1 and len (jobs) > 1:
+			pool = _multiprocessing.Pool (min (workers, len (jobs)))
+			try:
+				results = list (pool.imap_unordered (_read, jobs, 16))
+			finally:
+				pool.close ()
+				pool.join ()
+		else:
+			results = [_read (job) for job in jobs]
+		parsed = 0
+		for path, mtime, size, h, info, error in results:
+			if info is None and error is None:
+				self.db.execute ('UPDATE cartridges SET mtime = ?, size = ? WHERE path = ?', (mtime, size, path))
+				continue
+			if info is None:
+				info = dict.fromkeys (_columns[3:-1])
+			else:
+				parsed += 1
+			row = dict (info, mtime = mtime, size = size, hash = h, error = error)
+			self.db.execute ('INSERT OR REPLACE INTO cartridges (path, %s) VALUES (?%s)' % (', '.join (_columns), ', ?' * len (_columns)), (path,) + tuple (row[c] for c in _columns))
+		gone = set (known) - set (paths)
+		self.db.executemany ('DELETE FROM cartridges WHERE path = ?', [(path,) for path in gone])
+		self.db.commit ()
+		return len (jobs), parsed, len (gone)
+	def get (self, path):
+		'Return the entry for path, or None.'
+		rows = self._rows ('WHERE path = ?', (_os.path.abspath (path),))
+		return rows[0] if len (rows) > 0 else None
+	def entries (self):
+		'Return all entries, sorted by name.'
+		return self._rows ('ORDER BY name, path')
+	def nearest (self, lat, lon, count = 10, radius = None):
+		'''Return the count cartridges with the starting location closest to (lat, lon), and at most radius meters away if radius is given, closest first, as a list of (distance in meters, entry).
+		Only the entries in a box around the position are read from the database; the box is made larger until it contains enough cartridges.'''
+		scale = 60 * 1852.	# Meters per degree of latitude.
+		here = _math.radians (lat), _math.radians (lon)
+		extent = .05
+		while True:
+			if radius is not None:
+				extent = max (extent, radius / scale)
+			lon_extent = extent / max (1e-9, _math.cos (_math.radians (min (89.9, abs (lat) + extent))))
+			query = 'WHERE latitude BETWEEN ? AND ?'
+			args = [lat - extent, lat + extent]
+			if extent < 90 and lon_extent < 180:
+				low, high = (lon - lon_extent + 180) % 360 - 180, (lon + lon_extent + 180) % 360 - 180
+				query += ' AND (longitude BETWEEN ? AND ?)' if low <= high else ' AND (longitude >= ? OR longitude <= ?)'
+				args += [low, high]
+			# Everything outside the box is at least this far away.
+			bound = float ('inf') if extent >= 180 else extent * scale
+			found = []
+			for entry in self._rows (query, args):
+				distance = wherigo._meters (wherigo._vector (here[0], here[1], _math.radians (entry['latitude']), _math.radians (entry['longitude']))[0])
+				if radius is None or distance <= radius:
+					found.append ((distance, entry))
+			found.sort (key = lambda x: (x[0], x[1]['path']))
+			found = found[:count]
+			if (len (found) == count and found[-1][0] <= bound) or (radius is not None and radius <= bound) or extent >= 180:
+				return found
+			extent *= 4
+# }}}
+
+def _main (argv): # {{{
+	import argparse
+	parser = argparse.ArgumentParser (description = 'Keep an index of the wherigo cartridges in directory trees, and search it.')
+	parser.add_argument ('database', help = 'sqlite file for the index')
+	parser.add_argument ('directory', nargs = '*', help = 'directories to scan')
+	parser.add_argument ('--workers', type = int, help = 'number of processes for reading files (default: one per cpu)')
+	parser.add_argument ('--near', nargs = 2, type = float, metavar = ('LAT', 'LON'), help = 'print the cartridges which start closest to this location')
+	parser.add_argument ('--count', type = int, default = 10, help = 'number of cartridges to print with --near')
+	args = parser.parse_args (argv)
+	catalog = Catalog (args.database)
+	try:
+		for directory in args.directory:
+			read, parsed, removed = catalog.scan (directory, args.workers)
+			_sys.stderr.write ('%s: %d files read, %d parsed, %d removed\n' % (directory, read, parsed, removed))
+		if args.near:
+			for distance, entry in catalog.nearest (args.near[0], args.near[1], args.count):
+				_sys.stdout.write (_json.dumps ([round (distance), entry['name'], entry['path']]) + '\n')
+	finally:
+		catalog.close ()
+# }}}
+
+if __name__ == '__main__':
+	_main (_sys.argv[1:])
@@ -0,0 +1,337 @@
+# wherigo_host.py - Serve many games of one cartridge from a pool of worker processes.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# The cartridge is parsed once, in the parent process. The workers are forked from it, so they share that image.
+# Every player has a session in one of the workers. The parent sends requests to the worker of a player;
+# everything the game does is sent back as plain data (see _Callbacks), which can be read with Host.poll.
+
+# Imports. {{{
+import time as _time
+import heapq as _heapq
+import select as _select
+import traceback as _traceback
+import multiprocessing as _multiprocessing
+import multiprocessing.connection
+import wherigo
+from wherigo_replay import Fix
+from wherigo import _fields, _items
+# }}}
+
+default_config = wherigo._default_config
+
+def _name (obj): # {{{
+	return getattr (obj, 'Name', None)
+# }}}
+
+# Worker side. {{{
+class _Callbacks: # {{{
+	'''Callbacks for the session of one player in a worker.
+	Everything is recorded in events as tuples, which are sent to the parent:
+		('dialog', request, text, media name)
+		('message', request, text, buttons, media name)
+		('input', request, name, text, input type, choices)
+		('play', media name), ('stop_sound',), ('status', text), ('save',), ('quit',), ('drive_to',), ('alert',)
+		('log', level name, text), ('show', screen name, object name), ('refresh',)
+		('changes', {kind: list of ObjIndex}), with the changes that wherigo._Notifier reports; 'screens' is {screen name: (added, removed)}, with lists of ObjIndex
+	request is a number which must be passed to Host.answer to call the Callback or OnGetInput; it is None if there is no callback.'''
+	def __init__ (self, worker, player):
+		self.worker = worker
+		self.player = player
+		self.events = []
+		self.pending = {}	# request: function to call with the answer.
+		self.serial = 0
+		self.refresh = False
+	def request (self, function):
+		if not function:
+			return None
+		self.serial += 1
+		self.pending[self.serial] = function
+		return self.serial
+	def dialog (self, table):
+		for entry in _items (table):
+			fields = _fields (entry)
+			self.events.append (('dialog', self.request (fields.get ('Callback')), fields.get ('Text'), _name (fields.get ('Media'))))
+	def message (self, table):
+		fields = _fields (table)
+		buttons = fields.get ('Buttons')
+		self.events.append (('message', self.request (fields.get ('Callback')), fields.get ('Text'), _items (buttons) if buttons else [], _name (fields.get ('Media'))))
+	def get_input (self, zinput):
+		choices = getattr (zinput, 'Choices', None)
+		on_input = zinput.OnGetInput
+		function = (lambda answer: on_input (zinput, answer)) if on_input else None
+		self.events.append (('input', self.request (function), zinput.Name, getattr (zinput, 'Text', None), zinput.InputType, _items (choices) if choices else []))
+	def play (self, media):
+		self.events.append (('play', _name (media)))
+	def stop_sound (self):
+		self.events.append (('stop_sound',))
+	def set_status (self, text):
+		self.events.append (('status', text))
+	def save (self):
+		self.events.append (('save',))
+	def quit (self):
+		self.events.append (('quit',))
+	def drive_to (self, *zone):
+		self.events.append (('drive_to',))
+	def alert (self):
+		self.events.append (('alert',))
+	def log (self, level, levelname, text):
+		self.events.append (('log', levelname, text))
+	def show (self, screen, item):
+		self.events.append (('show', wherigo._screen_names[screen], _name (item)))
+	def update (self):
+		self.refresh = True
+	def update_stats (self):
+		self.refresh = True
+	def update_map (self):
+		self.refresh = True
+	def notify (self, changes):
+		changes = dict (changes)
+		screens = changes.pop ('screens', {})
+		changes = dict ((kind, [obj.ObjIndex for obj in objects if hasattr (obj, 'ObjIndex')]) for kind, objects in changes.items ())
+		if len (screens) > 0:
+			changes['screens'] = dict ((name, tuple ([obj.ObjIndex for obj in objects] for objects in delta)) for name, delta in screens.items ())
+		self.events.append (('changes', changes))
+	def add_timer (self, time, callback):
+		return self.worker.add_timer (self.player, time, callback)
+	def remove_timer (self, handle):
+		self.worker.live.discard (handle)
+	def time (self):
+		return _time.time ()
+	def take (self):
+		'Return and clear the recorded events.'
+		if self.refresh:
+			self.events.append (('refresh',))
+			self.refresh = False
+		ret = self.events
+		self.events = []
+		return ret
+# }}}
+
+class _Worker: # {{{
+	'Serve the requests for the sessions in one worker process.'
+	def __init__ (self, image, connection, warm = 0):
+		self.image = image
+		self.connection = connection
+		self.idle = []		# Functions to call when there are no requests; they load sessions for the pool.
+		self.pool = wherigo._SessionPool (image, default_config, warm, self.idle.append) if warm > 0 else None
+		self.sessions = {}	# player: _Session
+		self.timers = []	# Heap of (deadline, handle, player, callback).
+		self.live = set ()	# Handles of timers which have not been removed.
+		self.serial = 0
+	def add_timer (self, player, time, callback):
+		self.serial += 1
+		_heapq.heappush (self.timers, (_time.time () + time, self.serial, player, callback))
+		self.live.add (self.serial)
+		return self.serial
+	def run (self):
+		while True:
+			while len (self.timers) > 0 and self.timers[0][1] not in self.live:
+				_heapq.heappop (self.timers)
+			timeout = None if len (self.timers) == 0 else max (0, self.timers[0][0] - _time.time ())
+			if len (self.idle) > 0:
+				timeout = 0
+			if self.connection.poll (timeout):
+				try:
+					request = self.connection.recv ()
+				except EOFError:
+					return
+				if request[0] == 'stop':
+					return
+				self.handle (request)
+			elif len (self.idle) > 0:
+				self.idle.pop (0) ()
+			now = _time.time ()
+			while len (self.timers) > 0 and self.timers[0][0] <= now:
+				deadline, handle, player, callback = _heapq.heappop (self.timers)
+				if handle not in self.live or player not in self.sessions:
+					continue
+				self.live.discard (handle)
+				self.attempt (player, callback)
+	def attempt (self, player, function, *args):
+		'Call function for player, and send the resulting events (or the error) to the parent.'
+		session = self.sessions[player]
+		try:
+			ret = session._call (function, *args)
+		except Exception:
+			self.connection.send (('error', player, _traceback.format_exc ()))
+			return
+		events = session.cbs.take ()
+		if ret is not None:
+			events.append (('update', ret))
+		if len (events) > 0:
+			self.connection.send (('events', player, events))
+	def handle (self, request):
+		kind, player = request[:2]
+		if kind == 'new':
+			config = dict (default_config)
+			config.update (request[2])
+			try:
+				if self.pool is not None:
+					session = self.pool.take (_Callbacks (self, player), config)
+				else:
+					session = wherigo._Session (self.image, _Callbacks (self, player), config)
+			except Exception:
+				self.connection.send (('error', player, _traceback.format_exc ()))
+				return
+			self.sessions[player] = session
+			self.connection.send (('started', player, session.cartridge.Name))
+			if getattr (session.cartridge, 'OnStart', None):
+				self.attempt (player, session.cartridge.OnStart, session.cartridge)
+		elif player not in self.sessions:
+			self.connection.send (('error', player, 'no such player'))
+		elif kind == 'update':
+			lat, lon, alt, epx, epy, time = request[2:]
+			if time is None:
+				time = _time.time ()
+			self.attempt (player, self.sessions[player].cartridge._update, Fix (time, lat, lon, alt, epx, epy), time)
+		elif kind == 'answer':
+			function = self.sessions[player].cbs.pending.pop (request[2], None)
+			if function is not None:
+				self.attempt (player, function, request[3])
+		elif kind == 'event':
+			session = self.sessions[player]
+			objects = session.cartridge._objects_of (wherigo.ZObject)
+			if request[2] == -1:
+				obj = session.player
+			elif 1 <= request[2] <= len (objects):
+				obj = objects[request[2] - 1]
+			else:
+				self.connection.send (('error', player, 'no object with ObjIndex %s' % request[2]))
+				return
+			self.attempt (player, wherigo._fire, obj, request[3], *request[4])
+		elif kind == 'screen':
+			session = self.sessions[player]
+			try:
+				objects = session._call (session.cartridge._screen, request[2])
+			except Exception:
+				self.connection.send (('error', player, _traceback.format_exc ()))
+				return
+			self.connection.send (('screen', player, wherigo._screen_names[request[2]] if isinstance (request[2], int) else request[2], [obj.ObjIndex for obj in objects]))
+		elif kind == 'close':
+			session = self.sessions.pop (player)
+			if session is wherigo._session:
+				wherigo.ZCartridge._new ()
+			self.connection.send (('closed', player))
+# }}}
+
+def _serve (image, connection, warm): # {{{
+	'Main function of a worker process.'
+	try:
+		_Worker (image, connection, warm).run ()
+	except KeyboardInterrupt:
+		pass
+# }}}
+# }}}
+
+class Host: # {{{
+	'''Pool of worker processes which run games of one cartridge.
+	New players are started in the worker with the fewest players, of which there may be at most max_sessions per worker.
+	Every worker keeps warm sessions loaded in advance (see wherigo._SessionPool), which it loads when it has nothing else to do.
+	All requests are asynchronous; their results are returned by poll.'''
+	def __init__ (self, file, workers = None, max_sessions = 100, warm = 0):
+		self.image = file if isinstance (file, wherigo._CartridgeImage) else wherigo._CartridgeImage (file)
+		self.max_sessions = max_sessions
+		if hasattr (_multiprocessing, 'get_context'):
+			# Forked workers share the parsed image with this process; otherwise they load it again.
+			methods = _multiprocessing.get_all_start_methods ()
+			context = _multiprocessing.get_context ('fork' if 'fork' in methods else None)
+		else:
+			context = _multiprocessing
+		self.workers = []	# [connection, process, set of players]
+		for i in range (workers or _multiprocessing.cpu_count ()):
+			parent, child = context.Pipe ()
+			process = context.Process (target = _serve, args = (self.image, child, warm))
+			process.daemon = True
+			process.start ()
+			child.close ()
+			self.workers.append ([parent, process, set ()])
+		self.players = {}	# player: worker
+		self.starting = set ()	# Players whose game has not reported 'started' yet.
+		self.serial = 0
+	def new_player (self, config = None):
+		'''Start a game in the least busy worker; return the player id. config is used for _load, on top of default_config.
+		Raises RuntimeError if all workers have max_sessions players.'''
+		available = [w for w in self.workers if len (w[2]) < self.max_sessions]
+		if len (available) == 0:
+			raise RuntimeError ('all workers have the maximum number of sessions')
+		worker = min (available, key = lambda w: len (w[2]))
+		self.serial += 1
+		player = self.serial
+		# The slot is taken now, so games which are still loading count; it is freed again if loading fails.
+		worker[2].add (player)
+		self.players[player] = worker
+		self.starting.add (player)
+		worker[0].send (('new', player, config or {}))
+		return player
+	def update (self, player, lat, lon, alt = 0, epx = None, epy = None, time = None):
+		'Call _update for the game of player. If time is None, the current time of the worker is used.'
+		self.players[player][0].send (('update', player, lat, lon, alt, epx, epy, time))
+	def answer (self, player, request, value):
+		'Answer a dialog, message or input event; value is the button name or the input.'
+		self.players[player][0].send (('answer', player, request, value))
+	def event (self, player, obj, name, *args):
+		'Call the lua handler name (such as the OnClick of a command) of the object with ObjIndex obj (-1 for Player).'
+		self.players[player][0].send (('event', player, obj, name, args))
+	def screen (self, player, screen):
+		'''Request the contents of a list screen (INVENTORYSCREEN, ITEMSCREEN, LOCATIONSCREEN or TASKSCREEN, or its name) of the game of player.
+		After this, changes of the list screens are reported in the 'screens' entry of changes events.'''
+		self.players[player][0].send (('screen', player, screen))
+	def close (self, player):
+		'End the game of player.'
+		worker = self.players.pop (player)
+		worker[2].discard (player)
+		self.starting.discard (player)
+		worker[0].send (('close', player))
+	def poll (self, timeout = None):
+		'''Wait at most timeout seconds for results; return a list of them. Every result is a tuple of:
+			('started', player, cartridge name)
+			('screen', player, screen name, list of ObjIndex), for screen
+			('events', player, list of events, as described in _Callbacks; the result of _update is ('update', update_all))
+			('closed', player)
+			('error', player, description); if the game of player could not be loaded, the player is gone after this'''
+		connections = [w[0] for w in self.workers]
+		if hasattr (_multiprocessing.connection, 'wait'):
+			ready = _multiprocessing.connection.wait (connections, timeout)
+		else:
+			ready = [c for c in connections if c.fileno () in _select.select ([c.fileno () for c in connections], [], [], timeout)[0]]
+		ret = []
+		for connection in ready:
+			while connection.poll ():
+				result = connection.recv ()
+				if result[1] in self.starting and result[0] in ('started', 'error'):
+					self.starting.discard (result[1])
+					if result[0] == 'error':
+						worker = self.players.pop (result[1], None)
+						if worker is not None:
+							worker[2].discard (result[1])
+				ret.append (result)
+		return ret
+	def stats (self):
+		'Return the number of players for every worker.'
+		return [len (w[2]) for w in self.workers]
+	def shutdown (self):
+		for connection, process, players in self.workers:
+			try:
+				connection.send (('stop', None))
+			except (IOError, OSError):
+				pass
+		for connection, process, players in self.workers:
+			process.join ()
+			connection.close ()
+		self.workers = []
+# }}}
@@ -0,0 +1,366 @@
+# wherigo_replay.py - Play a wherigo cartridge without a gui, from a recorded track.
+# vim: set fileencoding=utf-8 foldmethod=marker :
+# Copyright 2012 Bas Wijnen <wijnen@debian.org> {{{
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# }}}
+
+# The game runs on a virtual clock, which jumps straight to the next fix or timer deadline.
+# Questions and messages are answered from a script, and everything that happens is written to an event log.
+
+# Imports. {{{
+import wherigo
+import re as _re
+import sys as _sys
+import json as _json
+import heapq as _heapq
+import calendar as _calendar
+import xml.etree.ElementTree as _ElementTree
+# }}}
+
+# Reading tracks. {{{
+class Fix: # {{{
+	'A recorded position, which can be passed to _update.'
+	def __init__ (self, time, lat, lon, alt = 0, epx = None, epy = None):
+		self.time = time
+		self.lat = lat
+		self.lon = lon
+		self.alt = alt
+		self.epx = epx
+		self.epy = epy
+	def __repr__ (self):
+		return 'Fix (%f, %f, %f, %f)' % (self.time, self.lat, self.lon, self.alt)
+# }}}
+
+def _parse_time (text): # {{{
+	'Parse an ISO 8601 time, as used in gpx files; return seconds since the epoch.'
+	r = _re.match (r'\s*(\d+)-(\d+)-(\d+)[T ](\d+):(\d+):(\d+(?:\.\d*)?)\s*(Z|[+-]\d\d:?\d\d)?\s*$', text)
+	if r is None:
+		raise ValueError ('invalid time: %s' % text)
+	seconds = float (r.group (6))
+	ret = _calendar.timegm (tuple (int (r.group (i)) for i in range (1, 6)) + (int (seconds), 0, 0, 0)) + seconds % 1
+	zone = r.group (7)
+	if zone and zone != 'Z':
+		offset = (int (zone[1:3]) * 60 + int (zone[-2:])) * 60
+		ret += -offset if zone[0] == '+' else offset
+	return ret
+# }}}
+
+def read_gpx (file, interval = 1.): # {{{
+	'''Read track points (or route points, if there are no tracks) from a gpx file; return a list of Fixes.
+	Points without a time are interval seconds after the previous point.'''
+	points = {'trkpt': [], 'rtept': []}
+	for event, element in _ElementTree.iterparse (file):
+		tag = element.tag.rsplit ('}', 1)[-1]
+		if tag not in points:
+			continue
+		data = {}
+		for child in element:
+			data[child.tag.rsplit ('}', 1)[-1]] = child.text
+		points[tag].append ((float (element.get ('lat')), float (element.get ('lon')), data))
+		element.clear ()
+	ret = []
+	for lat, lon, data in points['trkpt'] or points['rtept']:
+		if data.get ('time'):
+			time = _parse_time (data['time'])
+		else:
+			time = ret[-1].time + interval if len (ret) > 0 else 0.
+		epx = float (data['hdop']) * 5 if data.get ('hdop') else None
+		ret.append (Fix (time, lat, lon, float (data['ele']) if data.get ('ele') else 0., epx, epx))
+	return ret
+# }}}
+
+def read_nmea (file): # {{{
+	'''Read positions from RMC and GGA sentences in an nmea log; return a list of Fixes.
+	Sentences with the same time are combined into one fix. Sentences with a wrong checksum, or without a valid position, are ignored.
+	Only RMC sentences have a date; fixes before the first of them are dated from it. If there is no RMC sentence, the times start on 1 January 1970.'''
+	def coordinate (value, hemisphere):
+		if not value:
+			return None
+		point = value.index ('.') if '.' in value else len (value)
+		ret = int (value[:point - 2]) + float (value[point - 2:]) / 60
+		return -ret if hemisphere in ('S', 'W') else ret
+	ret = []
+	current = None	# [time of day, fix]
+	base = None	# Start of the day of the first fix, once a date is known.
+	days = 0	# Day of the current fix, counted from the day of the first fix.
+	for line in file:
+		if isinstance (line, bytes):
+			line = line.decode ('ascii', 'replace')
+		line = line.strip ()
+		if not line.startswith ('$'):
+			continue
+		if '*' in line:
+			line, checksum = line[1:].split ('*', 1)
+			check = 0
+			for c in line:
+				check ^= ord (c)
+			try:
+				if int (checksum[:2], 16) != check:
+					continue
+			except ValueError:
+				continue
+		else:
+			line = line[1:]
+		fields = line.split (',')
+		kind = fields[0][2:]
+		if kind == 'RMC' and len (fields) > 9:
+			if fields[2] != 'A':
+				continue
+			tod, lat, lon, alt, epx = fields[1], coordinate (fields[3], fields[4]), coordinate (fields[5], fields[6]), None, None
+			date = None
+			if len (fields[9]) == 6:
+				# Two digit years are 1980 to 2079.
+				year = int (fields[9][4:])
+				date = _calendar.timegm ((year + (2000 if year < 80 else 1900), int (fields[9][2:4]), int (fields[9][:2]), 0, 0, 0, 0, 0, 0))
+		elif kind == 'GGA' and len (fields) > 9:
+			if fields[6] in ('', '0'):
+				continue
+			tod, lat, lon, date = fields[1], coordinate (fields[2], fields[3]), coordinate (fields[4], fields[5]), None
+			alt = float (fields[9]) if fields[9] else None
+			epx = float (fields[8]) * 5 if fields[8] else None
+		else:
+			continue
+		if lat is None or lon is None or len (tod) < 6:
+			continue
+		seconds = int (tod[:2]) * 3600 + int (tod[2:4]) * 60 + float (tod[4:])
+		new = current is None or current[0] != tod
+		if new:
+			# GGA sentences have no date; count the days when the time of day wraps.
+			while len (ret) > 0 and days * 86400 + seconds < ret[-1].time - 43200:
+				days += 1
+		if date is not None:
+			if base is None:
+				base = date - days * 86400
+			else:
+				days = int (round ((date - base) / 86400.))
+		if new:
+			current = [tod, Fix (0., lat, lon, 0., None, None)]
+			ret.append (current[1])
+		fix = current[1]
+		fix.time = days * 86400 + seconds
+		fix.lat, fix.lon = lat, lon
+		if alt is not None:
+			fix.alt = alt
+		if epx is not None:
+			fix.epx = fix.epy = epx
+	if base is not None:
+		for fix in ret:
+			fix.time += base
+	return ret
+# }}}
+
+def read_track (filename): # {{{
+	'Read a gpx or nmea file, depending on its contents; return a list of Fixes.'
+	with open (filename, 'rb') as f:
+		start = f.read (512).lstrip ()
+	with open (filename, 'rb') as f:
+		if start.startswith (b'<'):
+			return read_gpx (f)
+		return read_nmea (f)
+# }}}
+# }}}
+
+class Replay: # {{{
+	'''Callbacks for wherigo._load, which play the game on a virtual clock.
+	answers maps the Name (or Text) of a ZInput to an answer, or a list of answers which are used in turn. Unanswered inputs are aborted.
+	buttons maps the Text of a message to the button which is pressed; the default is Button1.
+	All events are appended to events as tuples of (time since start, kind, subject, detail).'''
+	def __init__ (self, answers = None, buttons = None):
+		self.answers = {}
+		for key, value in (answers or {}).items ():
+			self.answers[key] = list (value) if isinstance (value, (list, tuple)) else [value]
+		self.buttons = dict (buttons or {})
+		self.events = []
+		self.now = 0.
+		self.start = None
+		self.cartridge = None
+		self.timers = []		# Heap of (deadline, handle, callback).
+		self.live = set ()		# Handles of timers which have not been removed.
+		self.serial = 0
+		self.pending = []		# Answers which are given after the current lua callback returns.
+		self.states = {}		# zone: (State, inside) after the last fix.
+		self.quit_called = False
+	# Running. {{{
+	def load (self, file, config = None):
+		'Load a cartridge; return the ZCartridge.'
+		cfg = {'PlayerName': 'Replay', 'CompletionCode': 'replay', 'env_Platform': 'python-wherigo', 'env_CartFolder': '/', 'env_SyncFolder': '/', 'env_LogFolder': '/', 'env_PathSep': '/', 'env_DeviceID': 'Replay', 'env_Version': '2.11-compatible', 'env_Downloaded': 0, 'env_CartFilename': '', 'env_Device': ''}
+		if config is not None:
+			cfg.update (config)
+		self.cartridge = wherigo._load (file, self, cfg)
+		return self.cartridge
+	def event (self, kind, subject = None, detail = None):
+		self.events.append ((self.now - (self.start or 0.), kind, subject, detail))
+	def begin (self, time):
+		'Start the game at the given time, and call OnStart.'
+		self.start = self.now = time
+		self.cartridge._update (None, time)
+		self.event ('start', self.cartridge.Name)
+		if getattr (self.cartridge, 'OnStart', None):
+			self.call (self.cartridge.OnStart, self.cartridge)
+		self.answer ()
+	def advance (self, time):
+		'Run all timers with a deadline before or at time, and set the clock to time.'
+		while len (self.timers) > 0 and self.timers[0][0] <= time and not self.quit_called:
+			deadline, handle, callback = _heapq.heappop (self.timers)
+			if handle not in self.live:
+				continue
+			self.live.discard (handle)
+			self.now = max (self.now, deadline)
+			self.evaluate (None)
+			timer = getattr (callback, '__self__', None)
+			self.event ('tick', getattr (timer, 'Name', None))
+			callback ()
+			self.answer ()
+		self.now = max (self.now, time)
+	def fix (self, fix):
+		'Move the player to fix.'
+		self.advance (fix.time)
+		self.evaluate (fix)
+		self.answer ()
+	def run (self, fixes, until = None):
+		'''Play the game along fixes (which must be in time order). Timers keep running after the last fix, until the given time.
+		Return the list of events.'''
+		if self.start is None:
+			self.begin (fixes[0].time if len (fixes) > 0 else 0.)
+		for f in fixes:
+			if self.quit_called:
+				break
+			self.fix (f)
+		if until is not None and not self.quit_called:
+			self.advance (until)
+		return self.events
+	def evaluate (self, fix):
+		'Call _update with fix (or None) at the current time, and log the zones which it changed before what their handlers did.'
+		first = len (self.events)
+		self.cartridge._update (fix, self.now)
+		self.check_zones (first)
+	def check_zones (self, at = None):
+		'''Log zones which changed state since the last check. The events are inserted at index at of events, or appended if it is None;
+		_update calls OnEnter and the other handlers of a zone when it changes state, so their events must come after it.'''
+		changes = []
+		for zone in self.cartridge._objects_of (wherigo.Zone):
+			state = (zone.State, zone._inside)
+			old = self.states.get (zone, ('NotInRange', False))
+			if state == old:
+				continue
+			self.states[zone] = state
+			if state[1] != old[1]:
+				self.event ('enter' if state[1] else 'exit', zone.Name)
+				changes.append (self.events.pop ())
+			if state[0] != old[0]:
+				self.event ('state', zone.Name, state[0])
+				changes.append (self.events.pop ())
+		if at is None:
+			at = len (self.events)
+		self.events[at:at] = changes
+	def answer (self):
+		'Answer the questions and messages which were shown by the last lua callback.'
+		while len (self.pending) > 0:
+			self.call (self.pending.pop (0))
+	def call (self, function, *args):
+		'Call a lua function in the session of the game; other games may have run since it was set up.'
+		if self.cartridge._session is None:
+			return function (*args)
+		return self.cartridge._session._call (function, *args)
+	# }}}
+	# Callbacks for wherigo. {{{
+	def dialog (self, table):
+		for entry in wherigo._items (table):
+			fields = wherigo._fields (entry)
+			self.event ('dialog', fields.get ('Text'))
+			if fields.get ('Callback'):
+				self.pending.append (lambda cb = fields['Callback']: cb ('Button1'))
+	def message (self, table):
+		fields = wherigo._fields (table)
+		text = fields.get ('Text')
+		button = self.buttons.get (text, 'Button1')
+		self.event ('message', text, button)
+		if fields.get ('Callback'):
+			self.pending.append (lambda: fields['Callback'] (button))
+	def get_input (self, zinput):
+		answers = self.answers.get (zinput.Name) or self.answers.get (getattr (zinput, 'Text', None))
+		answer = None
+		if answers:
+			answer = answers[0] if len (answers) == 1 else answers.pop (0)
+		self.event ('input', zinput.Name, answer)
+		if zinput.OnGetInput:
+			self.pending.append (lambda: zinput.OnGetInput (zinput, answer))
+	def play (self, media):
+		self.event ('play', getattr (media, 'Name', None))
+	def stop_sound (self):
+		self.event ('stop_sound')
+	def set_status (self, text):
+		self.event ('status', text)
+	def save (self):
+		self.event ('save')
+	def quit (self):
+		self.event ('quit')
+		self.quit_called = True
+	def drive_to (self, *zone):
+		self.event ('drive_to')
+	def alert (self):
+		self.event ('alert')
+	def log (self, level, levelname, text):
+		self.event ('log', levelname, text)
+	def show (self, screen, item):
+		self.event ('show', wherigo._screen_names[screen], getattr (item, 'Name', None))
+	def update (self):
+		pass
+	def update_stats (self):
+		pass
+	def update_map (self):
+		pass
+	def add_timer (self, time, callback):
+		self.serial += 1
+		_heapq.heappush (self.timers, (self.now + time, self.serial, callback))
+		self.live.add (self.serial)
+		return self.serial
+	def remove_timer (self, handle):
+		self.live.discard (handle)
+	def time (self):
+		return self.now
+	# }}}
+# }}}
+
+def replay (cartridge, track, answers = None, buttons = None, until = None, config = None): # {{{
+	'''Load cartridge (a file name), play it along track (a file name or a list of Fixes) and return the list of events.
+	If until is given, timers keep running until that time (in seconds since the epoch, like the times of the fixes).'''
+	if not isinstance (track, (list, tuple)):
+		track = read_track (track)
+	r = Replay (answers, buttons)
+	r.load (cartridge, config)
+	return r.run (track, until)
+# }}}
+
+def _main (argv): # {{{
+	import argparse
+	parser = argparse.ArgumentParser (description = 'Play a wherigo cartridge along a recorded track, and print what happens.')
+	parser.add_argument ('cartridge', help = 'gwc or gwz file, or directory with the contents of a gwz file')
+	parser.add_argument ('track', help = 'gpx or nmea file')
+	parser.add_argument ('--answers', help = 'json file with an object containing "inputs" (answers by input name) and "buttons" (buttons by message text)')
+	parser.add_argument ('--until', type = float, help = 'keep running timers until this many seconds after the start')
+	args = parser.parse_args (argv)
+	script = {}
+	if args.answers:
+		with open (args.answers) as f:
+			script = _json.load (f)
+	track = read_track (args.track)
+	until = None if args.until is None or len (track) == 0 else track[0].time + args.until
+	for time, kind, subject, detail in replay (args.cartridge, track, script.get ('inputs'), script.get ('buttons'), until):
+		_sys.stdout.write (_json.dumps ([round (time, 3), kind, subject, detail]) + '\n')
+# }}}
+
+if __name__ == '__main__':
+	_main (_sys.argv[1:])